@@ -0,0 +1,274 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+from sqlalchemy import delete, func, insert, select, update
+from models import db, PhotoEvent, AnalyticsRollup, ReferrerRollup, RollupWatermark
+
+# --- VIEW & LIKE ANALYTICS ---
+# Photo.views / Photo.likes only know lifetime totals. For "views per day", referrers and
+# trends every view and like is also recorded as an event:
+#   1. record() appends to an in-memory buffer, the request doesn't wait on the DB
+#   2. every ANALYTICS_FLUSH_INTERVAL seconds the buffer goes into photo_events in one INSERT
+#   3. every ANALYTICS_ROLLUP_INTERVAL seconds rollup() folds new events into hourly and
+#      daily buckets per photo and per photographer (analytics_rollups), plus daily views
+#      per referrer, and prunes raw events older than ANALYTICS_RAW_RETENTION_DAYS
+# Dashboard queries only ever read the rollups, so any range is a short index scan.
+# Buckets are UTC. Numbers lag by up to a flush + a rollup interval (+ the settle time).
+#
+# The rollup watermark is the last photo_events.id folded in. Ids are given out when the
+# INSERT runs but only become visible at COMMIT, so while one flush is still committing a
+# later one can already be readable with higher ids. Moving the watermark past those would
+# skip the slow batch for good. So every row is stamped with recorded_at at flush, and
+# rollup() stops at the first event that isn't ANALYTICS_ROLLUP_SETTLE seconds old yet.
+
+events = PhotoEvent.__table__
+rollups = AnalyticsRollup.__table__
+referrers = ReferrerRollup.__table__
+watermarks = RollupWatermark.__table__
+
+KINDS = {'view': (1, 0), 'like': (0, 1), 'unlike': (0, -1)}   # kind -> (views, likes)
+GRANULARITIES = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+# Widest range a single query may ask for, in buckets
+MAX_BUCKETS = {'hour': 24 * 31, 'day': 366 * 5}
+WATERMARK = 'photo_events'
+
+
+def floor_bucket(when, granularity):
+    if granularity == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_time(value):
+    """ISO date/datetime from a query string, as naive UTC like everything in the DB."""
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def referrer_label(referrer, own_host):
+    """'explore' / 'feed' ... for our own pages, the host for other sites, None for direct."""
+    if not referrer:
+        return None
+    parts = urlsplit(referrer)
+    host = (parts.hostname or '').lower()
+    if not host:
+        return None
+    if host == (own_host or '').split(':')[0].lower():
+        section = parts.path.strip('/').split('/')[0]
+        return (section or 'home')[:100]
+    return host[4:100] if host.startswith('www.') else host[:100]
+
+
+class EventBuffer:
+
+    def __init__(self, app=None, socketio=None):
+        self.app = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._worker_started = False
+        self._last_rollup = time.monotonic()
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio=None):
+        self.app = app
+        self.socketio = socketio
+        self.interval = app.config.get('ANALYTICS_FLUSH_INTERVAL', 5)
+        self.rollup_interval = app.config.get('ANALYTICS_ROLLUP_INTERVAL', 60)
+        self.retention_days = app.config.get('ANALYTICS_RAW_RETENTION_DAYS', 7)
+        self.settle = app.config.get('ANALYTICS_ROLLUP_SETTLE', 30)
+        # If the DB is down for a while, keep at most this many events around
+        self.limit = app.config.get('ANALYTICS_BUFFER_LIMIT', 100000)
+        atexit.register(self.flush)
+
+    def record(self, kind, photo_id, owner_id, referrer=None, when=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown event: {kind}")
+        event = {'kind': kind, 'photo_id': photo_id, 'owner_id': owner_id,
+                 'referrer': referrer, 'occurred_at': when or datetime.utcnow()}
+        with self._lock:
+            if len(self._pending) >= self.limit:
+                self._pending.pop(0)
+                self.dropped += 1
+            self._pending.append(event)
+        self._ensure_worker()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        recorded_at = datetime.utcnow()
+        try:
+            with self.app.app_context():
+                db.session.execute(insert(events), [dict(event, recorded_at=recorded_at) for event in batch])
+                db.session.commit()
+        except Exception as e:
+            print(f"Analytics flush failed, will retry: {e}")
+            with self._lock:
+                self._pending[:0] = batch[-self.limit:]
+            return 0
+        return len(batch)
+
+    def _ensure_worker(self):
+        if self._worker_started or not (self.interval or self.rollup_interval):
+            return
+        with self._lock:
+            if self._worker_started:
+                return
+            self._worker_started = True
+        if self.socketio is not None:
+            self.socketio.start_background_task(self._run)
+        else:
+            threading.Thread(target=self._run, daemon=True, name='analytics').start()
+
+    def _run(self):
+        sleep = self.socketio.sleep if self.socketio is not None else time.sleep
+        while True:
+            sleep(self.interval)
+            self.flush()
+            if self.rollup_interval and time.monotonic() - self._last_rollup >= self.rollup_interval:
+                self._last_rollup = time.monotonic()
+                try:
+                    with self.app.app_context():
+                        rollup(settle=self.settle)
+                        prune(self.retention_days)
+                except Exception as e:
+                    print(f"Analytics rollup failed: {e}")
+
+
+# --- ROLLUPS ---
+
+def _add(table, keys, rows):
+    """Add the count columns of `rows` onto existing rows (matched on `keys`), inserting new ones."""
+    if not rows:
+        return
+    counts = [name for name in rows[0] if name not in keys]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        stmt = upsert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys],
+            set_={name: table.c[name] + stmt.excluded[name] for name in counts})
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        found = db.session.execute(
+            update(table).where(*[table.c[key] == row[key] for key in keys])
+            .values({name: table.c[name] + row[name] for name in counts})).rowcount
+        if not found:
+            db.session.execute(insert(table).values(row))
+
+
+def rollup(batch_size=50000, settle=30):
+    """Fold new photo_events into the rollup tables. Returns how many events were processed.
+
+    Only events written more than `settle` seconds ago are folded, see the note at the top.
+    """
+    done = 0
+    cutoff = datetime.utcnow() - timedelta(seconds=settle)
+    while True:
+        last_id = db.session.execute(
+            select(watermarks.c.last_event_id).where(watermarks.c.name == WATERMARK)).scalar()
+        if last_id is None:
+            db.session.execute(insert(watermarks).values(name=WATERMARK, last_event_id=0))
+            last_id = 0
+
+        batch = db.session.execute(
+            select(events.c.id, events.c.kind, events.c.photo_id, events.c.owner_id,
+                   events.c.referrer, events.c.occurred_at, events.c.recorded_at)
+            .where(events.c.id > last_id).order_by(events.c.id).limit(batch_size)).all()
+        # Stop short of the first event that might still have an uncommitted lower id before it
+        for position, event in enumerate(batch):
+            if event.recorded_at is not None and event.recorded_at >= cutoff:
+                batch = batch[:position]
+                break
+        if not batch:
+            db.session.commit()
+            return done
+
+        buckets = defaultdict(lambda: [0, 0])   # (scope, id, granularity, bucket) -> [views, likes]
+        sources = defaultdict(int)              # (user_id, day, referrer) -> views
+        for event in batch:
+            views, likes = KINDS.get(event.kind, (0, 0))
+            for granularity in GRANULARITIES:
+                bucket = floor_bucket(event.occurred_at, granularity)
+                for scope, scope_id in (('photo', event.photo_id), ('user', event.owner_id)):
+                    counts = buckets[(scope, scope_id, granularity, bucket)]
+                    counts[0] += views
+                    counts[1] += likes
+            if views:
+                sources[(event.owner_id, floor_bucket(event.occurred_at, 'day'), event.referrer or 'direct')] += views
+
+        # Move the watermark first and only if nobody else did, so two workers
+        # rolling up at the same moment can't count the same events twice
+        moved = db.session.execute(
+            update(watermarks).where(watermarks.c.name == WATERMARK, watermarks.c.last_event_id == last_id)
+            .values(last_event_id=batch[-1].id)).rowcount
+        if not moved:
+            db.session.rollback()
+            return done
+
+        _add(rollups, ('scope', 'scope_id', 'granularity', 'bucket'), [
+            {'scope': scope, 'scope_id': scope_id, 'granularity': granularity, 'bucket': bucket,
+             'views': views, 'likes': likes}
+            for (scope, scope_id, granularity, bucket), (views, likes) in buckets.items()])
+        _add(referrers, ('user_id', 'day', 'referrer'), [
+            {'user_id': user_id, 'day': day, 'referrer': referrer, 'views': views}
+            for (user_id, day, referrer), views in sources.items()])
+        db.session.commit()
+        done += len(batch)
+
+
+def prune(retention_days):
+    """Delete raw events that are rolled up and older than the retention window."""
+    if not retention_days:
+        return 0
+    last_id = db.session.execute(
+        select(watermarks.c.last_event_id).where(watermarks.c.name == WATERMARK)).scalar() or 0
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    removed = db.session.execute(delete(events).where(events.c.id <= last_id,
+                                                      events.c.occurred_at < cutoff)).rowcount
+    db.session.commit()
+    return removed
+
+
+# --- QUERIES ---
+
+def series(scope, scope_id, start, end, granularity='day'):
+    """[(bucket, views, likes)] for every bucket in [start, end), zero filled."""
+    step = GRANULARITIES[granularity]
+    start, end = floor_bucket(start, granularity), floor_bucket(end, granularity)
+    rows = db.session.execute(
+        select(rollups.c.bucket, rollups.c.views, rollups.c.likes)
+        .where(rollups.c.scope == scope, rollups.c.scope_id == scope_id,
+               rollups.c.granularity == granularity,
+               rollups.c.bucket >= start, rollups.c.bucket < end)).all()
+    found = {row.bucket: (row.views, row.likes) for row in rows}
+
+    result, bucket = [], start
+    while bucket < end:
+        views, likes = found.get(bucket, (0, 0))
+        result.append((bucket, views, likes))
+        bucket += step
+    return result
+
+
+def top_referrers(user_id, start, end, limit=10):
+    return db.session.execute(
+        select(referrers.c.referrer, func.sum(referrers.c.views).label('views'))
+        .where(referrers.c.user_id == user_id,
+               referrers.c.day >= floor_bucket(start, 'day'), referrers.c.day < end)
+        .group_by(referrers.c.referrer)
+        .order_by(func.sum(referrers.c.views).desc()).limit(limit)).all()
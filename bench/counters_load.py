@@ -0,0 +1,116 @@
+"""
+Concurrency load test for view counters: the old `photo.views += 1; commit`
+against the buffered counters in counters.py.
+
+    python bench/counters_load.py --threads 16 --hits 500 --buffers 4
+
+Every thread records `hits` views on the same few photos. --buffers simulates that many
+worker processes, each with its own CounterBuffer flushing into the same DB.
+The buffered run must end with exactly threads * hits views; the old one usually doesn't.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, User, Photo
+from counters import CounterBuffer
+
+
+def make_app(path, interval):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+    app.config['COUNTER_FLUSH_INTERVAL'] = interval
+    db.init_app(app)
+    return app
+
+
+def reset(app, photos):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(id=1, full_name='Bench', email='bench@bench.local', password_hash='x'))
+        for i in range(1, photos + 1):
+            db.session.add(Photo(id=i, title=f'P{i}', category='Nature', filename=f'{i}.jpg', user_id=1))
+        db.session.commit()
+
+
+def total_views(app):
+    with app.app_context():
+        return db.session.query(db.func.sum(Photo.views)).scalar()
+
+
+def hammer(threads, worker):
+    errors = []
+
+    def run(n):
+        try:
+            worker(n)
+        except Exception as e:
+            errors.append(e)
+
+    pool = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - started, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--hits', type=int, default=500, help='views per thread')
+    parser.add_argument('--photos', type=int, default=4)
+    parser.add_argument('--buffers', type=int, default=4, help='simulated worker processes')
+    parser.add_argument('--interval', type=float, default=0.2, help='flush interval in seconds')
+    args = parser.parse_args()
+
+    expected = args.threads * args.hits
+    path = os.path.join(tempfile.mkdtemp(), 'counters.db')
+    app = make_app(path, args.interval)
+
+    # 1. Old read-modify-write in Python
+    reset(app, args.photos)
+
+    def naive(n):
+        for i in range(args.hits):
+            with app.app_context():
+                photo = db.session.get(Photo, (n + i) % args.photos + 1)
+                photo.views += 1
+                db.session.commit()
+
+    elapsed, errors = hammer(args.threads, naive)
+    got = total_views(app)
+    print(f"read-modify-write  {got:>8} / {expected} views   lost {expected - got:>6}   "
+          f"errors {len(errors):>4}   {expected / elapsed:9.0f} hits/s")
+
+    # 2. Buffered increments, flushed as views = views + n
+    reset(app, args.photos)
+    buffers = [CounterBuffer(app) for _ in range(args.buffers)]
+
+    def buffered(n):
+        buffer = buffers[n % len(buffers)]
+        for i in range(args.hits):
+            buffer.incr((n + i) % args.photos + 1, 'views')
+
+    elapsed, errors = hammer(args.threads, buffered)
+    for buffer in buffers:
+        buffer.flush()
+    got = total_views(app)
+    print(f"buffered           {got:>8} / {expected} views   lost {expected - got:>6}   "
+          f"errors {len(errors):>4}   {expected / elapsed:9.0f} hits/s")
+
+    if got != expected:
+        sys.exit('Buffered counters lost updates!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Home feed benchmark: old IN (...) query vs the fan-out timeline in feed.py.
+
+    python bench/feed_bench.py --users 10000 --photos 1000000
+
+Seeds its own SQLite file (default bench/feed_bench.db), so your real DB is never touched.
+Only the sampled readers get their timelines built, the read path doesn't care about the rest.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event, insert
+from models import db, User, Photo, connections
+import feed as timelines
+from graph import SocialGraph
+
+social_graph = SocialGraph()
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    db.init_app(app)
+    return app
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(insert(User), [
+        {'id': i, 'full_name': f'User {i}', 'email': f'user{i}@bench.local', 'password_hash': 'x'}
+        for i in range(1, args.users + 1)
+    ])
+
+    edges = set()
+    for follower in range(1, args.users + 1):
+        for followed in rng.sample(range(1, args.users + 1), min(args.follows, args.users)):
+            if followed != follower:
+                edges.add((follower, followed))
+    db.session.execute(insert(connections), [
+        {'follower_id': a, 'followed_id': b} for a, b in edges
+    ])
+
+    start = datetime(2024, 1, 1)
+    batch = []
+    for i in range(1, args.photos + 1):
+        batch.append({
+            'id': i, 'title': f'Photo {i}', 'category': 'Nature', 'filename': f'p{i}.jpg',
+            'user_id': rng.randint(1, args.users),
+            'upload_date': start + timedelta(seconds=i * 30),
+            'views': 0, 'likes': 0,
+        })
+        if len(batch) == 50000:
+            db.session.execute(insert(Photo), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(Photo), batch)
+    db.session.commit()
+
+
+def legacy_feed(user):
+    # What feed() + feed.html used to do
+    followed_ids = [u.id for u in user.followed]
+    followed_ids.append(user.id)
+    photos = Photo.query.filter(Photo.user_id.in_(followed_ids)).order_by(Photo.upload_date.desc()).all()
+    for photo in photos:
+        photo.photographer.full_name
+        len(photo.comments)
+        user.is_connected_to(photo.photographer)
+    return photos
+
+
+def timeline_feed(user):
+    page = timelines.feed_page(user, limit=20)
+    followed = social_graph.follows_many(user.id, {photo.user_id for photo in page.items})
+    for photo in page.items:
+        photo.photographer.full_name
+        photo.comment_count
+        photo.user_id in followed
+    return page.items
+
+
+def measure(fn, readers, counter):
+    timings, queries = [], []
+    for user_id in readers:
+        db.session.expunge_all()
+        user = db.session.get(User, user_id)
+        counter[0] = 0
+        started = time.perf_counter()
+        fn(user)
+        timings.append((time.perf_counter() - started) * 1000)
+        queries.append(counter[0])
+    return timings, queries
+
+
+def report(name, timings, queries):
+    timings = sorted(timings)
+    p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+    print(f"{name:<10} p50 {statistics.median(timings):9.2f} ms   p95 {p95:9.2f} ms   "
+          f"queries/page {statistics.mean(queries):8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--photos', type=int, default=1000000)
+    parser.add_argument('--follows', type=int, default=200, help='accounts followed per user')
+    parser.add_argument('--readers', type=int, default=20, help='users whose feed gets timed')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'feed_bench.db'))
+    parser.add_argument('--reuse', action='store_true', help='skip seeding if the DB exists')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    app = make_app(args.db)
+    social_graph.init_app(app)
+    with app.app_context():
+        if not (args.reuse and os.path.exists(args.db)):
+            print(f"Seeding {args.users} users / {args.photos} photos...")
+            seed(args)
+
+        readers = random.Random(args.seed).sample(range(1, args.users + 1), args.readers)
+        for user_id in readers:
+            timelines.rebuild_feed(user_id)
+        db.session.commit()
+
+        counter = [0]
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: counter.__setitem__(0, counter[0] + 1))
+
+        report('legacy', *measure(legacy_feed, readers, counter))
+        report('timeline', *measure(timeline_feed, readers, counter))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+Load test for the main pages and Socket.IO DMs against a dataset from bench/seed.py.
+
+    python bench/seed.py --scale small
+    python bench/loadtest.py                          # every route, 200 requests each
+    python bench/loadtest.py --routes explore,feed --requests 1000
+    python bench/loadtest.py --compare latest         # diff against the previous stored run
+    python bench/loadtest.py --routes upload --image-mode inline   # include Pillow in /upload
+
+Requests go through the real app (run.py) in process with Flask's test client, so the
+numbers are server time only: routing, queries, templates, Pillow. No network, no browser.
+A pool of logged in users takes turns, ids for /photo and /portfolio are drawn with a fixed
+seed, so the same dataset + the same commit gives comparable numbers.
+
+Per route: p50/p95/p99 latency, throughput and SQL queries per request (X-DB-Queries from
+instrumentation.py). Socket.IO: ack latency of send_message with --socket-senders clients
+sending at once. Each run is stored as JSON in bench/results/ with the git commit, and
+--compare prints the change against another run (exit code 1 with --fail-on-regression).
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROUTES = ['explore', 'feed', 'portfolio', 'photo', 'messages', 'upload']
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(timings, queries, errors, wall):
+    timings = sorted(timings)
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'mean_ms': round(sum(timings) / len(timings), 2) if timings else 0.0,
+        'rps': round(len(timings) / wall, 1) if wall else 0.0,
+        'queries_per_request': round(sum(queries) / len(queries), 1) if queries else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def sample_jpeg(rng):
+    from PIL import Image
+    # Noise doesn't compress, so every upload costs a realistic amount of Pillow work
+    img = Image.frombytes('RGB', (1600, 1067), rng.randbytes(1600 * 1067 * 3))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+        # The app reads its settings at import time
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+        os.environ.setdefault('LENS_ENV', 'development')
+        os.chdir(ROOT)
+        import run
+        self.run = run
+        self.app = run.app
+        self.app.config['TESTING'] = True
+        # Uploads land in a scratch folder, not static/uploads
+        self.scratch = tempfile.mkdtemp(prefix='lens-loadtest-')
+        self.app.config['UPLOAD_FOLDER'] = os.path.join(self.scratch, 'uploads')
+        self.app.config['INCOMING_FOLDER'] = os.path.join(self.scratch, 'incoming')
+        os.makedirs(self.app.config['UPLOAD_FOLDER'])
+        os.makedirs(self.app.config['INCOMING_FOLDER'])
+        run.media.configure(self.app.config)
+        run.pipeline.mode = args.image_mode
+        run.instrumentation.headers = True
+        run.instrumentation.slow_ms = None
+
+        from models import db, User, Photo, Conversation
+        with self.app.app_context():
+            # Users with conversations, so /messages isn't an empty inbox
+            chatty = [uid for (uid,) in db.session.query(Conversation.user_id).distinct().limit(args.clients * 20)]
+            pool = chatty or [uid for (uid,) in db.session.query(User.id).limit(args.clients * 20)]
+            if not pool:
+                sys.exit(f"{args.db} is empty, run bench/seed.py first")
+            self.user_ids = self.rng.sample(pool, min(args.clients, len(pool)))
+            self.max_user = db.session.query(db.func.max(User.id)).scalar()
+            self.photo_ids = [pid for (pid,) in db.session.query(Photo.id).filter(Photo.status == 'ready')]
+
+        self.clients = [self.login(user_id) for user_id in self.user_ids]
+        self.upload_body = sample_jpeg(self.rng) if 'upload' in args.routes else None
+
+    def login(self, user_id):
+        client = self.app.test_client()
+        response = client.post('/login', data={'action': 'login', 'email': f'user{user_id}@bench.local',
+                                               'password': self.args.password})
+        if response.status_code != 302 or '/dashboard' not in response.headers.get('Location', ''):
+            sys.exit(f"Could not log in as user{user_id}@bench.local, was the DB made by bench/seed.py?")
+        return client
+
+    def request(self, route, client):
+        if route == 'explore':
+            return client.get('/explore')
+        if route == 'feed':
+            return client.get('/feed')
+        if route == 'portfolio':
+            return client.get(f'/portfolio/{self.rng.randint(1, self.max_user)}')
+        if route == 'photo':
+            return client.get(f'/photo/{self.rng.choice(self.photo_ids)}')
+        if route == 'messages':
+            return client.get('/messages')
+        if route == 'upload':
+            return client.post('/upload', content_type='multipart/form-data', data={
+                'title': 'Load test', 'category': 'street', 'description': 'bench upload',
+                'tags': 'bench, street', 'photo': (io.BytesIO(self.upload_body), 'bench.jpg')})
+        raise ValueError(f"Unknown route: {route}")
+
+    def run_route(self, route):
+        # Uploads are slow and fill the image queue, they get their own (smaller) count
+        count = self.args.upload_requests if route == 'upload' else self.args.requests
+        warmup = 0 if route == 'upload' else self.args.warmup
+        for i in range(warmup):
+            self.request(route, self.clients[i % len(self.clients)])
+
+        timings, queries, errors = [], [], 0
+        wall = time.perf_counter()
+        for i in range(count):
+            client = self.clients[i % len(self.clients)]
+            started = time.perf_counter()
+            response = self.request(route, client)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(int(response.headers.get('X-DB-Queries', 0)))
+            if response.status_code >= 400:
+                errors += 1
+            # Let the counter flusher / image dispatcher greenlets run, like the real server would
+            self.run.socketio.sleep(0)
+        return summarize(timings, queries, errors, time.perf_counter() - wall)
+
+    def run_socket(self):
+        import eventlet
+        from sqlalchemy import event
+        from models import db
+        socketio = self.run.socketio
+
+        senders = []
+        for i in range(min(self.args.socket_senders, len(self.clients))):
+            sock = socketio.test_client(self.app, flask_test_client=self.clients[i])
+            sock.emit('join', {})
+            senders.append(sock)
+        counter = [0]
+        with self.app.app_context():
+            engine = db.engine
+        count = lambda *a: counter.__setitem__(0, counter[0] + 1)
+        event.listen(engine, 'before_cursor_execute', count)
+
+        per_sender = max(self.args.socket_messages // len(senders), 1)
+        timings, errors = [], [0]
+
+        def send(index):
+            sock = senders[index]
+            others = [uid for uid in self.user_ids if uid != self.user_ids[index]] or [self.max_user]
+            for n in range(per_sender):
+                recipient = others[n % len(others)]
+                started = time.perf_counter()
+                ack = sock.emit('send_message', {'recipient_id': recipient, 'content': f'load {n}',
+                                                 'client_id': f'lt-{os.getpid()}-{index}-{n}-{time.time_ns()}'},
+                                callback=True)
+                timings.append((time.perf_counter() - started) * 1000)
+                if not ack or ack.get('status') != 'success':
+                    errors[0] += 1
+                sock.get_received()
+
+        wall = time.perf_counter()
+        pool = eventlet.GreenPool(len(senders))
+        list(pool.imap(send, range(len(senders))))
+        wall = time.perf_counter() - wall
+        event.remove(engine, 'before_cursor_execute', count)
+        for sock in senders:
+            sock.disconnect()
+
+        result = summarize(timings, [], errors[0], wall)
+        result['queries_per_request'] = round(counter[0] / len(timings), 1) if timings else 0.0
+        result['senders'] = len(senders)
+        return result
+
+    def close(self):
+        # Don't wait for queued uploads to finish processing, nobody is timing them anymore
+        if self.run.pipeline.executor is not None:
+            self.run.pipeline.executor.shutdown(wait=False, cancel_futures=True)
+        import shutil
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+def print_table(results, previous=None):
+    print(f"{'route':<12}{'reqs':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'q/req':>8}")
+    for name, r in results.items():
+        line = (f"{name:<12}{r['requests']:>6}{r['errors']:>5}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+                f"{r['p99_ms']:>10.2f}{r['rps']:>9.1f}{r['queries_per_request']:>8.1f}")
+        old = (previous or {}).get(name)
+        if old:
+            change = (r['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+            line += f"   p95 {change:+6.1f}%  q/req {r['queries_per_request'] - old['queries_per_request']:+.1f}"
+        print(line)
+
+
+def regressions(results, previous, threshold):
+    found = []
+    for name, r in results.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        if old['p95_ms'] and (r['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 > threshold:
+            found.append(f"{name}: p95 {old['p95_ms']} -> {r['p95_ms']} ms")
+        # Background flushes add the odd query, a real N+1 adds at least one to every request
+        if r['queries_per_request'] >= old['queries_per_request'] + 0.5:
+            found.append(f"{name}: queries/request {old['queries_per_request']} -> {r['queries_per_request']}")
+    return found
+
+
+def load_previous(compare, exclude=None):
+    if compare != 'latest':
+        with open(compare) as f:
+            return json.load(f)
+    runs = sorted(path for path in glob.glob(os.path.join(RESULTS_DIR, '*.json')) if path != exclude)
+    if not runs:
+        return None
+    with open(runs[-1]) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'loadtest.db'))
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma separated, any of ' + ', '.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=20, help='logged in users taking turns')
+    parser.add_argument('--password', default='benchpass')
+    parser.add_argument('--upload-requests', type=int, default=20,
+                        help='timed uploads, keep it under IMAGE_QUEUE_LIMIT in process/thread mode')
+    parser.add_argument('--image-mode', default='process', choices=['inline', 'thread', 'process'],
+                        help="'inline' puts the Pillow work inside the /upload timing (seconds per upload)")
+    parser.add_argument('--socket-messages', type=int, default=1000, help='0 skips the Socket.IO run')
+    parser.add_argument('--socket-senders', type=int, default=10)
+    parser.add_argument('--compare', help="results file to diff against, or 'latest'")
+    parser.add_argument('--threshold', type=float, default=10.0, help='p95 regression in %% worth flagging')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    args.routes = [route.strip() for route in args.routes.split(',') if route.strip()]
+    unknown = set(args.routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} doesn't exist, run bench/seed.py first")
+
+    previous = load_previous(args.compare) if args.compare else None
+
+    test = LoadTest(args)
+    results = {}
+    try:
+        for route in args.routes:
+            if route != 'upload':
+                results[route] = test.run_route(route)
+                print(f"  {route} done")
+        if args.socket_messages:
+            results['socket_dm'] = test.run_socket()
+            print("  socket_dm done")
+        # Last, queued uploads keep the image workers busy and would slow down everything after them
+        if 'upload' in args.routes:
+            results['upload'] = test.run_route('upload')
+            print("  upload done")
+    finally:
+        test.close()
+
+    commit, dirty = git_commit()
+    manifest_path = args.db + '.json'
+    dataset = json.load(open(manifest_path)) if os.path.exists(manifest_path) else None
+    run = {
+        'commit': commit, 'dirty': dirty, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'machine': platform.machine(),
+        'dataset': dataset, 'args': {key: value for key, value in vars(args).items()
+                                     if key not in ('compare', 'fail_on_regression', 'no_save')},
+        'results': results,
+    }
+
+    print(f"\ncommit {commit}{' (dirty)' if dirty else ''}, dataset "
+          f"{dataset['scale'] if dataset else os.path.basename(args.db)}")
+    print_table(results, previous['results'] if previous else None)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{commit}.json")
+        with open(path, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"\nSaved {os.path.relpath(path, ROOT)}")
+
+    if previous:
+        found = regressions(results, previous['results'], args.threshold)
+        if found:
+            print(f"\nRegressions against {previous['commit']}:")
+            for line in found:
+                print(f"  {line}")
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Related photos benchmark: the batch build in related.py at 1M photos.
+
+    python bench/related_bench.py                          # 1M photos, NumPy build only
+    python bench/related_bench.py --photos 200000 --db     # plus the full rebuild() on SQLite
+
+Photos are synthetic but shaped like ours: a few tags each from a skewed vocabulary,
+7 categories, ~50 photos per photographer, and colour histograms that lean on the category.
+The NumPy phases are timed on their own (vectorize, k-means, cell assignment, top-K),
+then recall@K of the approximate lists is checked against an exact brute force
+scan for --sample photos.
+
+--db seeds its own SQLite file (default bench/related_bench.db, your real DB is never
+touched) and times RelatedPhotos.rebuild() end to end, reads and writes included, then one
+incremental add() and the photo page's for_photo() lookup.
+"""
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from flask import Flask
+from sqlalchemy import insert
+from models import db, User, Photo, PhotoFeatures
+import related
+from related import RelatedPhotos
+
+WORDS = ['sunset', 'mountain', 'street', 'portrait', 'monsoon', 'market', 'harbour', 'desert', 'forest',
+         'festival', 'skyline', 'river', 'temple', 'snow', 'neon', 'coast', 'bridge', 'garden', 'fog', 'dune',
+         'night', 'rain', 'bw', 'film', 'drone', 'macro', 'bird', 'city', 'lake', 'wedding', 'travel', 'food']
+CATEGORIES = ['landscape', 'portrait', 'architecture', 'street', 'nature', 'wildlife', 'abstract']
+
+
+def synthetic_rows(count, seed):
+    """(id, tags, category, user_id, histogram) like related.rebuild() reads them."""
+    rng = np.random.default_rng(seed)
+    # Zipf-ish: a handful of tags are on most photos, the long tail is rare
+    weights = 1 / np.arange(1, len(WORDS) + 1)
+    weights /= weights.sum()
+    categories = rng.integers(0, len(CATEGORIES), count)
+    # Each category has its own palette, every photo is a noisy draw from it
+    palettes = rng.dirichlet(np.full(64, 0.3), len(CATEGORIES))
+    users = max(1, count // 50)
+    for i in range(count):
+        tags = ','.join(rng.choice(WORDS, rng.integers(0, 5), replace=False, p=weights))
+        share = rng.dirichlet(palettes[categories[i]] * 40 + 0.01)
+        histogram = np.round(np.sqrt(share) * 255).astype(np.uint8).tobytes()
+        yield i + 1, tags, CATEGORIES[categories[i]], int(rng.integers(1, users + 1)), histogram
+
+
+def timed(label, fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    print(f"  {label:<28}{time.perf_counter() - started:8.1f} s")
+    return result
+
+
+def numpy_build(args):
+    print(f"NumPy build, {args.photos} photos, K={args.per_photo}, probes={args.probes}:")
+    rows = list(synthetic_rows(args.photos, args.seed))
+
+    def vectorize_all():
+        parts = [related.vectorize(row[1:] for row in rows[start:start + 10000]).astype(np.float16)
+                 for start in range(0, len(rows), 10000)]
+        return np.concatenate(parts)
+
+    started = time.perf_counter()
+    matrix = timed('vectorize', vectorize_all)
+    del rows
+    centroids = timed('k-means', related.train_cells, matrix, args.cells or round(math.sqrt(args.photos)),
+                      seed=args.seed)
+    home = timed('assign cells', related.nearest_cells, matrix, centroids)[:, 0]
+
+    found = np.full((len(matrix), args.per_photo), -1, dtype=np.int64)
+    scores = np.zeros((len(matrix), args.per_photo), dtype=np.float32)
+
+    def top_k():
+        for block, others, block_scores in related.neighbours(matrix, args.per_photo, centroids,
+                                                              args.probes, home):
+            found[block, :others.shape[1]] = others
+            scores[block, :others.shape[1]] = block_scores
+
+    timed('top-K per cell', top_k)
+    total = time.perf_counter() - started
+    sizes = np.bincount(home, minlength=len(centroids))
+    print(f"  {'total':<28}{total:8.1f} s   ({len(centroids)} cells, "
+          f"median {int(np.median(sizes))} / max {sizes.max()} photos per cell)")
+
+    # Recall: how many of the exact top-K (brute force over everything) the cells found
+    rng = np.random.default_rng(args.seed + 1)
+    sample = rng.choice(len(matrix), min(args.sample, len(matrix)), replace=False)
+    recalls = []
+    for row in sample:
+        exact = matrix.astype(np.float32) @ matrix[row].astype(np.float32) if len(matrix) <= 50000 else \
+            np.concatenate([matrix[start:start + 200000].astype(np.float32) @ matrix[row].astype(np.float32)
+                            for start in range(0, len(matrix), 200000)])
+        exact[row] = -np.inf
+        best = set(np.argpartition(-exact, args.per_photo)[:args.per_photo].tolist())
+        recalls.append(len(best & set(found[row].tolist())) / args.per_photo)
+    print(f"  recall@{args.per_photo} over {len(sample)} photos: {statistics.mean(recalls):.2f}")
+
+
+def make_app(path, args):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    app.config['RELATED_PER_PHOTO'] = args.per_photo
+    app.config['RELATED_PROBES'] = args.probes
+    db.init_app(app)
+    return app
+
+
+def seed_db(args):
+    db.create_all()
+    users = max(1, args.photos // 50)
+    for start in range(1, users + 1, 50000):
+        db.session.execute(insert(User), [
+            {'id': i, 'full_name': f'Photographer {i}', 'email': f'user{i}@bench.local', 'password_hash': 'x'}
+            for i in range(start, min(start + 50000, users + 1))])
+    photos, histograms = [], []
+    for photo_id, tags, category, user_id, histogram in synthetic_rows(args.photos, args.seed):
+        photos.append({'id': photo_id, 'title': f'Photo {photo_id}', 'category': category, 'tags': tags,
+                       'filename': f'p{photo_id}.jpg', 'user_id': user_id, 'status': 'ready'})
+        histograms.append({'photo_id': photo_id, 'histogram': histogram})
+        if len(photos) == 50000:
+            db.session.execute(insert(Photo), photos)
+            db.session.execute(insert(PhotoFeatures), histograms)
+            photos, histograms = [], []
+    if photos:
+        db.session.execute(insert(Photo), photos)
+        db.session.execute(insert(PhotoFeatures), histograms)
+    db.session.commit()
+
+
+def db_build(args):
+    app = make_app(args.db, args)
+    with app.app_context():
+        if not (args.reuse and os.path.exists(args.db)):
+            db.engine.dispose()
+            if os.path.exists(args.db):
+                os.remove(args.db)
+            print(f"\nSeeding {args.photos} photos into {args.db}...")
+            seed_db(args)
+
+        engine = RelatedPhotos(app)
+        print("\nRelatedPhotos on SQLite:")
+        photos, stored = timed('rebuild()', engine.rebuild, cell_count=args.cells, seed=args.seed)
+        print(f"  {photos} photos, {stored} related rows")
+
+        # One more upload, filed incrementally like photo_processed() does
+        _, tags, category, user_id, histogram = next(synthetic_rows(1, args.seed + 2))
+        photo = Photo(title='New upload', category=category, tags=tags, filename='new.jpg',
+                      user_id=user_id, status='ready')
+        db.session.add(photo)
+        db.session.flush()
+        started = time.perf_counter()
+        engine.add(photo, histogram)
+        db.session.commit()
+        print(f"  {'add() one upload':<28}{(time.perf_counter() - started) * 1000:8.1f} ms")
+
+        timings = []
+        for photo_id in np.random.default_rng(args.seed).integers(1, photos + 1, 50).tolist():
+            db.session.expunge_all()
+            started = time.perf_counter()
+            engine.for_photo(photo_id)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"  {'for_photo() median':<28}{statistics.median(timings):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=1000000)
+    parser.add_argument('--per-photo', type=int, default=12)
+    parser.add_argument('--probes', type=int, default=8)
+    parser.add_argument('--cells', type=int, default=None, help='default: square root of --photos')
+    parser.add_argument('--sample', type=int, default=100, help='photos checked against brute force')
+    parser.add_argument('--db', nargs='?', const=os.path.join(os.path.dirname(__file__), 'related_bench.db'),
+                        default=None, help='also time rebuild() on a seeded SQLite file')
+    parser.add_argument('--reuse', action='store_true', help='skip seeding if the DB exists')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    numpy_build(args)
+    if args.db:
+        db_build(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Search benchmark: the old `full_name ILIKE '%q%'` against the FTS5 backend in search.py.
+
+    python bench/search_bench.py --users 1000000 --photos 1000000
+
+Seeds its own SQLite file (default bench/search_bench.db), so your real DB is never touched.
+Rows are bulk inserted first and indexed in one go, like `flask rebuild-search`.
+"old ILIKE" only searched user names, the other two columns search users and photos.
+Typeahead queries are timed as the user types them ("s", "su", "sun", ...).
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert
+from models import db, User, Photo
+from search import Search, FTS5Backend, LikeBackend
+
+FIRST = ['Parth', 'Ana', 'Ravi', 'Meera', 'John', 'Sofia', 'Arjun', 'Lena', 'Kabir', 'Maya', 'Omar', 'Iris']
+LAST = ['Patil', 'Sharma', 'Silva', 'Kim', 'Novak', 'Ito', 'Mehta', 'Berg', 'Rossi', 'Khan', 'Lopez', 'Ward']
+WORDS = ['sunset', 'mountain', 'street', 'portrait', 'monsoon', 'market', 'harbour', 'desert', 'forest',
+         'festival', 'skyline', 'river', 'temple', 'snow', 'neon', 'coast', 'bridge', 'garden', 'fog', 'dune']
+PLACES = ['Pune', 'Goa', 'Mumbai', 'Lisbon', 'Kyoto', 'Oslo', 'Cairo', 'Lima', 'Reykjavik', 'Hampi']
+
+QUERIES = ['parth', 'parth pat', 'sunset goa', 'monsoon market', 'kyoto temple', 'zebra']
+TYPEAHEAD = 'sunset'
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    app.config['SEARCH_BACKEND'] = 'fts5'
+    db.init_app(app)
+    return app
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    db.create_all()
+
+    batch = []
+    for i in range(1, args.users + 1):
+        batch.append({'id': i, 'full_name': f'{rng.choice(FIRST)} {rng.choice(LAST)} {i}',
+                      'email': f'user{i}@bench.local', 'password_hash': 'x',
+                      'bio': ' '.join(rng.sample(WORDS, 4)) + ' photographer from ' + rng.choice(PLACES)})
+        if len(batch) == 50000:
+            db.session.execute(insert(User), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(User), batch)
+
+    for i in range(1, args.photos + 1):
+        words = rng.sample(WORDS, 3)
+        batch.append({'id': i, 'title': f'{words[0].title()} {words[1]}', 'category': 'Nature',
+                      'description': f'A {words[2]} shot on a quiet morning', 'location': rng.choice(PLACES),
+                      'tags': ','.join(rng.sample(WORDS, 3)), 'filename': f'p{i}.jpg',
+                      'user_id': rng.randint(1, args.users), 'views': 0, 'likes': 0, 'status': 'ready'})
+        if len(batch) == 50000:
+            db.session.execute(insert(Photo), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(Photo), batch)
+    db.session.commit()
+
+
+def legacy_search(query):
+    # What search() used to do: name only, no limit, no index
+    return User.query.filter(User.full_name.ilike(f'%{query}%')).all()
+
+
+def time_it(fn, query, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        fn(query)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--photos', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'search_bench.db'))
+    parser.add_argument('--reuse', action='store_true', help='skip seeding if the DB exists')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    app = make_app(args.db)
+    with app.app_context():
+        if not (args.reuse and os.path.exists(args.db)):
+            # Start from an empty file, that also gets rid of the old FTS tables and triggers
+            db.engine.dispose()
+            if os.path.exists(args.db):
+                os.remove(args.db)
+            print(f"Seeding {args.users} users / {args.photos} photos...")
+            seed(args)
+            started = time.perf_counter()
+            Search(app).setup()
+            print(f"FTS5 index built in {time.perf_counter() - started:.1f}s")
+
+        fts = Search(app)
+        like = Search(app)
+        like.backend = LikeBackend()
+        assert isinstance(fts.backend, FTS5Backend)
+
+        def fts_both(query):
+            fts.users(query)
+            fts.photos(query)
+
+        def like_both(query):
+            like.users(query)
+            like.photos(query)
+
+        print(f"{'query':<18}{'old ILIKE':>12}{'LIKE paged':>12}{'FTS5':>10}   (median ms)")
+        for query in QUERIES:
+            print(f"{query:<18}{time_it(legacy_search, query, args.repeat):12.2f}"
+                  f"{time_it(like_both, query, args.repeat):12.2f}{time_it(fts_both, query, args.repeat):10.2f}")
+
+        print(f"\nTypeahead '{TYPEAHEAD}', FTS5 suggest (5 users + 5 photos) per keystroke:")
+        for end in range(1, len(TYPEAHEAD) + 1):
+            prefix = TYPEAHEAD[:end]
+            ms = time_it(lambda q: (fts.users(q, per_page=5, ranked=False),
+                                   fts.photos(q, per_page=5, ranked=False)), prefix, args.repeat)
+            print(f"  {prefix:<10}{ms:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
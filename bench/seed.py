@@ -0,0 +1,259 @@
+"""
+Synthetic dataset for load tests: users, a power-law follow graph, tagged photos,
+likes, comments and DM histories, written straight through the models in models.py.
+
+    python bench/seed.py --scale small                 # ~1k users, 10k photos
+    python bench/seed.py --scale large --db /tmp/lens_large.db
+    python bench/seed.py --scale medium --users 20000  # any count can be overridden
+
+Same --seed and scale = same dataset, so numbers from bench/loadtest.py compare between commits.
+Everything the app derives (tag index, feed timelines, inbox summaries, search index) is
+rebuilt at the end with the app's own rebuild functions. A <db>.json manifest records
+what was generated. Every user's password is `benchpass`, emails are user<id>@bench.local.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from models import db, User, Photo, Comment, Message, connections, photo_likes
+from config import configure_engine
+from search import Search
+from tags import rebuild_tag_index
+import feed as timelines
+import messaging
+import migrations
+
+PASSWORD = 'benchpass'
+
+SCALES = {
+    #          users   photos    conversations
+    'small':  (1000,   10000,    2000),
+    'medium': (10000,  100000,   20000),
+    'large':  (100000, 1000000,  200000),
+}
+
+CATEGORIES = ['landscape', 'portrait', 'architecture', 'street', 'nature', 'wildlife', 'abstract']
+FIRST = ['Parth', 'Ana', 'Ravi', 'Meera', 'John', 'Sofia', 'Arjun', 'Lena', 'Kabir', 'Maya', 'Omar', 'Iris']
+LAST = ['Patil', 'Sharma', 'Silva', 'Kim', 'Novak', 'Ito', 'Mehta', 'Berg', 'Rossi', 'Khan', 'Lopez', 'Ward']
+WORDS = ['sunset', 'mountain', 'street', 'portrait', 'monsoon', 'market', 'harbour', 'desert', 'forest',
+         'festival', 'skyline', 'river', 'temple', 'snow', 'neon', 'coast', 'bridge', 'garden', 'fog', 'dune',
+         'night', 'rain', 'bw', 'film', 'travel', 'wildlife', 'macro', 'drone', 'golden', 'blue']
+PLACES = ['Pune', 'Goa', 'Mumbai', 'Lisbon', 'Kyoto', 'Oslo', 'Cairo', 'Lima', 'Reykjavik', 'Hampi']
+LINES = ['hey!', 'love this shot', 'which lens was that?', 'thanks :)', 'are you free this weekend?',
+         'sending the raw files now', 'haha', 'ok', 'that light is unreal', 'see you at the meetup']
+
+BATCH = 50000
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(path)}'
+    app.config['SQLITE_PRAGMAS'] = {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -200000}
+    db.init_app(app)
+    configure_engine(app, db)
+    return app
+
+
+def zipf_weights(n, alpha):
+    # Cumulative weights for rng.choices: rank 1 gets picked far more than rank n
+    return list(itertools.accumulate(1.0 / (rank ** alpha) for rank in range(1, n + 1)))
+
+
+def bulk(table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            db.session.execute(insert(table), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(table), batch)
+
+
+def gen_users(args, rng, password_hash, start):
+    for i in range(1, args.users + 1):
+        yield {'id': i, 'full_name': f'{rng.choice(FIRST)} {rng.choice(LAST)}',
+               'email': f'user{i}@bench.local', 'password_hash': password_hash,
+               'bio': f"{' '.join(rng.sample(WORDS, 3))} photographer from {rng.choice(PLACES)}",
+               'profile_image': 'default_profile.jpg',
+               'created_at': start + timedelta(seconds=rng.randrange(args.days * 86400 // 4))}
+
+
+def gen_follows(args, rng, ranking, popularity):
+    # Out-degree is Pareto distributed (most people follow a few, some follow thousands) and
+    # targets are picked by popularity, so in-degree ends up power-law too: a handful of
+    # accounts with huge follower counts and a long tail with almost none
+    cap = max(args.users // 2, 1)
+    scale = args.avg_follows / 3   # mean of xm * pareto(1.5) is 3 * xm
+    for follower in range(1, args.users + 1):
+        degree = min(int(scale * rng.paretovariate(1.5)), cap)
+        followed = {ranking[i] for i in rng.choices(range(args.users), cum_weights=popularity, k=degree)}
+        followed.discard(follower)
+        for user_id in followed:
+            yield {'follower_id': follower, 'followed_id': user_id}
+
+
+def gen_tags(args, rng, vocabulary, weights):
+    picked = {vocabulary[i] for i in rng.choices(range(len(vocabulary)), cum_weights=weights,
+                                                 k=rng.randint(1, 5))}
+    return ', '.join(sorted(picked))
+
+
+def gen_photos(args, rng, ranking, popularity, start, stats):
+    vocabulary = WORDS + [f'{word}{n}' for n in range(2, args.tag_vocab // len(WORDS) + 2) for word in WORDS]
+    vocabulary = vocabulary[:args.tag_vocab]
+    tag_weights = zipf_weights(len(vocabulary), 1.1)
+    span = args.days * 86400
+
+    # Popular photographers post more. Sorted times so ids follow upload order like real inserts
+    offsets = sorted(rng.randrange(span) for _ in range(args.photos))
+    authors = rng.choices(range(args.users), cum_weights=popularity, k=args.photos)
+    for i, (offset, author) in enumerate(zip(offsets, authors), start=1):
+        words = rng.sample(WORDS, 3)
+        stats['photo_dates'].append(start + timedelta(seconds=offset))
+        yield {'id': i, 'title': f'{words[0].title()} {words[1]}', 'category': rng.choice(CATEGORIES),
+               'description': f'A {words[2]} shot in {rng.choice(PLACES)}', 'location': rng.choice(PLACES),
+               'tags': gen_tags(args, rng, vocabulary, tag_weights), 'filename': f'bench_{i}.jpeg',
+               'upload_date': stats['photo_dates'][-1], 'status': 'ready',
+               'views': int(rng.lognormvariate(4, 1.5)), 'likes': 0, 'user_id': ranking[author]}
+
+
+def gen_likes(args, rng, stats):
+    # Likes per photo are heavy tailed as well, the rare viral photo gets hundreds
+    for photo_id in range(1, args.photos + 1):
+        n = min(int(rng.paretovariate(1.3) * args.avg_likes * 0.25), args.users)
+        for user_id in rng.sample(range(1, args.users + 1), n):
+            yield {'user_id': user_id, 'photo_id': photo_id, 'created_at': stats['photo_dates'][photo_id - 1]}
+
+
+def gen_comments(args, rng, stats):
+    comment_id = itertools.count(1)
+    for photo_id in range(1, args.photos + 1):
+        posted = stats['photo_dates'][photo_id - 1]
+        for _ in range(int(rng.expovariate(1 / args.avg_comments)) if args.avg_comments else 0):
+            yield {'id': next(comment_id), 'content': rng.choice(LINES), 'photo_id': photo_id,
+                   'user_id': rng.randint(1, args.users),
+                   'timestamp': posted + timedelta(minutes=rng.randrange(1, 60 * 24 * 7))}
+
+
+def gen_messages(args, rng, end):
+    # Conversations between random pairs, lengths heavy tailed, read except the last few
+    rows = []
+    for _ in range(args.conversations):
+        a, b = rng.sample(range(1, args.users + 1), 2) if args.users > 1 else (1, 1)
+        length = min(int(rng.paretovariate(1.2) * 3), 2000)
+        at = end - timedelta(seconds=rng.randrange(args.days * 86400))
+        unread_tail = rng.choice([0, 0, 0, 1, 2, 5])
+        for n in range(length):
+            sender, recipient = (a, b) if rng.random() < 0.5 else (b, a)
+            at += timedelta(seconds=rng.randrange(5, 3600))
+            rows.append({'sender_id': sender, 'recipient_id': recipient, 'content': rng.choice(LINES),
+                         'timestamp': at, 'read': n < length - unread_tail, 'delivered_at': at})
+    rows.sort(key=lambda row: row['timestamp'])
+    for i, row in enumerate(rows, start=1):
+        row['id'] = i
+        yield row
+
+
+def seed(app, args):
+    rng = random.Random(args.seed)
+    end = datetime(2025, 1, 1)
+    start = end - timedelta(days=args.days)
+    password_hash = generate_password_hash(PASSWORD)
+    stats = {'photo_dates': []}
+
+    # Shuffled so popularity isn't simply "low ids are famous"
+    ranking = list(range(1, args.users + 1))
+    rng.shuffle(ranking)
+    popularity = zipf_weights(args.users, args.zipf)
+
+    steps = [
+        ('users', User, lambda: gen_users(args, rng, password_hash, start)),
+        ('follows', connections, lambda: gen_follows(args, rng, ranking, popularity)),
+        ('photos', Photo, lambda: gen_photos(args, rng, ranking, popularity, start, stats)),
+        ('likes', photo_likes, lambda: gen_likes(args, rng, stats)),
+        ('comments', Comment, lambda: gen_comments(args, rng, stats)),
+        ('messages', Message, lambda: gen_messages(args, rng, end)),
+    ]
+    for name, table, rows in steps:
+        started = time.perf_counter()
+        bulk(table, rows())
+        db.session.commit()
+        print(f"  {name:<10} {time.perf_counter() - started:7.1f}s")
+
+    # Denormalized like counts, same thing interactions.py keeps up to date
+    db.session.execute(
+        Photo.__table__.update().values(likes=db.select(db.func.count())
+                                        .where(photo_likes.c.photo_id == Photo.id)
+                                        .scalar_subquery()))
+    db.session.commit()
+
+    derived = [
+        ('tag index', rebuild_tag_index),
+        ('feeds', timelines.rebuild_all_feeds),
+        ('inboxes', messaging.rebuild_conversations),
+        ('search', lambda: Search(app).setup()),
+    ]
+    for name, rebuild in derived:
+        started = time.perf_counter()
+        rebuild()
+        print(f"  {name:<10} {time.perf_counter() - started:7.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--photos', type=int)
+    parser.add_argument('--conversations', type=int)
+    parser.add_argument('--avg-follows', type=float, default=30)
+    parser.add_argument('--avg-likes', type=float, default=8)
+    parser.add_argument('--avg-comments', type=float, default=2)
+    parser.add_argument('--tag-vocab', type=int, default=500)
+    parser.add_argument('--zipf', type=float, default=1.0, help='popularity skew, higher = more lopsided')
+    parser.add_argument('--days', type=int, default=365, help='history spread over this many days')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'loadtest.db'))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    users, photos, conversations = SCALES[args.scale]
+    args.users = args.users or users
+    args.photos = args.photos or photos
+    args.conversations = args.conversations if args.conversations is not None else conversations
+
+    for path in (args.db, args.db + '-wal', args.db + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    app = make_app(args.db)
+    started = time.perf_counter()
+    with app.app_context():
+        migrations.upgrade()
+        print(f"Seeding {args.users} users / {args.photos} photos / {args.conversations} conversations "
+              f"into {args.db}")
+        seed(app, args)
+        counts = {name: db.session.execute(db.select(db.func.count()).select_from(table)).scalar()
+                  for name, table in [('users', User.__table__), ('follows', connections),
+                                      ('photos', Photo.__table__), ('likes', photo_likes),
+                                      ('comments', Comment.__table__), ('messages', Message.__table__)]}
+
+    manifest = {'scale': args.scale, 'seed': args.seed, 'password': PASSWORD,
+                'params': {key: value for key, value in vars(args).items() if key not in ('db', 'scale', 'seed')},
+                'counts': counts, 'seconds': round(time.perf_counter() - started, 1)}
+    with open(args.db + '.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Done in {manifest['seconds']}s: " + ', '.join(f'{n} {name}' for name, n in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Cross-process Socket.IO fan-out: how many messages/sec reach clients spread over N workers.
+
+    python bench/socket_fanout.py --workers 4 --clients 200 --messages 20000
+    python bench/socket_fanout.py --workers 4 --queue none     # the old in-memory rooms
+
+Each worker process runs its own socketio.Server with `--clients` fake connections
+(one user_{id} room each, packets are counted instead of written to a websocket).
+A separate publisher process emits DMs round-robin to every user, like chat() does.
+With --queue local every emit goes through realtime.LocalBroker, with --queue none
+only the publisher's own (empty) process sees them, which is what multiple workers
+used to get. Pass --queue redis://... to measure a real Redis instead.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socketio
+import realtime
+
+
+def make_server(queue_url):
+    options = realtime.queue_options(queue_url)
+    manager = options.get('client_manager')
+    if 'message_queue' in options:
+        # Same picking rules as Flask-SocketIO
+        url = options['message_queue']
+        manager_class = (socketio.RedisManager if url.startswith(('redis://', 'rediss://'))
+                         else socketio.KafkaManager if url.startswith('kafka://')
+                         else socketio.KombuManager)
+        manager = manager_class(url, channel=options['channel'])
+    kwargs = {'client_manager': manager} if manager is not None else {}
+    return socketio.Server(async_mode='threading', **kwargs)
+
+
+def worker(index, queue_url, users, expected, timeout, ready, results):
+    server = make_server(queue_url)
+    delivered = 0
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def count(eio_sid, pkt):
+        nonlocal delivered
+        with lock:
+            delivered += 1
+            if delivered == expected:
+                done.set()
+
+    server._send_eio_packet = count
+    server.manager_initialized = True
+    server.manager.initialize()
+
+    for user_id in users:
+        sid = server.manager.connect(f'eio-{user_id}', '/')
+        server.manager.enter_room(sid, '/', f'user_{user_id}')
+
+    # Give the subscriber a moment to register with the broker
+    time.sleep(0.5)
+    ready.put(index)
+    done.wait(timeout=timeout)
+    results.put((index, delivered, time.perf_counter()))
+
+
+def publisher(queue_url, user_count, messages, start):
+    server = make_server(queue_url)
+    payload = {'content': 'hello there', 'timestamp': '10:00 AM', 'sender_id': 0}
+    start.put(time.perf_counter())
+    for i in range(messages):
+        server.emit('receive_message', payload, room=f'user_{i % user_count + 1}')
+
+
+def run(args):
+    broker = None
+    queue_url = None
+    if args.queue == 'local':
+        broker = realtime.LocalBroker('127.0.0.1', args.port)
+        broker.start()
+        queue_url = f'local://127.0.0.1:{args.port}'
+    elif args.queue != 'none':
+        queue_url = args.queue
+
+    user_ids = list(range(1, args.clients + 1))
+    shards = [user_ids[i::args.workers] for i in range(args.workers)]
+    per_user = args.messages // args.clients
+
+    ready, results, start = mp.Queue(), mp.Queue(), mp.Queue()
+    procs = [mp.Process(target=worker, args=(i, queue_url, shard, per_user * len(shard), args.timeout, ready, results))
+             for i, shard in enumerate(shards)]
+    for proc in procs:
+        proc.start()
+    for _ in procs:
+        ready.get()
+
+    sender = mp.Process(target=publisher, args=(queue_url, args.clients, per_user * args.clients, start))
+    sender.start()
+    started = start.get()
+    sender.join()
+
+    delivered, finished = 0, started
+    for _ in procs:
+        _, count, at = results.get()
+        delivered += count
+        finished = max(finished, at)
+    for proc in procs:
+        proc.join()
+
+    # With lost messages the workers sit out the whole --timeout, so this includes it
+    elapsed = finished - started
+    sent = per_user * args.clients
+    print(f"queue={args.queue} workers={args.workers} clients={args.clients}")
+    print(f"  sent      {sent}")
+    print(f"  delivered {delivered} ({delivered / sent:.0%})")
+    print(f"  elapsed   {elapsed:.2f}s, {delivered / elapsed:,.0f} msgs/sec delivered")
+    if broker is not None:
+        broker.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--queue', default='local', help="'local', 'none' or a message queue URL")
+    parser.add_argument('--port', type=int, default=5598)
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='seconds a worker waits for its messages before giving up')
+    run(parser.parse_args())
@@ -0,0 +1,187 @@
+"""
+Peak memory per upload: request ingestion and Pillow processing, each measured in a
+fresh child process so one run can't inflate the next.
+
+    python bench/upload_memory.py                        # 24 MP JPEG and PNG
+    python bench/upload_memory.py --megapixels 48 --max-mb 250
+
+ingest   POST /upload through the real app (run.py) with the multipart body streamed
+         from a file on disk, image workers in their own processes, so this is only
+         parsing + probe + claim. Should stay flat no matter how big the file is.
+process  imaging.process_image / process_avatar on the same file. JPEGs are decoded
+         with draft() at reduced size, so compare against the full bitmap column.
+
+Exit code 1 if any peak (above the child's baseline after imports) is over --max-mb.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def reset_peak():
+    # Linux: writing 5 to clear_refs resets VmHWM (the peak) to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rss_mb(field):
+    """Current ('VmRSS') or peak ('VmHWM') resident memory, ru_maxrss where /proc isn't there."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_image(path, fmt, megapixels):
+    from PIL import Image
+    width = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    height = int(width * 2 / 3)
+    if fmt == 'jpeg':
+        # Noise, so the file is as big as a real camera JPEG of that size
+        img = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+        img.save(path, 'JPEG', quality=90)
+    else:
+        img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        img.save(path, 'PNG')
+    return width, height
+
+
+# --- CHILD PROCESSES ---
+
+def child_process(src, kind):
+    import shutil
+    import imaging
+    scratch = tempfile.mkdtemp(prefix='lens-upload-mem-')
+    # process_image deletes its input, work on a copy
+    copy = os.path.join(scratch, 'in' + os.path.splitext(src)[1])
+    shutil.copy(src, copy)
+    reset_peak()
+    baseline = rss_mb('VmRSS')
+    work = imaging.process_image if kind == 'photo' else imaging.process_avatar
+    work(copy, os.path.join(scratch, 'out.jpeg'))
+    shutil.rmtree(scratch)
+    return baseline, rss_mb('VmHWM')
+
+
+def child_ingest(src, db_path):
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['LENS_ENV'] = 'development'
+    os.chdir(ROOT)
+    from werkzeug.test import EnvironBuilder
+    import run
+    from models import db, User
+    app = run.app
+    scratch = tempfile.mkdtemp(prefix='lens-upload-mem-')
+    app.config['UPLOAD_FOLDER'] = os.path.join(scratch, 'uploads')
+    app.config['INCOMING_FOLDER'] = os.path.join(scratch, 'incoming')
+    os.makedirs(app.config['UPLOAD_FOLDER'])
+    os.makedirs(app.config['INCOMING_FOLDER'])
+    run.media.configure(app.config)
+    app.config['MAX_CONTENT_LENGTH'] = None
+    with app.app_context():
+        user = User(full_name='Bench', email='bench@bench.local')
+        user.set_password('benchpass')
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'action': 'login', 'email': 'bench@bench.local', 'password': 'benchpass'})
+    session_cookie = client.get_cookie('session').value
+
+    # multipart body on disk: form fields, then the file copied in chunks
+    boundary = uuid.uuid4().hex
+    body_path = os.path.join(scratch, 'body')
+    with open(body_path, 'wb') as body, open(src, 'rb') as image:
+        for name, value in (('title', 'Memory bench'), ('category', 'nature'), ('tags', 'bench')):
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="photo"; '
+                   f'filename="big{os.path.splitext(src)[1]}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        while chunk := image.read(1024 * 1024):
+            body.write(chunk)
+        body.write(f'\r\n--{boundary}--\r\n'.encode())
+
+    reset_peak()
+    baseline = rss_mb('VmRSS')
+    with open(body_path, 'rb') as body:
+        environ = EnvironBuilder(path='/upload', method='POST', input_stream=body,
+                                 content_length=os.path.getsize(body_path),
+                                 content_type=f'multipart/form-data; boundary={boundary}',
+                                 headers={'Cookie': f'session={session_cookie}'}).get_environ()
+        status = []
+        response = app(environ, lambda code, headers, exc_info=None: status.append(code))
+        b''.join(response)
+        getattr(response, 'close', lambda: None)()
+    if not status[0].startswith('302'):
+        raise SystemExit(f"upload failed: {status[0]}")
+    peak = rss_mb('VmHWM')
+    run.pipeline.shutdown()
+    return baseline, peak
+
+
+def measure(mode, src, extra=()):
+    out = subprocess.run([sys.executable, __file__, '--child', mode, src, *extra],
+                         capture_output=True, text=True, cwd=ROOT)
+    if out.returncode != 0:
+        raise SystemExit(f"{mode} child failed:\n{out.stderr}")
+    baseline, peak = json.loads(out.stdout.strip().splitlines()[-1])
+    return peak - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--formats', default='jpeg,png')
+    parser.add_argument('--max-mb', type=float, default=None, help='fail if any peak is above this')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, src, *rest = args.child
+        if mode == 'ingest':
+            result = child_ingest(src, rest[0])
+        else:
+            result = child_process(src, mode)
+        print(json.dumps(result))
+        return
+
+    scratch = tempfile.mkdtemp(prefix='lens-upload-mem-')
+    rows, worst = [], 0.0
+    for fmt in [f.strip() for f in args.formats.split(',') if f.strip()]:
+        src = os.path.join(scratch, f'sample.{fmt}')
+        width, height = make_image(src, fmt, args.megapixels)
+        size_mb = os.path.getsize(src) / (1024 * 1024)
+        bitmap_mb = width * height * 3 / (1024 * 1024)
+        ingest = measure('ingest', src, [os.path.join(scratch, f'{fmt}.db')])
+        photo = measure('photo', src)
+        avatar = measure('avatar', src)
+        worst = max(worst, ingest, photo, avatar)
+        rows.append((f'{fmt} {width}x{height}', size_mb, bitmap_mb, ingest, photo, avatar))
+
+    print(f"\n{'image':<22}{'file MB':>9}{'bitmap MB':>11}{'ingest MB':>11}{'photo MB':>10}{'avatar MB':>11}")
+    for name, size_mb, bitmap_mb, ingest, photo, avatar in rows:
+        print(f"{name:<22}{size_mb:>9.1f}{bitmap_mb:>11.1f}{ingest:>11.1f}{photo:>10.1f}{avatar:>11.1f}")
+    print('\nPeak RSS growth over the process baseline, per upload.')
+
+    if args.max_mb is not None and worst > args.max_mb:
+        print(f"\nOver budget: {worst:.1f} MB > {args.max_mb:.1f} MB")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from flask import g, request, session, make_response
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import select, update, insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Photo, ContentVersion
+
+# --- HTTP CACHING ---
+# Explore, portfolios and photo pages were re-queried and re-rendered on every hit,
+# even when nothing had changed since the browser's last copy. Three layers now:
+#   1. content versions: every write that changes a public page bumps a counter in
+#      content_versions ('photos', 'user:3', 'photo:42') in the same transaction
+#   2. conditional GET: a page's ETag (and Last-Modified for anonymous visitors) is a
+#      hash of the versions it's built from plus who's looking, a match is a bare 304
+#   3. fragment cache: masonry grids and trending tags are rendered once per version
+#      into a size-bounded LRU, so a bumped version is a miss and old entries age out
+# Versions live in the DB, so a write on one worker invalidates every worker.
+# Uploads have unique file names and never change, browsers may keep them for a year.
+#
+# Known lag: view counts come from the counter buffer, a page can show a count up to
+# COUNTER_FLUSH_INTERVAL seconds older than what a fresh render would.
+
+content_versions = ContentVersion.__table__
+photos = Photo.__table__
+
+PHOTOS = 'photos'   # anything on explore: new/deleted photos, likes, comments, tags
+
+
+def touch(*names):
+    """Bump content versions, call inside the write's transaction (before commit)."""
+    names = sorted(set(names))
+    if not names:
+        return
+    now = datetime.utcnow()
+    found = db.session.execute(
+        update(content_versions).where(content_versions.c.name.in_(names))
+        .values(version=content_versions.c.version + 1, updated_at=now)).rowcount
+    if found == len(names):
+        return
+    # First write for some of them, create the missing rows
+    existing = set(db.session.execute(
+        select(content_versions.c.name).where(content_versions.c.name.in_(names))).scalars())
+    missing = [{'name': name, 'version': 1, 'updated_at': now} for name in names if name not in existing]
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(content_versions), missing)
+    except IntegrityError:
+        # Another request created them first, its bump is just as good
+        pass
+
+
+def touch_all():
+    """Bump every version, e.g. after all upload URLs changed."""
+    db.session.execute(update(content_versions).values(
+        version=content_versions.c.version + 1, updated_at=datetime.utcnow()))
+    touch(PHOTOS)
+
+
+def touch_photo(photo):
+    touch(PHOTOS, f'user:{photo.user_id}', f'photo:{photo.id}')
+
+
+def touch_photo_ids(photo_ids, *names):
+    """Bump the pages of these photos and of their owners (e.g. after a counter flush)."""
+    if not photo_ids:
+        return
+    owners = db.session.execute(
+        select(photos.c.id, photos.c.user_id).where(photos.c.id.in_(photo_ids))).all()
+    touch(*names, *[f'photo:{photo_id}' for photo_id, _ in owners],
+          *{f'user:{user_id}' for _, user_id in owners})
+
+
+def versions(names):
+    """{name: (version, updated_at)} in one SELECT, (0, None) for never-written names."""
+    rows = db.session.execute(
+        select(content_versions.c.name, content_versions.c.version, content_versions.c.updated_at)
+        .where(content_versions.c.name.in_(names))).all()
+    found = {row.name: (row.version, row.updated_at) for row in rows}
+    return {name: found.get(name, (0, None)) for name in names}
+
+
+def _template_salt(app):
+    # A deploy that changes a template must not revalidate old copies
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder or 'templates')
+    for root, _, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            digest.update(f"{name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.hexdigest()[:12]
+
+
+class FragmentCache:
+    """Rendered HTML by key, least recently used dropped once over `max_bytes`."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key, html):
+        if len(html) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = html
+            self.size += len(html)
+            while self.size > self.max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class HttpCache:
+
+    def __init__(self, app=None, viewer=None):
+        if app is not None:
+            self.init_app(app, viewer)
+
+    def init_app(self, app, viewer=None):
+        self.enabled = app.config.get('HTTP_CACHE', True)
+        self.upload_max_age = app.config.get('UPLOAD_CACHE_MAX_AGE', 365 * 24 * 3600)
+        self.fragments = FragmentCache(app.config.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+        self.salt = app.config.get('CACHE_SALT') or _template_salt(app)
+        # Anything else on every page that depends on who's looking (e.g. the unread badge)
+        self.viewer = viewer
+        app.after_request(self._add_headers)
+        app.add_template_global(self.cached_fragment)
+
+    # --- CONDITIONAL GET ---
+
+    def validate(self, *names):
+        """
+        Call before doing the expensive part of a page built from `names`.
+        Returns a 304 response if the browser's copy is still good, else None and
+        the 200 gets ETag / Last-Modified headers on the way out.
+        """
+        viewer = [f'user:{current_user.id}'] if current_user.is_authenticated else []
+        found = versions(list(names) + viewer)
+        # Fragments are shared between everyone, only the page's own versions go in their keys
+        g.content_versions = {name: found[name] for name in names}
+        # Flash messages are one-off, that page must never be reused
+        if not self.enabled or request.method != 'GET' or session.get('_flashes'):
+            return None
+
+        parts = [self.salt, request.full_path]
+        parts += [f"{name}={version}" for name, (version, _) in sorted(found.items())]
+        if current_user.is_authenticated:
+            parts += ['viewer', str(current_user.id)] + [str(part) for part in (self.viewer() if self.viewer else ())]
+            last_modified = None
+        else:
+            stamps = [stamp for _, stamp in found.values() if stamp is not None]
+            last_modified = max(stamps).replace(microsecond=0) if stamps else None
+        etag = hashlib.sha1('|'.join(parts).encode()).hexdigest()[:20]
+        g.cache_validators = (etag, last_modified)
+
+        if request.if_none_match:
+            fresh = request.if_none_match.contains_weak(etag)
+        else:
+            since = request.if_modified_since
+            fresh = (last_modified is not None and since is not None
+                     and last_modified <= since.replace(tzinfo=None))
+        if not fresh:
+            return None
+        return make_response('', 304)
+
+    def _add_headers(self, response):
+        if request.endpoint == 'static':
+            if (request.view_args or {}).get('filename', '').startswith('uploads/') and response.status_code in (200, 206, 304):
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = self.upload_max_age
+                response.cache_control.immutable = True
+            return response
+
+        validators = g.get('cache_validators')
+        if validators is None or response.status_code not in (200, 304):
+            return response
+        etag, last_modified = validators
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # Always revalidate, a copy is only reused after a 304
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.vary.add('Cookie')
+        return response
+
+    # --- FRAGMENTS ---
+
+    def cached_fragment(self, name, *key, caller):
+        """
+        {% call cached_fragment('explore-grid', tag, cursor) %} ... {% endcall %}
+        The block is rendered once per key and per version of whatever the page
+        passed to validate(), later renders reuse the HTML.
+        """
+        page_versions = g.get('content_versions')
+        if page_versions is None:
+            return caller()
+        cache_key = (self.salt, name, key, tuple(sorted((n, v) for n, (v, _) in page_versions.items())))
+        html = self.fragments.get(cache_key)
+        if html is None:
+            html = str(caller())
+            self.fragments.set(cache_key, html)
+        return Markup(html)
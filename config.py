@@ -0,0 +1,215 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+
+# --- CONFIGURATION PROFILES ---
+# Pick one with LENS_ENV=development|testing|production (development if unset).
+# Anything secret or machine specific comes from the environment, never from here.
+
+
+class Config:
+    # Bro please don't leak this key... phat jayegi
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your_super_secret_key_here')  # Change this in production
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///lens_portfolio.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # SQLite: WAL lets readers keep going while a write is in progress, NORMAL only
+    # fsyncs at checkpoints (still safe in WAL mode), and writers wait for the lock
+    # instead of failing straight away with "database is locked"
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,          # ms
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -32000,          # negative = KiB, so ~32 MB
+        'temp_store': 'MEMORY',
+    }
+
+    # Server databases (Postgres, MySQL): per worker process pool
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 20
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800             # seconds, stay under server/proxy idle timeouts
+
+    # File Upload Configuration
+    UPLOAD_FOLDER = os.path.join('static', 'uploads')
+    # Raw uploads wait here (outside static/) until the image workers pick them up.
+    # None = <instance folder>/incoming
+    INCOMING_FOLDER = None
+
+    # Processed images are content addressed (ab/cd/<sha256>.<ext>, see storage.py).
+    # 'local' keeps them under STORAGE_ROOT (None = UPLOAD_FOLDER), 'bucket' is a local
+    # stand-in for object storage, with STORAGE_PUBLIC_URL browsers fetch from it directly
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_ROOT = os.environ.get('STORAGE_ROOT')
+    STORAGE_PUBLIC_URL = os.environ.get('STORAGE_PUBLIC_URL')
+    # Let the front server send /media files: 'x-accel' (nginx, internal location at
+    # STORAGE_ACCEL_PREFIX aliased to STORAGE_ROOT), 'x-sendfile' (Apache/lighttpd) or None
+    STORAGE_OFFLOAD = os.environ.get('STORAGE_OFFLOAD')
+    STORAGE_ACCEL_PREFIX = '/_media/'
+    # Unreferenced files are kept this long before `flask gc-storage` deletes them
+    STORAGE_GC_GRACE = 3600
+
+    # Request bodies above this are refused with 413 before they're stored
+    MAX_CONTENT_LENGTH = 100 * 1024 * 1024
+    # Images with more pixels than this are rejected from their header, before decoding
+    MAX_IMAGE_PIXELS = 100_000_000
+
+    # Image processing workers: 'process', 'thread' or 'inline'
+    IMAGE_WORKER_MODE = 'process'
+    IMAGE_WORKERS = 2
+    IMAGE_QUEUE_LIMIT = 32
+    # Derivatives written for every upload (widths live in imaging.py)
+    RENDITION_FORMATS = ('jpeg', 'webp', 'avif')
+
+    # Views are buffered in memory and written in one batch every N seconds
+    COUNTER_FLUSH_INTERVAL = 5
+
+    # View/like analytics (see analytics.py): events are written in batches every
+    # ANALYTICS_FLUSH_INTERVAL seconds and rolled up into hourly/daily buckets every
+    # ANALYTICS_ROLLUP_INTERVAL seconds (0 = only via `flask rollup-analytics`)
+    ANALYTICS_FLUSH_INTERVAL = 5
+    ANALYTICS_ROLLUP_INTERVAL = 60
+    # Rollup only folds events written at least this many seconds ago. Ids are handed out
+    # at INSERT but show up at COMMIT, so a younger batch can still be missing a lower id
+    ANALYTICS_ROLLUP_SETTLE = 30
+    # Raw events are kept this many days after being rolled up
+    ANALYTICS_RAW_RETENTION_DAYS = 7
+
+    # Unread badge counts are cached per user and re-checked against the DB this often
+    UNREAD_RECONCILE_SECONDS = 60
+
+    # Followed/follower id sets cached per worker (see graph.py): at most this many ids
+    # in total, re-read after GRAPH_CACHE_TTL seconds to see other workers' follows
+    GRAPH_CACHE_MAX_IDS = 1000000
+    GRAPH_CACHE_TTL = 60
+    # Suggested photographers shown on the feed (stored by `flask rebuild-suggestions`)
+    SUGGESTIONS_SHOWN = 5
+
+    # Related photos (see related.py): neighbours stored / shown per photo, how many
+    # nearby clusters a photo is compared with, and a cap on rows scored per upload
+    RELATED_PER_PHOTO = 12
+    RELATED_SHOWN = 6
+    RELATED_PROBES = 8
+    RELATED_MAX_CANDIDATES = 50000
+
+    # Shared Socket.IO queue so emits reach clients on every worker (see realtime.py).
+    # Leave empty for a single process, e.g. redis://localhost:6379/0 or local://127.0.0.1:5599
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    # Each worker refreshes its live connections this often (seconds)
+    PRESENCE_HEARTBEAT = 30
+    # DMs are group committed, at most this many per transaction (see messaging.Outbox)
+    MESSAGE_BATCH_SIZE = 100
+
+    # Full-text search: 'fts5' (SQLite) or 'like', picked from the database URL when unset
+    SEARCH_BACKEND = None
+
+    # Instrumentation (see instrumentation.py): query/template timings as response headers,
+    # a Prometheus /metrics endpoint (Bearer METRICS_TOKEN if set) and a slow request log
+    INSTRUMENT_HEADERS = False
+    METRICS_ENDPOINT = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SLOW_REQUEST_MS = 500              # None turns the slow log off
+
+    # HTTP caching (see caching.py): ETag/304 for explore, portfolios and photo pages,
+    # rendered grids kept in a per-worker LRU, uploads cached by browsers for a year
+    HTTP_CACHE = True
+    FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+    # Changes every ETag, unset = derived from the templates (so a deploy busts old copies)
+    CACHE_SALT = os.environ.get('CACHE_SALT')
+
+    # Pagination
+    EXPLORE_PAGE_SIZE = 24
+    FEED_PAGE_SIZE = 20
+    INBOX_PAGE_SIZE = 30
+    CHAT_PAGE_SIZE = 50
+    SEARCH_PAGE_SIZE = 12
+    DASHBOARD_PAGE_SIZE = 24
+    DASHBOARD_SAVED_LIMIT = 12
+    PORTFOLIO_PAGE_SIZE = 24
+    COMMENTS_PAGE_SIZE = 20
+    # Dashboard chart JSON is cached per user this long (seconds)
+    DASHBOARD_CHART_TTL = 60
+
+
+class DevelopmentConfig(Config):
+    # X-DB-Queries / Server-Timing on every response, makes N+1s easy to spot
+    INSTRUMENT_HEADERS = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    # No worker processes or background flush delays in tests
+    IMAGE_WORKER_MODE = 'inline'
+    COUNTER_FLUSH_INTERVAL = 0.1
+    ANALYTICS_FLUSH_INTERVAL = 0.1
+    ANALYTICS_ROLLUP_INTERVAL = 0
+    ANALYTICS_ROLLUP_SETTLE = 0
+
+
+class ProductionConfig(Config):
+    # Postgres by default, e.g. DATABASE_URL=postgresql://lens:secret@db/lens (needs psycopg2)
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://lens@localhost/lens')
+    IMAGE_WORKERS = os.cpu_count() or 2
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database."""
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            # One shared in-memory DB, otherwise every pooled connection gets its own empty one
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        return {'connect_args': {'timeout': config['SQLITE_PRAGMAS'].get('busy_timeout', 5000) / 1000}}
+
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        # Checks a pooled connection is still alive before handing it out
+        'pool_pre_ping': True,
+    }
+
+
+def load_config(app, profile=None):
+    profile = profile or os.environ.get('LENS_ENV', 'development')
+    if profile not in PROFILES:
+        raise RuntimeError(f"Unknown LENS_ENV '{profile}', use one of: {', '.join(PROFILES)}")
+    app.config.from_object(PROFILES[profile])
+
+    if profile == 'production' and 'SECRET_KEY' not in os.environ:
+        raise RuntimeError('Set SECRET_KEY in the environment for production')
+    if app.config['INCOMING_FOLDER'] is None:
+        app.config['INCOMING_FOLDER'] = os.path.join(app.instance_path, 'incoming')
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    return profile
+
+
+def configure_engine(app, db):
+    """Apply the SQLite pragmas to every new connection. Call after db.init_app(app)."""
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = app.config['SQLITE_PRAGMAS']
+    in_memory = engine.url.database in (None, '', ':memory:')
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if in_memory and name in ('journal_mode', 'mmap_size'):
+                continue  # meaningless for :memory:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
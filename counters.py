@@ -0,0 +1,103 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import bindparam, update
+from models import db, Photo
+import stats as user_stats
+import caching
+
+# --- BUFFERED PHOTO VIEW COUNTERS ---
+# `photo.views += 1; commit` is a read-modify-write done in Python: two requests
+# read 10, both write 11 and a view is lost. It also costs a whole write transaction
+# per page view, and SQLite only lets one writer in at a time.
+# Here increments just bump a dict in memory, and every few seconds one batched
+#   UPDATE photos SET views = views + :n WHERE id = :id
+# applies them all. The DB does the addition, so nothing is lost between processes either.
+
+# Likes are exact per-user rows now (interactions.py), only views get buffered
+COUNTER_FIELDS = ('views',)
+
+
+class CounterBuffer:
+
+    def __init__(self, app=None, socketio=None):
+        self.app = None
+        self._pending = defaultdict(int)   # (field, photo_id) -> delta
+        self._lock = threading.Lock()
+        self._flusher_started = False
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio=None):
+        self.app = app
+        self.socketio = socketio
+        self.interval = app.config.get('COUNTER_FLUSH_INTERVAL', 5)
+        # Whatever is still buffered when the process exits gets written out
+        atexit.register(self.flush)
+
+    def incr(self, photo_id, field='views', n=1):
+        if field not in COUNTER_FIELDS:
+            raise ValueError(f"Unknown counter: {field}")
+        with self._lock:
+            self._pending[(field, photo_id)] += n
+        self._ensure_flusher()
+
+    def pending(self, photo_id, field='views'):
+        # Not flushed yet, add this to the DB value for a close-to-live number
+        with self._lock:
+            return self._pending.get((field, photo_id), 0)
+
+    def live(self, photo, field='views'):
+        return (getattr(photo, field) or 0) + self.pending(photo.id, field)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, defaultdict(int)
+        if not batch:
+            return 0
+
+        photos = Photo.__table__
+        try:
+            with self.app.app_context():
+                for field in COUNTER_FIELDS:
+                    params = [{'photo_id': photo_id, 'delta': delta}
+                              for (name, photo_id), delta in batch.items() if name == field and delta]
+                    if not params:
+                        continue
+                    stmt = (update(photos)
+                            .where(photos.c.id == bindparam('photo_id'))
+                            .values({field: photos.c[field] + bindparam('delta')}))
+                    db.session.execute(stmt, params)
+                    # Owners' dashboard totals move in the same transaction
+                    user_stats.bump_photo_owners(field, params)
+                # New counts on the photo pages and the owners' portfolios
+                caching.touch_photo_ids(sorted({photo_id for (_, photo_id) in batch}))
+                db.session.commit()
+        except Exception as e:
+            # Put the increments back so the next flush retries them
+            print(f"Counter flush failed, will retry: {e}")
+            with self._lock:
+                for key, delta in batch.items():
+                    self._pending[key] += delta
+            return 0
+
+        return sum(batch.values())
+
+    def _ensure_flusher(self):
+        if self._flusher_started:
+            return
+        with self._lock:
+            if self._flusher_started:
+                return
+            self._flusher_started = True
+        if self.socketio is not None:
+            self.socketio.start_background_task(self._run)
+        else:
+            threading.Thread(target=self._run, daemon=True, name='counter-flusher').start()
+
+    def _run(self):
+        sleep = self.socketio.sleep if self.socketio is not None else time.sleep
+        while True:
+            sleep(self.interval)
+            self.flush()
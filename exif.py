@@ -0,0 +1,250 @@
+import math
+from datetime import datetime
+from PIL import ExifTags, Image, UnidentifiedImageError
+from sqlalchemy import and_, case, extract, func, insert, select
+import caching
+from models import db, Photo, PhotoExif, Tag, photo_tags
+
+# --- EXIF METADATA ---
+# The image pipeline re-encodes every upload (and strips its EXIF, GPS included, from the
+# files we serve), so camera data is read once from the original's header while probe()
+# has it open anyway and kept in photo_exif. Explore filters on camera / lens / focal
+# length / aperture / ISO / year taken page over photo_exif's own indexes, and the facet
+# counts next to them are GROUP BYs on the same table, no image is ever re-opened.
+# Photos uploaded before this have a row from `flask backfill-exif`, which only reads
+# file headers (and finds nothing for files the pipeline already re-encoded).
+
+exif_rows = PhotoExif.__table__
+
+# Equality facets, top values by photo count
+VALUE_FACETS = ('camera', 'lens')
+# Range facets: URL value -> label, [low, high)
+RANGE_FACETS = {
+    'focal': ('focal_length', [
+        ('0-24', 'Under 24 mm', None, 24), ('24-35', '24-35 mm', 24, 35), ('35-70', '35-70 mm', 35, 70),
+        ('70-200', '70-200 mm', 70, 200), ('200-', '200 mm and up', 200, None)]),
+    'aperture': ('aperture', [
+        ('0-2.8', 'Faster than f/2.8', None, 2.8), ('2.8-5.6', 'f/2.8 - f/5.6', 2.8, 5.6),
+        ('5.6-11', 'f/5.6 - f/11', 5.6, 11), ('11-', 'f/11 and up', 11, None)]),
+    'iso': ('iso', [
+        ('0-400', 'ISO under 400', None, 400), ('400-1600', 'ISO 400 - 1600', 400, 1600),
+        ('1600-6400', 'ISO 1600 - 6400', 1600, 6400), ('6400-', 'ISO 6400 and up', 6400, None)]),
+}
+FACETS = VALUE_FACETS + tuple(RANGE_FACETS) + ('year',)
+
+
+# --- PARSING ---
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'ignore')
+    if not isinstance(value, str):
+        return None
+    return value.replace('\x00', '').strip()[:100] or None
+
+
+def _number(value):
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    try:
+        number = float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return number if math.isfinite(number) and number > 0 else None
+
+
+def _when(value):
+    text = _text(value)
+    try:
+        return datetime.strptime(text[:19], '%Y:%m:%d %H:%M:%S') if text else None
+    except ValueError:
+        return None
+
+
+def _coordinate(dms, ref, limit):
+    try:
+        degrees, minutes, seconds = (float(part) for part in dms)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    value = degrees + minutes / 60 + seconds / 3600
+    if _text(ref) in ('S', 'W'):
+        value = -value
+    return round(value, 6) if math.isfinite(value) and abs(value) <= limit else None
+
+
+def read_exif(img):
+    """Column values for photo_exif from an opened (not decoded) image, {} when there's no EXIF."""
+    if img.format == 'PNG' and 'exif' not in img.info:
+        # Pillow would decode the whole PNG looking for an eXIf chunk after the pixel data
+        return {}
+    try:
+        tags = img.getexif()
+        shot = tags.get_ifd(ExifTags.IFD.Exif)
+        gps = tags.get_ifd(ExifTags.IFD.GPSInfo)
+    except Exception as e:
+        # Broken EXIF is the camera's problem, not a reason to reject the upload
+        print(f"Unreadable EXIF: {e}")
+        return {}
+
+    make, model = _text(tags.get(ExifTags.Base.Make)), _text(tags.get(ExifTags.Base.Model))
+    camera = model
+    # "Canon" + "Canon EOS R5" -> "Canon EOS R5", "Apple" + "iPhone 13" -> "Apple iPhone 13"
+    if make and model and not model.lower().startswith(make.split()[0].lower()):
+        camera = f"{make} {model}"[:100]
+    iso = _number(shot.get(ExifTags.Base.ISOSpeedRatings))
+
+    data = {
+        'camera': camera or make,
+        'lens': _text(shot.get(ExifTags.Base.LensModel)),
+        'aperture': _number(shot.get(ExifTags.Base.FNumber)),
+        'shutter': _number(shot.get(ExifTags.Base.ExposureTime)),
+        'iso': int(iso) if iso else None,
+        'focal_length': _number(shot.get(ExifTags.Base.FocalLength)),
+        'taken_at': _when(shot.get(ExifTags.Base.DateTimeOriginal)) or _when(tags.get(ExifTags.Base.DateTime)),
+        'latitude': _coordinate(gps.get(ExifTags.GPS.GPSLatitude), gps.get(ExifTags.GPS.GPSLatitudeRef), 90),
+        'longitude': _coordinate(gps.get(ExifTags.GPS.GPSLongitude), gps.get(ExifTags.GPS.GPSLongitudeRef), 180),
+    }
+    return {name: value for name, value in data.items() if value is not None}
+
+
+def summary(exif):
+    """['Canon EOS R5', 'RF 24-70mm', '35 mm', 'f/2.8', '1/250 s', 'ISO 100'] for the photo page."""
+    if exif is None:
+        return []
+    parts = [exif.camera, exif.lens]
+    if exif.focal_length:
+        parts.append(f"{exif.focal_length:g} mm")
+    if exif.aperture:
+        parts.append(f"f/{exif.aperture:g}")
+    if exif.shutter:
+        parts.append(f"1/{round(1 / exif.shutter)} s" if exif.shutter < 1 else f"{exif.shutter:g} s")
+    if exif.iso:
+        parts.append(f"ISO {exif.iso}")
+    return [part for part in parts if part]
+
+
+# --- FILTERS ---
+
+def parse_filters(args):
+    """Valid facet filters from a query string, anything unknown is dropped."""
+    filters = {}
+    for name in VALUE_FACETS:
+        value = (args.get(name) or '').strip()[:100]
+        if value:
+            filters[name] = value
+    for name, (_, buckets) in RANGE_FACETS.items():
+        value = args.get(name)
+        if value in {slug for slug, _, _, _ in buckets}:
+            filters[name] = value
+    year = args.get('year') or ''
+    if year.isdigit() and 1900 <= int(year) <= 2100:
+        filters['year'] = int(year)
+    return filters
+
+
+def _conditions(filters, skip=None):
+    conditions = [exif_rows.c.upload_date.isnot(None)]
+    for name, value in filters.items():
+        if name == skip:
+            continue
+        if name in VALUE_FACETS:
+            conditions.append(exif_rows.c[name] == value)
+        elif name in RANGE_FACETS:
+            column, buckets = RANGE_FACETS[name]
+            _, _, low, high = next(bucket for bucket in buckets if bucket[0] == value)
+            if low is not None:
+                conditions.append(exif_rows.c[column] >= low)
+            if high is not None:
+                conditions.append(exif_rows.c[column] < high)
+        elif name == 'year':
+            conditions.append(exif_rows.c.taken_at >= datetime(value, 1, 1))
+            conditions.append(exif_rows.c.taken_at < datetime(value + 1, 1, 1))
+    return conditions
+
+
+def filter_photos(query, filters):
+    """Narrow a Photo query to the filters. Page it on (PhotoExif.upload_date, PhotoExif.photo_id)."""
+    return query.join(PhotoExif, PhotoExif.photo_id == Photo.id).filter(*_conditions(filters))
+
+
+def _tagged(tag):
+    # Same photos filter_by_tag() leaves in the grid, checked per photo_exif row
+    tag_id = select(Tag.id).where(Tag.name == tag.strip().lower()).scalar_subquery()
+    return select(photo_tags.c.photo_id).where(photo_tags.c.photo_id == exif_rows.c.photo_id,
+                                               photo_tags.c.tag_id == tag_id).exists()
+
+
+def facets(filters, limit=12, tag=None):
+    """
+    {facet: [(value, label, count)]}. Each facet is counted under every other active
+    filter (not its own), so picking a camera still shows the other cameras. With a
+    tag, only photos carrying it are counted, like the grid next to them.
+    """
+    result = {}
+    count = func.count().label('count')
+    scope = [_tagged(tag)] if tag else []
+    for name in VALUE_FACETS:
+        column = exif_rows.c[name]
+        rows = db.session.execute(
+            select(column, count).where(column.isnot(None), *_conditions(filters, skip=name), *scope)
+            .group_by(column).order_by(count.desc(), column).limit(limit))
+        result[name] = [(value, value, n) for value, n in rows]
+
+    for name, (column_name, buckets) in RANGE_FACETS.items():
+        column = exif_rows.c[column_name]
+        bucket = case(*[(and_(*([column >= low] if low is not None else []),
+                              *([column < high] if high is not None else [])), slug)
+                        for slug, _, low, high in buckets]).label('bucket')
+        found = dict(db.session.execute(
+            select(bucket, count).where(column.isnot(None), *_conditions(filters, skip=name), *scope)
+            .group_by(bucket)).all())
+        result[name] = [(slug, label, found[slug]) for slug, label, _, _ in buckets if found.get(slug)]
+
+    year = extract('year', exif_rows.c.taken_at).label('year')
+    rows = db.session.execute(
+        select(year, count).where(exif_rows.c.taken_at.isnot(None), *_conditions(filters, skip='year'), *scope)
+        .group_by(year).order_by(year.desc()).limit(limit))
+    result['year'] = [(int(value), str(int(value)), n) for value, n in rows]
+    return result
+
+
+# --- BACKFILL ---
+
+def backfill(open_file, batch_size=500):
+    """
+    photo_exif rows for photos that don't have one, read from the stored file's header
+    (Image.open doesn't decode pixels). open_file(name) -> binary file, e.g. Storage.open. Photos without EXIF get an empty row so they
+    aren't checked again. Returns (photos checked, photos with EXIF found).
+    """
+    checked = found = 0
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Photo.id, Photo.filename, Photo.status, Photo.upload_date)
+            .outerjoin(PhotoExif, PhotoExif.photo_id == Photo.id)
+            .where(Photo.id > last_id, PhotoExif.photo_id.is_(None))
+            .order_by(Photo.id).limit(batch_size)).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        rows = []
+        for photo in batch:
+            data = {}
+            try:
+                with open_file(photo.filename) as f, Image.open(f) as img:
+                    data = read_exif(img)
+            except (OSError, UnidentifiedImageError) as e:
+                print(f"Skipping EXIF for photo {photo.id}: {e}")
+            found += bool(data)
+            rows.append({'photo_id': photo.id,
+                         'upload_date': photo.upload_date if photo.status == 'ready' else None,
+                         **{name: data.get(name) for name in
+                            ('camera', 'lens', 'aperture', 'shutter', 'iso', 'focal_length',
+                             'taken_at', 'latitude', 'longitude')}})
+        db.session.execute(insert(exif_rows), rows)
+        if found:
+            caching.touch(caching.PHOTOS)
+        db.session.commit()
+        checked += len(batch)
+    return checked, found
@@ -0,0 +1,111 @@
+from sqlalchemy import delete, exists, insert, literal, select
+from sqlalchemy.orm import joinedload, undefer
+from models import db, User, Photo, FeedEntry, connections
+from pagination import keyset_page
+
+# --- HOME FEED TIMELINES (fan-out on write) ---
+# Instead of building an IN (...) list of everyone you follow on every page view,
+# each upload is pushed into the timeline of every follower once. Reading the feed
+# is then a single indexed range scan on feed_entries for that user.
+# Only ready photos ever go in: photo_processed() fans out once the image workers are done.
+
+FEED_MAX_ENTRIES = 800    # Timelines get trimmed back to this many rows
+FEED_FOLLOW_BACKFILL = 50  # Recent photos copied in when you follow someone
+
+entries = FeedEntry.__table__
+
+
+def _readers_of(author_id):
+    # Everyone following the author, plus the author (your own photos show in your feed)
+    return (select(connections.c.follower_id).where(connections.c.followed_id == author_id)
+            .union(select(literal(author_id))))
+
+
+def _trim(user_ids):
+    # Drop everything older than the Nth newest entry of each of these timelines
+    newer = entries.alias('newer')
+    cutoff = (select(newer.c.upload_date)
+              .where(newer.c.user_id == entries.c.user_id)
+              .order_by(newer.c.upload_date.desc())
+              .limit(1).offset(FEED_MAX_ENTRIES - 1)
+              .scalar_subquery())
+    db.session.execute(delete(entries)
+                       .where(entries.c.user_id.in_(user_ids))
+                       .where(entries.c.upload_date < cutoff))
+
+
+def fan_out_photo(photo):
+    """Push a new photo into its readers' timelines. Caller commits."""
+    readers = _readers_of(photo.user_id).subquery()
+    # Skip timelines that already have it (e.g. a rebuild ran while it was processing)
+    already_there = exists().where(entries.c.user_id == readers.c[0],
+                                   entries.c.photo_id == photo.id)
+    db.session.execute(insert(entries).from_select(
+        ['user_id', 'photo_id', 'author_id', 'upload_date'],
+        select(readers.c[0],
+               literal(photo.id),
+               literal(photo.user_id),
+               literal(photo.upload_date, db.DateTime))
+        .where(~already_there)
+    ))
+    _trim(select(readers.c[0]))
+
+
+def remove_photo(photo):
+    db.session.execute(delete(entries).where(entries.c.photo_id == photo.id))
+
+
+def on_follow(follower, followed):
+    """Copy the followed user's latest photos into the follower's timeline."""
+    already_there = exists().where(entries.c.user_id == follower.id,
+                                   entries.c.photo_id == Photo.id)
+    recent = (select(literal(follower.id), Photo.id, Photo.user_id, Photo.upload_date)
+              .where(Photo.user_id == followed.id, Photo.status == 'ready')
+              .where(~already_there)
+              .order_by(Photo.upload_date.desc())
+              .limit(FEED_FOLLOW_BACKFILL))
+    db.session.execute(insert(entries).from_select(
+        ['user_id', 'photo_id', 'author_id', 'upload_date'], recent))
+    _trim([follower.id])
+
+
+def on_unfollow(follower, followed):
+    db.session.execute(delete(entries).where(entries.c.user_id == follower.id,
+                                             entries.c.author_id == followed.id))
+
+
+def feed_page(user, cursor=None, limit=20):
+    query = (Photo.query
+             .join(FeedEntry, FeedEntry.photo_id == Photo.id)
+             .filter(FeedEntry.user_id == user.id, Photo.status == 'ready')
+             .options(joinedload(Photo.photographer), undefer(Photo.comment_count)))
+    return keyset_page(query, FeedEntry.upload_date, FeedEntry.photo_id,
+                       cursor=cursor, limit=limit,
+                       key=lambda photo: (photo.upload_date, photo.id))
+
+
+def rebuild_feed(user_id):
+    # Pull model, used for backfills. Same result the fan-out would have produced.
+    authors = (select(connections.c.followed_id).where(connections.c.follower_id == user_id)
+               .union(select(literal(user_id))))
+    db.session.execute(delete(entries).where(entries.c.user_id == user_id))
+    db.session.execute(insert(entries).from_select(
+        ['user_id', 'photo_id', 'author_id', 'upload_date'],
+        select(literal(user_id), Photo.id, Photo.user_id, Photo.upload_date)
+        .where(Photo.user_id.in_(authors), Photo.status == 'ready')
+        .order_by(Photo.upload_date.desc())
+        .limit(FEED_MAX_ENTRIES)
+    ))
+
+
+def rebuild_all_feeds(batch_size=500):
+    last_id = 0
+    while True:
+        user_ids = [uid for (uid,) in db.session.query(User.id)
+                    .filter(User.id > last_id).order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            rebuild_feed(user_id)
+        db.session.commit()
+        last_id = user_ids[-1]
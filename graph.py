@@ -0,0 +1,228 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from models import db, User, Suggestion, connections
+
+# --- SOCIAL GRAPH ---
+# Every Connect/Connected button used to be its own COUNT(*) over connections, once per
+# photo on the feed and again inside connect()/disconnect() before writing. Now:
+#   1. each user's followed and follower id sets are cached in a per-worker LRU, bounded
+#      by the total number of ids held (GRAPH_CACHE_MAX_IDS), so a page asks
+#      follows_many() once and gets every answer from one set
+#   2. follow() / unfollow() write the edge and drop both users' sets, again right after
+#      the commit so nobody re-caches the old state in between. Other workers pick the
+#      change up after GRAPH_CACHE_TTL seconds (the DB is always the truth)
+#   3. the unique index on (follower_id, followed_id) makes a double click a no-op
+#      instead of a duplicate edge
+# "Suggested photographers" (friends of friends) are computed for everyone in bulk by
+# rebuild_suggestions(), the feed just reads the stored rows.
+
+FOLLOWED = 'followed'    # who user_id follows
+FOLLOWERS = 'followers'  # who follows user_id
+
+suggestions = Suggestion.__table__
+
+
+class SocialGraph:
+
+    def __init__(self, app=None):
+        self._cache = OrderedDict()   # (direction, user_id) -> (frozenset of ids, loaded_at)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('GRAPH_CACHE_TTL', 60)
+        self.max_ids = app.config.get('GRAPH_CACHE_MAX_IDS', 1000000)
+        event.listen(db.session, 'after_commit', self._after_commit)
+
+    # --- CACHE ---
+
+    def _columns(self, direction):
+        if direction == FOLLOWED:
+            return connections.c.follower_id, connections.c.followed_id
+        return connections.c.followed_id, connections.c.follower_id
+
+    def _sets(self, direction, user_ids):
+        """{user_id: frozenset} for one direction, every miss loaded in one query."""
+        found, missing, now = {}, [], time.monotonic()
+        with self._lock:
+            for user_id in set(user_ids):
+                cached = self._cache.get((direction, user_id))
+                if cached is not None and now - cached[1] < self.ttl:
+                    self._cache.move_to_end((direction, user_id))
+                    found[user_id] = cached[0]
+                else:
+                    missing.append(user_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+        if not missing:
+            return found
+
+        key, other = self._columns(direction)
+        loaded = {user_id: set() for user_id in missing}
+        for owner, target in db.session.execute(select(key, other).where(key.in_(missing))):
+            loaded[owner].add(target)
+        with self._lock:
+            for user_id, ids in loaded.items():
+                ids = frozenset(ids)
+                found[user_id] = ids
+                self._store((direction, user_id), ids, now)
+        return found
+
+    def _store(self, key, ids, loaded_at):
+        # Caller holds the lock. Sets bigger than the whole budget just aren't kept
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._size -= len(old[0])
+        if len(ids) > self.max_ids:
+            return
+        self._cache[key] = (ids, loaded_at)
+        self._size += len(ids)
+        while self._size > self.max_ids:
+            _, (dropped, _) = self._cache.popitem(last=False)
+            self._size -= len(dropped)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                for direction in (FOLLOWED, FOLLOWERS):
+                    old = self._cache.pop((direction, user_id), None)
+                    if old is not None:
+                        self._size -= len(old[0])
+
+    def _after_commit(self, session):
+        dirty = session.info.pop('graph_dirty', None)
+        if dirty:
+            self.invalidate(*dirty)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+    # --- READS ---
+
+    def followed(self, user_id):
+        return self._sets(FOLLOWED, [user_id])[user_id]
+
+    def followers(self, user_id):
+        return self._sets(FOLLOWERS, [user_id])[user_id]
+
+    def follows(self, follower_id, followed_id):
+        return followed_id in self.followed(follower_id)
+
+    def follows_many(self, follower_id, user_ids):
+        """The subset of user_ids that follower_id follows, one set lookup for the lot."""
+        followed = self.followed(follower_id)
+        return {user_id for user_id in user_ids if user_id in followed}
+
+    def counts(self, user_ids):
+        """{user_id: (followers, following)}. Cached sets are counted, the rest in two GROUP BYs."""
+        user_ids = set(user_ids)
+        result = {user_id: [0, 0] for user_id in user_ids}
+        for slot, direction in enumerate((FOLLOWERS, FOLLOWED)):
+            now, missing = time.monotonic(), []
+            with self._lock:
+                for user_id in user_ids:
+                    cached = self._cache.get((direction, user_id))
+                    if cached is not None and now - cached[1] < self.ttl:
+                        result[user_id][slot] = len(cached[0])
+                    else:
+                        missing.append(user_id)
+            if missing:
+                key, _ = self._columns(direction)
+                rows = db.session.execute(
+                    select(key, func.count()).where(key.in_(missing)).group_by(key))
+                for user_id, count in rows:
+                    result[user_id][slot] = count
+        return {user_id: tuple(pair) for user_id, pair in result.items()}
+
+    # --- WRITES ---
+    # Both run inside the caller's transaction and return whether anything changed,
+    # so feeds/stats/versions are only touched for a real follow or unfollow
+
+    def _dirty(self, *user_ids):
+        self.invalidate(*user_ids)
+        db.session.info.setdefault('graph_dirty', set()).update(user_ids)
+
+    def follow(self, follower_id, followed_id):
+        if follower_id == followed_id:
+            return False
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(connections).values(
+                    follower_id=follower_id, followed_id=followed_id))
+        except IntegrityError:
+            return False
+        self._dirty(follower_id, followed_id)
+        return True
+
+    def unfollow(self, follower_id, followed_id):
+        removed = db.session.execute(delete(connections).where(
+            connections.c.follower_id == follower_id,
+            connections.c.followed_id == followed_id)).rowcount
+        if removed:
+            self._dirty(follower_id, followed_id)
+        return bool(removed)
+
+
+# --- SUGGESTED PHOTOGRAPHERS ---
+
+def rebuild_suggestions(batch_size=500, per_user=10):
+    """
+    Friends of friends for every user: accounts followed by the people they follow,
+    scored by how many of them do, minus themselves and who they already follow.
+    One GROUP BY per batch of users. Returns how many suggestions were stored.
+    """
+    mine = connections.alias('mine')
+    theirs = connections.alias('theirs')
+    already = connections.alias('already')
+    stored, last_id = 0, 0
+    while True:
+        batch = db.session.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)).scalars().all()
+        if not batch:
+            return stored
+        last_id = batch[-1]
+
+        already_follows = (select(already.c.follower_id)
+                           .where(already.c.follower_id == mine.c.follower_id,
+                                  already.c.followed_id == theirs.c.followed_id).exists())
+        rows = db.session.execute(
+            select(mine.c.follower_id, theirs.c.followed_id, func.count().label('score'))
+            .join(theirs, theirs.c.follower_id == mine.c.followed_id)
+            .where(mine.c.follower_id.in_(batch),
+                   theirs.c.followed_id != mine.c.follower_id,
+                   ~already_follows)
+            .group_by(mine.c.follower_id, theirs.c.followed_id))
+
+        candidates = {}
+        for user_id, suggested_id, score in rows:
+            candidates.setdefault(user_id, []).append((score, -suggested_id))
+        picked = [{'user_id': user_id, 'suggested_id': -neg_id, 'score': score}
+                  for user_id, scored in candidates.items()
+                  for score, neg_id in heapq.nlargest(per_user, scored)]
+
+        db.session.execute(delete(suggestions).where(suggestions.c.user_id.in_(batch)))
+        if picked:
+            db.session.execute(insert(suggestions), picked)
+        db.session.commit()
+        stored += len(picked)
+
+
+def suggested_for(user_id, exclude=(), limit=5):
+    """Stored suggestions for one user, best first, skipping anyone in `exclude`."""
+    # At most per_user rows are stored, the ones followed since the last rebuild drop out here
+    rows = (Suggestion.query
+            .filter(Suggestion.user_id == user_id)
+            .options(joinedload(Suggestion.suggested))
+            .order_by(Suggestion.score.desc(), Suggestion.suggested_id)
+            .all())
+    return [row for row in rows if row.suggested_id not in exclude][:limit]
@@ -0,0 +1,286 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageOps, features
+import pillow_heif
+from models import db, Photo, User
+
+# Worker processes import this module fresh, so register HEIF here too
+pillow_heif.register_heif_opener()
+
+# Derivative sizes, the biggest JPEG doubles as Photo.filename
+RENDITION_WIDTHS = (320, 640, 1280, 1920)
+RENDITION_FORMATS = ('jpeg', 'webp', 'avif')
+MAX_WIDTH = max(RENDITION_WIDTHS)
+
+SAVE_OPTIONS = {
+    'jpeg': {'format': 'JPEG', 'optimize': True, 'quality': 85, 'progressive': True},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'avif': {'format': 'AVIF', 'quality': 60},
+}
+EXTENSIONS = {'jpeg': 'jpeg', 'webp': 'webp', 'avif': 'avif'}
+
+# Avatars are cropped square, the biggest JPEG becomes User.profile_image
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_FORMATS = ('jpeg', 'webp')
+
+
+class PipelineFull(Exception):
+    pass
+
+
+def supported_formats(formats=RENDITION_FORMATS):
+    # AVIF needs a Pillow built with libavif, skip it quietly if that's not the case
+    return tuple(fmt for fmt in formats if fmt == 'jpeg' or features.check(fmt))
+
+
+def render_derivatives(img, dest_path, widths=RENDITION_WIDTHS, formats=RENDITION_FORMATS, write_main=True):
+    """
+    Writes every width x format combination next to dest_path and returns
+    {format: {width: filename}}. Sizes are produced largest first, each one
+    downsampled from the previous, so we never resize the full original more than once.
+    """
+    base = os.path.splitext(dest_path)[0]
+    renditions = {fmt: {} for fmt in formats}
+
+    # Never upscale: anything wider than the source collapses to the source width
+    targets = sorted({min(width, img.width) for width in widths}, reverse=True)
+    current = img
+    for width in targets:
+        if current.width != width:
+            height = max(round(img.height * width / img.width), 1)
+            current = current.resize((width, height), Image.Resampling.LANCZOS)
+
+        for fmt in formats:
+            if fmt == 'jpeg' and width == targets[0]:
+                # The full-size JPEG is the main file every old template still points at
+                path = dest_path
+                if not write_main:
+                    renditions[fmt][str(width)] = os.path.basename(path)
+                    continue
+            else:
+                path = f"{base}_{width}.{EXTENSIONS[fmt]}"
+            current.save(path, **SAVE_OPTIONS[fmt])
+            renditions[fmt][str(width)] = os.path.basename(path)
+
+    return renditions
+
+
+def reduced_decode(img, width, height):
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale straight from the DCT data, so a 24 MP
+    # photo never becomes a 72 MB bitmap when we only need 1920px. Still >= width x height.
+    # Other formats decode at full size (probe() caps their pixel count)
+    if img.format in ('JPEG', 'MPO'):
+        img.draft('RGB', (width, height))
+    return img
+
+
+def color_histogram(img, bins=4):
+    """
+    Joint RGB histogram with `bins` levels per channel (64 for 4) from a small thumbnail,
+    as bytes of sqrt(share) * 255, so the bins already form a unit vector for related.py.
+    """
+    small = np.asarray(img.convert('RGB').resize((64, 64), Image.Resampling.BOX), dtype=np.uint16)
+    levels = small * bins // 256
+    index = (levels[..., 0] * bins + levels[..., 1]) * bins + levels[..., 2]
+    counts = np.bincount(index.ravel(), minlength=bins ** 3)
+    return np.round(np.sqrt(counts / counts.sum()) * 255).astype(np.uint8).tobytes()
+
+
+# --- THE ACTUAL PILLOW WORK ---
+# Runs inside a worker process, so it only gets plain paths in and hands a plain dict back.
+def process_image(src_path, dest_path, formats=RENDITION_FORMATS):
+    started = time.perf_counter()
+    try:
+        with Image.open(src_path) as img:
+            reduced_decode(img, MAX_WIDTH, max(round(img.height * MAX_WIDTH / img.width), 1))
+            # Convert HEIC or non-RGB (like transparent PNG) to RGB
+            if img.format == 'HEIF' or img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            renditions = render_derivatives(img, dest_path, formats=supported_formats(formats))
+            histogram = color_histogram(img)
+    finally:
+        if os.path.exists(src_path) and src_path != dest_path:
+            os.remove(src_path)
+
+    return {
+        'renditions': renditions,
+        'histogram': histogram,
+        'seconds': time.perf_counter() - started
+    }
+
+
+def process_avatar(src_path, dest_path, formats=AVATAR_FORMATS):
+    started = time.perf_counter()
+    side = max(AVATAR_SIZES)
+    try:
+        with Image.open(src_path) as img:
+            reduced_decode(img, side, side)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            # Centre crop, avatars are always shown in a circle
+            square = ImageOps.fit(img, (min(side, *img.size),) * 2, Image.Resampling.LANCZOS)
+            renditions = render_derivatives(square, dest_path, widths=AVATAR_SIZES,
+                                            formats=supported_formats(formats))
+    finally:
+        if os.path.exists(src_path) and src_path != dest_path:
+            os.remove(src_path)
+
+    return {
+        'renditions': renditions,
+        'seconds': time.perf_counter() - started
+    }
+
+
+def backfill_renditions(path, formats=RENDITION_FORMATS):
+    # For photos uploaded before renditions existed, keeps the main file as is
+    with Image.open(path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return render_derivatives(img, path, formats=supported_formats(formats), write_main=False)
+
+
+def rendition_files(photo):
+    # Every file on disk that belongs to a photo
+    names = {photo.filename}
+    for sizes in (photo.renditions or {}).values():
+        names.update(sizes.values())
+    return names
+
+
+# --- WORKER POOL ---
+# upload() and settings() park the raw file and return straight away, the heavy lifting happens here.
+# Results are handed back through a queue and applied by a socketio background task,
+# so DB writes and emits always happen on the server's own event loop (eventlet friendly).
+class ImagePipeline:
+
+    def __init__(self, app=None, socketio=None):
+        self.app = None
+        self.executor = None
+        self.on_complete = []
+        self.on_avatar = []
+        self._done = queue.Queue()
+        self._slots = None
+        self._dispatcher_started = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.mode = app.config.get('IMAGE_WORKER_MODE', 'process')
+        self.formats = tuple(app.config.get('RENDITION_FORMATS', RENDITION_FORMATS))
+        workers = app.config.get('IMAGE_WORKERS') or os.cpu_count() or 2
+        self._slots = threading.BoundedSemaphore(app.config.get('IMAGE_QUEUE_LIMIT', 32))
+
+        # 'process' = real parallelism, 'thread' = no fork (handy on tiny boxes),
+        # 'inline' = run during the request like before (scripts and debugging)
+        if self.mode == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        elif self.mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imaging')
+
+    def completed(self, fn):
+        # Decorator: fn(photo, result_or_None, error_or_None), called inside an app context
+        self.on_complete.append(fn)
+        return fn
+
+    def avatar_completed(self, fn):
+        # Same for avatars: fn(user, result_or_None, error_or_None)
+        self.on_avatar.append(fn)
+        return fn
+
+    def submit(self, photo_id, src_path, dest_path):
+        self._submit('photo', photo_id, src_path, dest_path)
+
+    def submit_avatar(self, user_id, src_path, dest_path):
+        self._submit('avatar', user_id, src_path, dest_path)
+
+    def _submit(self, kind, key, src_path, dest_path):
+        work, formats = (process_image, self.formats) if kind == 'photo' else (process_avatar, AVATAR_FORMATS)
+        if self.mode == 'inline':
+            try:
+                result, error = work(src_path, dest_path, formats), None
+            except Exception as e:
+                result, error = None, e
+            self._finish(kind, key, dest_path, result, error)
+            return
+
+        if not self._slots.acquire(blocking=False):
+            raise PipelineFull('Image pipeline is at capacity')
+
+        self._ensure_dispatcher()
+        future = self.executor.submit(work, src_path, dest_path, formats)
+        future.add_done_callback(lambda f: self._done.put((kind, key, dest_path, f)))
+
+    def _ensure_dispatcher(self):
+        with self._lock:
+            if not self._dispatcher_started:
+                self._dispatcher_started = True
+                self.socketio.start_background_task(self._dispatch)
+
+    def _dispatch(self):
+        while True:
+            try:
+                kind, key, dest_path, future = self._done.get_nowait()
+            except queue.Empty:
+                self.socketio.sleep(0.1)
+                continue
+
+            self._slots.release()
+            error = future.exception()
+            self._finish(kind, key, dest_path, None if error else future.result(), error)
+
+    def _finish(self, kind, key, dest_path, result, error):
+        model, callbacks = (Photo, self.on_complete) if kind == 'photo' else (User, self.on_avatar)
+        with self.app.app_context():
+            try:
+                target = db.session.get(model, key)
+                if target is None:
+                    # Deleted while it was still processing, don't leave the output behind
+                    self._discard_outputs(dest_path, result)
+                    return
+                if result is not None:
+                    # Where the outputs are, the callbacks move them into storage
+                    result['folder'] = os.path.dirname(dest_path)
+                for fn in callbacks:
+                    fn(target, result, error)
+                db.session.commit()
+            except Exception as e:
+                # Never let one bad photo kill the dispatcher
+                print(f"Finishing {kind} {key} failed: {e}")
+                db.session.rollback()
+                self._discard_outputs(dest_path, result)
+                if error is None:
+                    # Report it as a failed conversion instead of leaving it 'processing' forever
+                    self._fail(model, key, callbacks, e)
+
+    def _fail(self, model, key, callbacks, error):
+        try:
+            target = db.session.get(model, key)
+            if target is not None:
+                for fn in callbacks:
+                    fn(target, None, error)
+                db.session.commit()
+        except Exception as e:
+            print(f"Marking {model.__name__} {key} as failed didn't work either: {e}")
+            db.session.rollback()
+
+    def _discard_outputs(self, dest_path, result):
+        # Whatever the worker wrote to incoming/ and nobody took over
+        outputs = {os.path.basename(dest_path)}
+        for sizes in ((result or {}).get('renditions') or {}).values():
+            outputs.update(sizes.values())
+        for name in outputs:
+            path = os.path.join(os.path.dirname(dest_path), name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
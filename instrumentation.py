@@ -0,0 +1,230 @@
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import g, request, abort, before_render_template, template_rendered
+from sqlalchemy import event
+from models import db
+
+# --- REQUEST INSTRUMENTATION ---
+# Most of our slow pages are N+1 lazy loads hiding in templates (photo.photographer,
+# comment.user, ... inside a for loop), and nothing told us about them. Every request
+# now counts its SQL queries and times them, its template rendering and any Pillow
+# work it did, and
+#   - dev: puts the numbers in X-DB-Queries / Server-Timing headers (devtools shows them)
+#   - always: adds them up for a Prometheus-style /metrics endpoint
+#   - slow requests (SLOW_REQUEST_MS) get logged with their slowest and most repeated queries
+# Numbers are per worker process, Prometheus sums them across scrape targets.
+
+# Request duration histogram buckets (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Statements kept per request for the slow log, enough to spot an N+1
+MAX_RECORDED_QUERIES = 500
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.image_time = 0.0
+        self.statements = []          # (seconds, sql)
+        self._template_starts = []
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Instrumentation:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.requests = Counter()                 # (endpoint, method, status) -> n
+        self.durations = defaultdict(Histogram)   # endpoint -> Histogram
+        self.totals = Counter()                   # db_queries, db_seconds, template_seconds
+        self.images = Histogram(BUCKETS + (30.0, 60.0))
+        self.slow_requests = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.headers = app.config.get('INSTRUMENT_HEADERS', app.debug)
+        self.slow_ms = app.config.get('SLOW_REQUEST_MS', 500)
+        self.token = app.config.get('METRICS_TOKEN')
+
+        app.before_request(self._request_started)
+        app.after_request(self._request_finished)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._query_started)
+        event.listen(engine, 'after_cursor_execute', self._query_finished)
+        event.listen(engine, 'handle_error', self._query_failed)
+
+        if app.config.get('METRICS_ENDPOINT', True):
+            app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    # --- PER REQUEST ---
+
+    @staticmethod
+    def current():
+        # None outside a request (background tasks, CLI), those only count towards totals
+        return g.get('request_stats')
+
+    def _request_started(self):
+        g.request_stats = RequestStats()
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        with self._lock:
+            self.totals['db_queries'] += 1
+            self.totals['db_seconds'] += elapsed
+        stats = self.current()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+            if len(stats.statements) < MAX_RECORDED_QUERIES:
+                stats.statements.append((elapsed, statement))
+
+    def _query_failed(self, context):
+        # after_cursor_execute never fires for a failed statement, drop its start time
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+
+    def _template_started(self, sender, template, context, **extra):
+        stats = self.current()
+        if stats is not None:
+            stats._template_starts.append(time.perf_counter())
+
+    def _template_finished(self, sender, template, context, **extra):
+        stats = self.current()
+        if stats is not None and stats._template_starts:
+            started = stats._template_starts.pop()
+            # Only the outermost render counts, otherwise nested renders are counted twice
+            if not stats._template_starts:
+                stats.template_time += time.perf_counter() - started
+
+    def record_image(self, seconds):
+        """Pillow time for one image, from the pipeline or an inline resize."""
+        with self._lock:
+            self.images.observe(seconds)
+        stats = self.current()
+        if stats is not None:
+            stats.image_time += seconds
+
+    def _request_finished(self, response):
+        stats = self.current()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+
+        with self._lock:
+            self.requests[(endpoint, request.method, response.status_code)] += 1
+            self.durations[endpoint].observe(elapsed)
+            self.totals['template_seconds'] += stats.template_time
+
+        if self.headers:
+            response.headers['X-DB-Queries'] = str(stats.queries)
+            response.headers['X-DB-Time'] = f"{stats.query_time * 1000:.1f}ms"
+            response.headers['Server-Timing'] = ', '.join([
+                f"db;desc=\"{stats.queries} queries\";dur={stats.query_time * 1000:.1f}",
+                f"tpl;dur={stats.template_time * 1000:.1f}",
+                f"img;dur={stats.image_time * 1000:.1f}",
+                f"total;dur={elapsed * 1000:.1f}",
+            ])
+
+        if self.slow_ms is not None and elapsed * 1000 >= self.slow_ms:
+            self._log_slow(stats, elapsed, response)
+        return response
+
+    def _log_slow(self, stats, elapsed, response):
+        with self._lock:
+            self.slow_requests += 1
+        lines = [f"Slow request: {request.method} {request.full_path.rstrip('?')} -> {response.status_code} "
+                 f"in {elapsed * 1000:.0f}ms (db {stats.queries} queries / {stats.query_time * 1000:.0f}ms, "
+                 f"templates {stats.template_time * 1000:.0f}ms, images {stats.image_time * 1000:.0f}ms)"]
+        # Same statement over and over = a lazy load in a loop
+        repeated = Counter(sql for _, sql in stats.statements).most_common(3)
+        for sql, n in repeated:
+            if n > 1:
+                lines.append(f"  {n}x  {' '.join(sql.split())[:300]}")
+        for seconds, sql in sorted(stats.statements, reverse=True)[:5]:
+            lines.append(f"  {seconds * 1000:6.1f}ms  {' '.join(sql.split())[:300]}")
+        self.app.logger.warning('\n'.join(lines))
+
+    # --- /metrics ---
+
+    def render_metrics(self):
+        out = []
+        with self._lock:
+            out += ['# HELP lens_http_requests_total HTTP requests by endpoint, method and status.',
+                    '# TYPE lens_http_requests_total counter']
+            for (endpoint, method, status), n in sorted(self.requests.items()):
+                out.append(f'lens_http_requests_total{{endpoint="{_label(endpoint)}",method="{method}",'
+                           f'status="{status}"}} {n}')
+
+            out += ['# HELP lens_http_request_duration_seconds Time spent handling requests.',
+                    '# TYPE lens_http_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.durations.items()):
+                out += self._histogram_lines('lens_http_request_duration_seconds', histogram,
+                                             f'endpoint="{_label(endpoint)}"')
+
+            out += ['# HELP lens_db_queries_total SQL statements executed.',
+                    '# TYPE lens_db_queries_total counter',
+                    f"lens_db_queries_total {self.totals['db_queries']}",
+                    '# HELP lens_db_query_seconds_total Time spent waiting on SQL statements.',
+                    '# TYPE lens_db_query_seconds_total counter',
+                    f"lens_db_query_seconds_total {self.totals['db_seconds']:.6f}",
+                    '# HELP lens_template_render_seconds_total Time spent rendering templates.',
+                    '# TYPE lens_template_render_seconds_total counter',
+                    f"lens_template_render_seconds_total {self.totals['template_seconds']:.6f}",
+                    '# HELP lens_slow_requests_total Requests slower than SLOW_REQUEST_MS.',
+                    '# TYPE lens_slow_requests_total counter',
+                    f"lens_slow_requests_total {self.slow_requests}",
+                    '# HELP lens_image_processing_seconds Pillow time per processed image.',
+                    '# TYPE lens_image_processing_seconds histogram']
+            out += self._histogram_lines('lens_image_processing_seconds', self.images)
+        return '\n'.join(out) + '\n'
+
+    @staticmethod
+    def _histogram_lines(name, histogram, labels=''):
+        sep = ',' if labels else ''
+        lines = [f'{name}_bucket{{{labels}{sep}le="{bound}"}} {n}'
+                 for bound, n in zip(histogram.buckets, histogram.counts)]
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {histogram.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.total:.6f}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+        return lines
+
+    def metrics_view(self):
+        # Set METRICS_TOKEN to keep the numbers away from the public internet
+        if self.token and request.headers.get('Authorization') != f'Bearer {self.token}':
+            abort(404)
+        return self.render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
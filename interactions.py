@@ -0,0 +1,108 @@
+from sqlalchemy import delete, insert, literal, select, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from models import db, Photo, Comment, photo_likes, saved_photos
+from pagination import keyset_page
+import stats as user_stats
+import caching
+
+# --- LIKES & SAVES ---
+# Toggles are a single DELETE or INSERT on the association table, and the
+# denormalized Photo.likes moves in the same transaction with likes = likes +/- 1,
+# so the count can never drift from the rows behind it.
+
+MAX_STATE_IDS = 200
+
+photos = Photo.__table__
+
+
+def _toggle(table, user_id, photo_id):
+    # Returns (row_exists_now, we_changed_something)
+    removed = db.session.execute(delete(table).where(table.c.user_id == user_id,
+                                                     table.c.photo_id == photo_id)).rowcount
+    if removed:
+        return False, True
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(table).values(user_id=user_id, photo_id=photo_id))
+    except IntegrityError:
+        # A parallel request (double click!) inserted it first, nothing left to do
+        return True, False
+    return True, True
+
+
+def toggle_like(user_id, photo_id):
+    """Like or unlike a photo. Returns (liked, new_like_count). Commits."""
+    liked, changed = _toggle(photo_likes, user_id, photo_id)
+    if changed:
+        delta = 1 if liked else -1
+        db.session.execute(update(photos).where(photos.c.id == photo_id)
+                           .values(likes=photos.c.likes + delta))
+        user_stats.bump_photo_owners('likes', [{'photo_id': photo_id, 'delta': delta}])
+        caching.touch_photo_ids([photo_id], caching.PHOTOS)
+    db.session.commit()
+
+    count = db.session.execute(select(photos.c.likes).where(photos.c.id == photo_id)).scalar()
+    return liked, count
+
+
+def toggle_save(user_id, photo_id):
+    """Save or unsave a photo. Returns True if it's saved now. Commits."""
+    saved, changed = _toggle(saved_photos, user_id, photo_id)
+    if changed:
+        # The saved/unsaved button is part of this viewer's cached pages
+        caching.touch(f'user:{user_id}')
+    db.session.commit()
+    return saved
+
+
+def remove_photo(photo):
+    db.session.execute(delete(photo_likes).where(photo_likes.c.photo_id == photo.id))
+
+
+def viewer_state(user, photo_ids):
+    """
+    Which of these photos has `user` liked / saved? Returns (liked_ids, saved_ids).
+    One query for the whole grid instead of one check per tile.
+    """
+    photo_ids = list(photo_ids)[:MAX_STATE_IDS]
+    if not photo_ids or not getattr(user, 'is_authenticated', False):
+        return set(), set()
+
+    liked = select(photo_likes.c.photo_id, literal('like').label('kind')).where(
+        photo_likes.c.user_id == user.id, photo_likes.c.photo_id.in_(photo_ids))
+    saved = select(saved_photos.c.photo_id, literal('save').label('kind')).where(
+        saved_photos.c.user_id == user.id, saved_photos.c.photo_id.in_(photo_ids))
+
+    liked_ids, saved_ids = set(), set()
+    for photo_id, kind in db.session.execute(union_all(liked, saved)):
+        (liked_ids if kind == 'like' else saved_ids).add(photo_id)
+    return liked_ids, saved_ids
+
+
+# --- COMMENTS ---
+# The photo page shows the newest page of comments (authors joined in the same SELECT)
+# and fetches older ones from /api/photos/<id>/comments, each page a range scan on
+# (photo_id, timestamp, id). The total is Photo.comment_count, a COUNT in SQL.
+
+MAX_COMMENT_LENGTH = 2000
+
+
+def comments_page(photo_id, cursor=None, limit=20):
+    """Newest `limit` comments on a photo before `cursor`, newest first, with their authors."""
+    query = Comment.query.filter(Comment.photo_id == photo_id).options(joinedload(Comment.user))
+    return keyset_page(query, Comment.timestamp, Comment.id, cursor=cursor, limit=limit)
+
+
+def add_comment(user_id, photo_id, content):
+    """Store a comment and bump the pages showing it. Returns the Comment. Commits."""
+    comment = Comment(content=content.strip()[:MAX_COMMENT_LENGTH], user_id=user_id, photo_id=photo_id)
+    db.session.add(comment)
+    caching.touch(caching.PHOTOS, f'photo:{photo_id}')
+    db.session.commit()
+    return comment
+
+
+def comment_count(photo_id):
+    return db.session.execute(select(db.func.count(Comment.id)).where(Comment.photo_id == photo_id)).scalar()
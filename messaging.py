@@ -0,0 +1,295 @@
+import time
+from datetime import datetime
+from sqlalchemy import and_, case, delete, func, insert, literal, or_, select, tuple_, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from models import db, Conversation, Message
+from pagination import keyset_page
+
+# --- DIRECT MESSAGES ---
+# The inbox used to load every message you ever sent or got and group them in Python.
+# Now each chat has a tiny summary row per participant (last message, unread count)
+# that chat() keeps current, and the inbox is one indexed, paginated SELECT.
+
+conversations = Conversation.__table__
+messages = Message.__table__
+
+
+def _touch(user_id, other_user_id, message, unread_delta):
+    values = {
+        'last_message_id': message.id,
+        'updated_at': message.timestamp,
+        'unread_count': conversations.c.unread_count + unread_delta,
+    }
+    where = and_(conversations.c.user_id == user_id, conversations.c.other_user_id == other_user_id)
+    if db.session.execute(update(conversations).where(where).values(values)).rowcount:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(conversations).values(
+                user_id=user_id, other_user_id=other_user_id, last_message_id=message.id,
+                updated_at=message.timestamp, unread_count=unread_delta))
+    except IntegrityError:
+        # The other side of a race created the row first, just update it
+        db.session.execute(update(conversations).where(where).values(values))
+
+
+def record_message(message):
+    """Update both inbox rows for a freshly flushed message. Caller commits."""
+    _touch(message.sender_id, message.recipient_id, message, 0)
+    _touch(message.recipient_id, message.sender_id, message, 1)
+
+
+def mark_read(user_id, other_user_id, up_to_id=None):
+    """
+    Mark what other_user sent to user as read (only up to message `up_to_id` if given).
+    Returns how many flipped. Caller commits.
+    """
+    conditions = [
+        messages.c.sender_id == other_user_id,
+        messages.c.recipient_id == user_id,
+        ~messages.c.read  # renders as read = 0, which the partial unread index matches
+    ]
+    if up_to_id is not None:
+        conditions.append(messages.c.id <= up_to_id)
+    flipped = db.session.execute(update(messages).where(*conditions).values(
+        read=True, delivered_at=func.coalesce(messages.c.delivered_at, datetime.utcnow()))).rowcount
+
+    if flipped:
+        unread_count = 0 if up_to_id is None else case(
+            (conversations.c.unread_count > flipped, conversations.c.unread_count - flipped), else_=0)
+        db.session.execute(update(conversations).where(
+            conversations.c.user_id == user_id,
+            conversations.c.other_user_id == other_user_id
+        ).values(unread_count=unread_count))
+    return flipped
+
+
+def mark_delivered(user_id, other_user_id, up_to_id):
+    """Delivery receipt for everything other_user sent to user up to `up_to_id`. Caller commits."""
+    # Read implies delivered, so only unread rows can still be undelivered (partial index again)
+    return db.session.execute(update(messages).where(
+        messages.c.sender_id == other_user_id,
+        messages.c.recipient_id == user_id,
+        ~messages.c.read,
+        messages.c.delivered_at.is_(None),
+        messages.c.id <= up_to_id
+    ).values(delivered_at=datetime.utcnow())).rowcount
+
+
+def inbox_page(user, cursor=None, limit=30):
+    query = (Conversation.query
+             .filter(Conversation.user_id == user.id)
+             .options(joinedload(Conversation.other_user), joinedload(Conversation.last_message)))
+    return keyset_page(query, Conversation.updated_at, Conversation.other_user_id,
+                       cursor=cursor, limit=limit)
+
+
+def history_page(user_id, other_user_id, cursor=None, limit=50):
+    """
+    Newest `limit` messages between two users before `cursor`, newest first.
+    Each direction is a range scan on (sender_id, recipient_id, timestamp, id).
+    """
+    query = Message.query.filter(or_(
+        and_(Message.sender_id == user_id, Message.recipient_id == other_user_id),
+        and_(Message.sender_id == other_user_id, Message.recipient_id == user_id)
+    ))
+    return keyset_page(query, Message.timestamp, Message.id, cursor=cursor, limit=limit)
+
+
+def messages_after(user_id, other_user_id, after_id, limit=50):
+    """Delta sync: up to `limit` messages of the chat with an id above `after_id`, oldest first."""
+    return (Message.query
+            .filter(or_(
+                and_(Message.sender_id == user_id, Message.recipient_id == other_user_id),
+                and_(Message.sender_id == other_user_id, Message.recipient_id == user_id)
+            ), Message.id > after_id)
+            .order_by(Message.id)
+            .limit(limit)
+            .all())
+
+
+def message_status(message):
+    # What the sender sees under their own message
+    if message.read:
+        return 'read'
+    return 'delivered' if message.delivered_at else 'sent'
+
+
+def message_to_dict(message):
+    return {
+        'id': message.id,
+        'client_id': message.client_id,
+        'content': message.content,
+        'timestamp': message.timestamp.strftime('%I:%M %p'),
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'status': message_status(message)
+    }
+
+
+def rebuild_conversations():
+    # Backfill straight from the messages table with one INSERT ... SELECT.
+    # Every message counts once from the sender's side and once from the recipient's,
+    # and only the recipient's side can be unread.
+    sides = union_all(
+        select(messages.c.sender_id.label('user_id'),
+               messages.c.recipient_id.label('other_user_id'),
+               messages.c.id.label('message_id'),
+               literal(0).label('unread')),
+        select(messages.c.recipient_id, messages.c.sender_id, messages.c.id,
+               case((~messages.c.read, 1), else_=0))
+    ).subquery()
+
+    summary = (select(sides.c.user_id, sides.c.other_user_id,
+                      func.max(sides.c.message_id).label('last_message_id'),
+                      func.sum(sides.c.unread).label('unread_count'))
+               .group_by(sides.c.user_id, sides.c.other_user_id)
+               .subquery())
+
+    db.session.execute(delete(conversations))
+    db.session.execute(insert(conversations).from_select(
+        ['user_id', 'other_user_id', 'last_message_id', 'unread_count', 'updated_at'],
+        select(summary.c.user_id, summary.c.other_user_id, summary.c.last_message_id,
+               summary.c.unread_count, messages.c.timestamp)
+        .select_from(summary)
+        .join(messages, messages.c.id == summary.c.last_message_id)
+    ))
+    db.session.commit()
+
+
+# --- GROUP COMMIT ---
+# Every send used to be its own transaction, and SQLite pays a full fsync per commit.
+# Outbox.send() queues the message and waits, a single writer task drains whatever is
+# queued (up to MESSAGE_BATCH_SIZE) and stores it all in one transaction. Idle, a batch
+# is just one message, under load the batches grow on their own while a commit is running.
+
+class _Pending:
+    __slots__ = ('sender_id', 'recipient_id', 'content', 'client_id', 'done', 'result', 'created', 'error')
+
+    def __init__(self, sender_id, recipient_id, content, client_id, done):
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.content = content
+        self.client_id = client_id
+        self.done = done
+        self.result = None
+        self.created = False
+        self.error = None
+
+
+class Outbox:
+
+    def __init__(self, app=None, socketio=None):
+        self.app = None
+        self._queue = None
+        self._writer_started = False
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.batch_size = app.config.get('MESSAGE_BATCH_SIZE', 100)
+        # Optionally hold the first message a moment so more can join its commit
+        self.window = app.config.get('MESSAGE_BATCH_WINDOW', 0)
+        self.timeout = app.config.get('MESSAGE_SEND_TIMEOUT', 10)
+        # Queue/event flavours that match the async mode (eventlet, threading...)
+        self._eio = socketio.server.eio
+        self._queue = self._eio.create_queue()
+        self._empty = self._eio.get_queue_empty_exception()
+
+    def send(self, sender_id, recipient_id, content, client_id=None):
+        """
+        Store a message with the next group commit and wait for it.
+        Returns (message_dict, created), created is False when client_id was already stored.
+        """
+        item = _Pending(sender_id, recipient_id, content, client_id, self._eio.create_event())
+        self._ensure_writer()
+        self._queue.put(item)
+        if not item.done.wait(timeout=self.timeout):
+            raise TimeoutError('Message was not stored in time')
+        if item.error is not None:
+            raise item.error
+        return item.result, item.created
+
+    def _ensure_writer(self):
+        if not self._writer_started:
+            self._writer_started = True
+            self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    wait = deadline - time.monotonic()
+                    batch.append(self._queue.get(timeout=wait) if wait > 0 else self._queue.get_nowait())
+                except self._empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        failed = None
+        with self.app.app_context():
+            try:
+                self._write(batch)
+            except Exception as e:
+                db.session.rollback()
+                failed = e
+
+        if failed is not None and len(batch) > 1:
+            # One bad message (or a dedup race with another worker) shouldn't sink the rest
+            for item in batch:
+                self._commit([item])
+            return
+        if isinstance(failed, IntegrityError) and batch[0].client_id:
+            # Another worker stored the same resend between our lookup and the flush
+            with self.app.app_context():
+                try:
+                    existing = Message.query.filter_by(sender_id=batch[0].sender_id,
+                                                       client_id=batch[0].client_id).first()
+                except Exception:
+                    db.session.rollback()
+                    existing = None
+                if existing is not None:
+                    batch[0].result, batch[0].created = message_to_dict(existing), False
+                    failed = None
+        if failed is not None:
+            print(f"Storing message failed: {failed}")
+            batch[0].error = failed
+        for item in batch:
+            item.done.set()
+
+    def _write(self, batch):
+        # Resends carry the same client_id, answer them with the row we already have
+        keys = {(item.sender_id, item.client_id) for item in batch if item.client_id}
+        known = {}
+        if keys:
+            known = {(msg.sender_id, msg.client_id): msg for msg in
+                     Message.query.filter(tuple_(Message.sender_id, Message.client_id).in_(keys))}
+
+        fresh = []
+        for item in batch:
+            key = (item.sender_id, item.client_id)
+            item.created = False
+            if item.client_id and key in known:
+                item.result = known[key]
+                continue
+            msg = Message(sender_id=item.sender_id, recipient_id=item.recipient_id,
+                          content=item.content, client_id=item.client_id)
+            db.session.add(msg)
+            fresh.append(msg)
+            item.result, item.created = msg, True
+            if item.client_id:
+                known[key] = msg
+
+        db.session.flush()
+        for msg in fresh:
+            record_message(msg)
+        # Serialize before commit, afterwards every attribute access would reload the row
+        for item in batch:
+            item.result = message_to_dict(item.result)
+        db.session.commit()
@@ -0,0 +1,119 @@
+from datetime import datetime
+from sqlalchemy import inspect, insert, select, text
+from models import db
+
+# --- SCHEMA MIGRATIONS ---
+# db.create_all() creates missing tables but never touches existing ones, so a database
+# made before a column or index was added kept its old shape (and its full table scans).
+# upgrade() brings any database up to models.py:
+#   1. create_all() for brand new tables
+#   2. every numbered step below that hasn't run yet, each recorded in schema_migrations
+#   3. every index declared in models.py that doesn't exist yet (CREATE INDEX only, never drops)
+# Steps must be safe on a fresh database too, where create_all() already did the work.
+
+schema_migrations = db.Table('schema_migrations',
+    db.Column('name', db.String(100), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False)
+)
+
+MIGRATIONS = []
+
+
+def migration(fn):
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def _add_column(conn, table, name):
+    # Type, default and nullability come from the model, so there's one source of truth
+    if name in {col['name'] for col in inspect(conn).get_columns(table)}:
+        return
+    column = db.metadata.tables[table].c[name]
+    ddl = f'ALTER TABLE {table} ADD COLUMN {name} {column.type.compile(conn.dialect)}'
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    elif column.default is not None and column.default.is_scalar:
+        ddl += f" DEFAULT '{column.default.arg}'" if isinstance(column.default.arg, str) \
+            else f" DEFAULT {column.default.arg}"
+        if not column.nullable:
+            ddl += ' NOT NULL'
+    conn.execute(text(ddl))
+
+
+@migration
+def m0001_photo_processing_columns(conn):
+    _add_column(conn, 'photos', 'renditions')
+    _add_column(conn, 'photos', 'status')
+
+
+@migration
+def m0002_message_receipt_columns(conn):
+    _add_column(conn, 'messages', 'delivered_at')
+    _add_column(conn, 'messages', 'client_id')
+
+
+@migration
+def m0003_unique_saved_photos(conn):
+    # saved_photos had no primary key, so the same save could be stored twice.
+    # Drop the extra copies, then the unique index below keeps it that way
+    if 'saved_photos' not in inspect(conn).get_table_names():
+        return
+    row_id = 'ctid' if conn.dialect.name == 'postgresql' else 'rowid'
+    conn.execute(text(
+        f'DELETE FROM saved_photos WHERE {row_id} NOT IN '
+        f'(SELECT min({row_id}) FROM saved_photos GROUP BY user_id, photo_id)'))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_saved_photos_user_photo ON saved_photos (user_id, photo_id)'))
+
+
+@migration
+def m0004_avatar_renditions(conn):
+    _add_column(conn, 'users', 'avatar_renditions')
+
+
+@migration
+def m0005_unique_connections(conn):
+    # Same story as saved_photos: connect() checked then inserted, two clicks could
+    # store the edge twice. Keep one copy and make the follower index unique
+    if 'connections' not in inspect(conn).get_table_names():
+        return
+    row_id = 'ctid' if conn.dialect.name == 'postgresql' else 'rowid'
+    conn.execute(text(
+        f'DELETE FROM connections WHERE {row_id} NOT IN '
+        f'(SELECT min({row_id}) FROM connections GROUP BY follower_id, followed_id)'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_connections_follower_id'))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX ix_connections_follower_id ON connections (follower_id, followed_id)'))
+
+
+@migration
+def m0006_event_recorded_at(conn):
+    # Older events stay NULL, rollup treats them as settled
+    _add_column(conn, 'photo_events', 'recorded_at')
+
+
+def create_missing_indexes(conn):
+    existing = {}
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            existing[table.name] = {index['name'] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing[table.name]:
+                index.create(conn)
+                print(f"Created index {index.name}")
+
+
+def upgrade():
+    """Bring the database schema up to date. Returns the names of the steps that ran."""
+    ran = []
+    with db.engine.begin() as conn:
+        db.metadata.create_all(conn)
+        applied = set(conn.execute(select(schema_migrations.c.name)).scalars())
+        for step in MIGRATIONS:
+            if step.__name__ in applied:
+                continue
+            step(conn)
+            conn.execute(insert(schema_migrations).values(name=step.__name__, applied_at=datetime.utcnow()))
+            ran.append(step.__name__)
+        create_missing_indexes(conn)
+    return ran
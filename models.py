@@ -9,13 +9,34 @@ db = SQLAlchemy()
 # Yeh wo table hai jo batati hai kaun kiska dost/follower hai
 connections = db.Table('connections',
     db.Column('follower_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('users.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('users.id')),
+    # "who do I follow" and "who follows me" both come straight off an index,
+    # the unique one also means an edge can only be stored once
+    db.Index('ix_connections_follower_id', 'follower_id', 'followed_id', unique=True),
+    db.Index('ix_connections_followed_id', 'followed_id', 'follower_id')
 )
 
 # 1.b. ASSOCIATION TABLE (Saved Photos)
 saved_photos = db.Table('saved_photos',
-    db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('photo_id', db.Integer, db.ForeignKey('photos.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    db.Column('photo_id', db.Integer, db.ForeignKey('photos.id'), primary_key=True)
+)
+
+# 1.b.2 ASSOCIATION TABLE (Likes)
+# One row per (user, photo), the primary key makes liking twice impossible.
+# Photo.likes is the denormalized count of these rows, see interactions.py
+photo_likes = db.Table('photo_likes',
+    db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
+    db.Column('photo_id', db.Integer, db.ForeignKey('photos.id'), primary_key=True, index=True),
+    db.Column('created_at', db.DateTime, default=datetime.utcnow)
+)
+
+# 1.c. ASSOCIATION TABLE (Photo <-> Tag)
+# Normalized copy of Photo.tags so tag filters hit an index instead of LIKE '%tag%'
+photo_tags = db.Table('photo_tags',
+    db.Column('photo_id', db.Integer, db.ForeignKey('photos.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'), primary_key=True),
+    db.Index('ix_photo_tags_tag_id_photo_id', 'tag_id', 'photo_id')
 )
 
 class User(UserMixin, db.Model):
@@ -28,6 +49,8 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     bio = db.Column(db.Text, nullable=True)
     profile_image = db.Column(db.String(255), default='default_profile.jpg')
+    # Square avatar sizes {format: {size: filename}}, profile_image is the biggest JPEG
+    avatar_renditions = db.Column(db.JSON, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship: One user can have many photos
@@ -55,8 +78,10 @@ class User(UserMixin, db.Model):
         if self.is_connected_to(user):
             self.followed.remove(user)
 
+    # Routes and templates ask graph.py (cached sets) instead, this one always hits the DB
     def is_connected_to(self, user):
-        return self.followed.filter(connections.c.followed_id == user.id).count() > 0
+        return db.session.query(connections.c.follower_id).filter(
+            connections.c.follower_id == self.id, connections.c.followed_id == user.id).first() is not None
 
     # Password save mat karna plain text mein bhai! (Don't save password in plain text brother!)
     def set_password(self, password):
@@ -77,7 +102,11 @@ class Photo(db.Model):
     
     # File details
     filename = db.Column(db.String(255), nullable=False)
+    # Derivative sizes written by imaging.py: {"webp": {"320": "x_320.webp", ...}, ...}
+    renditions = db.Column(db.JSON, nullable=True)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # 'processing' until the image worker is done with it, then 'ready' (or 'failed')
+    status = db.Column(db.String(20), default='ready', nullable=False)
     
     # Stats
     views = db.Column(db.Integer, default=0)
@@ -89,6 +118,110 @@ class Photo(db.Model):
     # Relationship: A photo can have many comments
     comments = db.relationship('Comment', backref='photo', lazy=True, cascade="all, delete-orphan")
 
+    # Normalized tags, kept in sync with the tags string by tags.py
+    tag_index = db.relationship('Tag', secondary=photo_tags, backref=db.backref('photos', lazy='dynamic'))
+
+    # Camera metadata read at upload (exif.py), goes away with the photo
+    exif = db.relationship('PhotoExif', uselist=False, backref='photo', cascade='all, delete-orphan')
+
+    # Explore/feed paginate on (upload_date, id), newest first, profiles do the same per user
+    __table_args__ = (
+        db.Index('ix_photos_upload_date_id', 'upload_date', 'id'),
+        db.Index('ix_photos_user_upload_date', 'user_id', 'upload_date', 'id'),
+    )
+
+class PhotoExif(db.Model):
+    __tablename__ = 'photo_exif'
+
+    # EXIF of the original upload, parsed once from the header (the stored JPEGs are
+    # re-encoded without it). Every column is optional, phones and editors leave gaps
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), primary_key=True)
+    camera = db.Column(db.String(100), nullable=True)       # "Canon EOS R5"
+    lens = db.Column(db.String(100), nullable=True)
+    aperture = db.Column(db.Float, nullable=True)           # f-number
+    shutter = db.Column(db.Float, nullable=True)            # exposure time, seconds
+    iso = db.Column(db.Integer, nullable=True)
+    focal_length = db.Column(db.Float, nullable=True)       # mm, as shot (not 35mm equivalent)
+    taken_at = db.Column(db.DateTime, nullable=True)        # camera clock, no timezone
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    # Copy of Photo.upload_date, NULL until the photo is ready. Filters and facet counts
+    # page/count on this table alone, unfinished uploads never show up in them
+    upload_date = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_photo_exif_camera', 'camera', 'upload_date', 'photo_id'),
+        db.Index('ix_photo_exif_lens', 'lens', 'upload_date', 'photo_id'),
+        db.Index('ix_photo_exif_upload_date', 'upload_date', 'photo_id'),
+        db.Index('ix_photo_exif_focal_length', 'focal_length', 'upload_date'),
+        db.Index('ix_photo_exif_aperture', 'aperture', 'upload_date'),
+        db.Index('ix_photo_exif_iso', 'iso', 'upload_date'),
+        db.Index('ix_photo_exif_taken_at', 'taken_at', 'upload_date'),
+    )
+
+class PhotoFeatures(db.Model):
+    __tablename__ = 'photo_features'
+
+    # Inputs for "related photos" (related.py), one row per ready photo.
+    # histogram: 4x4x4 RGB colour bins from the image worker, sqrt(share) * 255 as 64 bytes.
+    # vector: the photo's float16 feature vector, cell: which cluster it was filed under
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), primary_key=True)
+    histogram = db.Column(db.LargeBinary, nullable=True)
+    vector = db.Column(db.LargeBinary, nullable=True)
+    cell = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_photo_features_cell', 'cell', 'photo_id'),
+    )
+
+class RelatedPhoto(db.Model):
+    __tablename__ = 'related_photos'
+
+    # Top-K most similar photos per photo, written by the batch build and topped up on
+    # upload. The photo page reads them with one range scan on (photo_id, score)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('photos.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)                # cosine similarity, 0..1
+
+    __table_args__ = (
+        db.Index('ix_related_photos_photo_score', 'photo_id', 'score'),
+        db.Index('ix_related_photos_related_id', 'related_id'),
+    )
+
+class RelatedCell(db.Model):
+    __tablename__ = 'related_cells'
+
+    # Cluster centres from the last batch build, new uploads are only compared with the
+    # photos filed under their nearest few
+    cell = db.Column(db.Integer, primary_key=True)
+    centroid = db.Column(db.LargeBinary, nullable=False)       # float32 vector
+
+class FeedEntry(db.Model):
+    __tablename__ = 'feed_entries'
+    
+    # One row per (reader, photo). Filled on upload/follow by feed.py, trimmed to a fixed size
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), primary_key=True, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Copy of Photo.upload_date so paging never has to touch the photos table
+    upload_date = db.Column(db.DateTime, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_feed_entries_user_date', 'user_id', 'upload_date', 'photo_id'),
+        db.Index('ix_feed_entries_user_author', 'user_id', 'author_id'),
+    )
+
+class Tag(db.Model):
+    __tablename__ = 'tags'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    photo_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    # log2 of the time-decayed popularity, see tags.py for the math
+    # NULL once the last photo using the tag is gone
+    trend_score = db.Column(db.Float, nullable=True, index=True)
+
 class Comment(db.Model):
     __tablename__ = 'comments'
     
@@ -98,11 +231,26 @@ class Comment(db.Model):
     
     # Foreign Keys
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), nullable=False)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), nullable=False, index=True)
     
     # Relationship to user who wrote the comment
     user = db.relationship('User', backref='comments')
 
+    # The photo page pages through a photo's comments newest first
+    __table_args__ = (
+        db.Index('ix_comments_photo_timestamp', 'photo_id', 'timestamp', 'id'),
+    )
+
+# Comment count computed in SQL instead of loading photo.comments just to call len() on it.
+# Deferred, so use undefer(Photo.comment_count) in grid queries to fetch it in the same SELECT.
+Photo.comment_count = db.column_property(
+    db.select(db.func.count(Comment.id))
+    .where(Comment.photo_id == Photo.id)
+    .correlate_except(Comment)
+    .scalar_subquery(),
+    deferred=True
+)
+
 class Message(db.Model):
     __tablename__ = 'messages'
     
@@ -112,10 +260,143 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     read = db.Column(db.Boolean, default=False) # Seen zone feature!
+    delivered_at = db.Column(db.DateTime, nullable=True)   # Reached the recipient's browser
+    client_id = db.Column(db.String(64), nullable=True)    # Sender-generated, makes resends safe
     
     # Relationships
     # DMs going back and forth
     sender = db.relationship('User', foreign_keys=[sender_id], backref=db.backref('sent_messages', lazy='dynamic'))
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref=db.backref('received_messages', lazy='dynamic'))
+    
+    # Covers both directions of a chat: (a -> b) and (b -> a), newest last.
+    # The partial index only holds unread rows, so read-marking never walks the whole history
+    __table_args__ = (
+        db.Index('ix_messages_sender_recipient_timestamp', 'sender_id', 'recipient_id', 'timestamp', 'id'),
+        db.Index('ix_messages_unread', 'recipient_id', 'sender_id',
+                 sqlite_where=db.text('read = 0'), postgresql_where=db.text('read = false')),
+        # A retried send finds its first attempt instead of creating a duplicate (NULLs don't clash)
+        db.Index('ix_messages_sender_client_id', 'sender_id', 'client_id', unique=True),
+    )
+
+class Conversation(db.Model):
+    __tablename__ = 'conversations'
+    
+    # Inbox summary, one row per participant per chat (so two rows per pair).
+    # Kept up to date by messaging.py whenever a message is sent or read
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    other_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=False)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    
+    other_user = db.relationship('User', foreign_keys=[other_user_id])
+    last_message = db.relationship('Message')
+    
+    # The inbox is "my conversations, most recent first"
+    __table_args__ = (
+        db.Index('ix_conversations_user_updated', 'user_id', 'updated_at', 'other_user_id'),
+    )
+
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+
+    # Profile/dashboard totals, one row per user. Moved by stats.py from the write paths
+    # (photo ready/deleted, likes, buffered views, follows) instead of summing every photo
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    photo_count = db.Column(db.Integer, default=0, nullable=False)     # ready photos only
+    total_views = db.Column(db.Integer, default=0, nullable=False)
+    total_likes = db.Column(db.Integer, default=0, nullable=False)
+    follower_count = db.Column(db.Integer, default=0, nullable=False)
+    following_count = db.Column(db.Integer, default=0, nullable=False)
+
+class Suggestion(db.Model):
+    __tablename__ = 'suggestions'
+
+    # "Suggested photographers": accounts followed by people you follow, scored by how
+    # many of them do. Rebuilt in bulk by graph.rebuild_suggestions(), never per request
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    score = db.Column(db.Integer, default=0, nullable=False)   # mutual connections
+
+    suggested = db.relationship('User', foreign_keys=[suggested_id])
+
+class PhotoEvent(db.Model):
+    __tablename__ = 'photo_events'
+
+    # Append-only raw view/like events, written in batches by analytics.EventBuffer.
+    # The rollup job folds them into analytics_rollups and prunes old ones
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)          # 'view', 'like' or 'unlike'
+    photo_id = db.Column(db.Integer, nullable=False)         # no FK, events outlive deleted photos
+    owner_id = db.Column(db.Integer, nullable=False)         # the photographer, for per-user rollups
+    referrer = db.Column(db.String(100), nullable=True)      # external host, internal page or NULL (direct)
+    occurred_at = db.Column(db.DateTime, nullable=False)
+    recorded_at = db.Column(db.DateTime, nullable=True)      # when flush() wrote it, rollup waits for it to settle
+
+class AnalyticsRollup(db.Model):
+    __tablename__ = 'analytics_rollups'
+
+    # Views/likes per hour and per day, for every photo and every photographer.
+    # A range query is an index range scan over one (scope, scope_id, granularity)
+    scope = db.Column(db.String(10), primary_key=True)       # 'photo' or 'user'
+    scope_id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), primary_key=True) # 'hour' or 'day'
+    bucket = db.Column(db.DateTime, primary_key=True)        # UTC start of the hour/day
+    views = db.Column(db.Integer, default=0, nullable=False)
+    likes = db.Column(db.Integer, default=0, nullable=False) # net, unlikes count as -1
+
+class ReferrerRollup(db.Model):
+    __tablename__ = 'referrer_rollups'
+
+    # Daily views per photographer per referrer
+    user_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.DateTime, primary_key=True)
+    referrer = db.Column(db.String(100), primary_key=True)
+    views = db.Column(db.Integer, default=0, nullable=False)
+
+class RollupWatermark(db.Model):
+    __tablename__ = 'rollup_watermarks'
+
+    # Last photo_events.id folded into the rollups
+    name = db.Column(db.String(50), primary_key=True)
+    last_event_id = db.Column(db.Integer, default=0, nullable=False)
+
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+
+    # One row per content-addressed file in storage.py (ab/cd/<sha256>.<ext>).
+    # refcount = how many photo/avatar renditions point at it, 0 = garbage after a grace period
+    key = db.Column(db.String(100), primary_key=True)
+    refcount = db.Column(db.Integer, default=0, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_stored_files_refcount_updated', 'refcount', 'updated_at'),
+    )
+
+class ContentVersion(db.Model):
+    __tablename__ = 'content_versions'
+
+    # Bumped by every write that changes what a public page shows ('photos',
+    # 'user:3', 'photo:42'). ETags and fragment cache keys are built from these
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class SocketConnection(db.Model):
+    __tablename__ = 'socket_connections'
+
+    # One row per live Socket.IO connection, shared by every worker process.
+    # Each node refreshes last_seen for its own rows, so a crashed node's rows just expire
+    sid = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    node = db.Column(db.String(120), nullable=False, index=True)
+    connected_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_socket_connections_user_seen', 'user_id', 'last_seen'),
+    )
 
 # All models done! Database ready hai.
\ No newline at end of file
@@ -0,0 +1,52 @@
+import base64
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# Keyset (a.k.a. seek) pagination helpers.
+# OFFSET pagination gets slower the deeper you scroll, seek pagination doesn't.
+# We always order by (timestamp, id) so ties on the timestamp never skip rows.
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything we didn't hand out ourselves
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        stamp, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(stamp), int(row_id)
+    except (UnicodeDecodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def keyset_page(query, time_col, id_col, cursor=None, limit=24, key=None):
+    """
+    Returns the next `limit` rows of `query`, newest first, after `cursor`.
+    `key` maps a result row to its (timestamp, id) pair; defaults to reading
+    the two columns off an ORM object.
+    """
+    if cursor:
+        stamp, row_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            time_col < stamp,
+            and_(time_col == stamp, id_col < row_id)
+        ))
+
+    # Fetch one extra row so we know whether another page exists without a COUNT
+    rows = query.order_by(time_col.desc(), id_col.desc()).limit(limit + 1).all()
+    items = rows[:limit]
+
+    next_cursor = None
+    if len(rows) > limit:
+        if key is None:
+            key = lambda row: (getattr(row, time_col.key), getattr(row, id_col.key))
+        next_cursor = encode_cursor(*key(items[-1]))
+
+    return Page(items, next_cursor)
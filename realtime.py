@@ -0,0 +1,241 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+import socketio
+from sqlalchemy import delete, func, insert, select, update
+from models import db, SocketConnection
+
+# --- SOCKET.IO ACROSS PROCESSES ---
+# Rooms like user_{id} live in the memory of whichever process holds the socket, so with
+# more than one worker an emit from chat() only reached people connected to that same worker.
+# With SOCKETIO_MESSAGE_QUEUE set, every emit goes through a shared queue and each
+# worker delivers it to its own clients:
+#   redis://, rediss://, amqp://, kafka://, zmq+tcp://   -> the backends python-socketio ships
+#   local://host:port                                    -> LocalBroker below, no extra services
+
+DEFAULT_BROKER_PORT = 5599
+
+
+def queue_options(url, channel='flask-socketio'):
+    """Extra SocketIO(...) kwargs for the configured message queue (empty = single process)."""
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalBrokerManager(url, channel=channel)}
+    return {'message_queue': url, 'channel': channel}
+
+
+def _address(url):
+    parsed = urlparse(url)
+    return parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_BROKER_PORT
+
+
+# --- LOCAL BROKER ---
+# A tiny TCP pub/sub hub: newline separated JSON, every published line goes out to
+# every subscriber. Good enough for dev, tests and the bench, use Redis in production.
+class _BrokerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        role = self.rfile.readline().strip()
+        if role == b'SUB':
+            self.server.subscribe(self.wfile)
+            try:
+                # Subscribers never talk again, this just waits for them to hang up
+                while self.rfile.readline():
+                    pass
+            finally:
+                self.server.unsubscribe(self.wfile)
+            return
+
+        for line in self.rfile:
+            self.server.publish(line)
+
+
+class LocalBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_BROKER_PORT):
+        super().__init__((host, port), _BrokerHandler)
+        self._subscribers = {}   # wfile -> lock
+        self._lock = threading.Lock()
+
+    def subscribe(self, wfile):
+        with self._lock:
+            self._subscribers[wfile] = threading.Lock()
+
+    def unsubscribe(self, wfile):
+        with self._lock:
+            self._subscribers.pop(wfile, None)
+
+    def publish(self, line):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for wfile, lock in subscribers:
+            try:
+                with lock:
+                    wfile.write(line)
+                    wfile.flush()
+            except OSError:
+                self.unsubscribe(wfile)
+
+    def start(self):
+        # Runs in a daemon thread, handy for tests and benches
+        thread = threading.Thread(target=self.serve_forever, daemon=True, name='socket-broker')
+        thread.start()
+        return thread
+
+
+class LocalBrokerManager(socketio.PubSubManager):
+    """python-socketio client manager that talks to a LocalBroker."""
+    name = 'local'
+
+    def __init__(self, url=f'local://127.0.0.1:{DEFAULT_BROKER_PORT}', channel='flask-socketio',
+                 write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.address = _address(url)
+        self._pub = None
+        self._pub_lock = threading.Lock()
+
+    def _socket_module(self):
+        # Under eventlet a plain blocking socket would freeze the whole hub
+        if self.server is not None and self.server.async_mode == 'eventlet':
+            from eventlet.green import socket as green_socket
+            return green_socket
+        return socket
+
+    def _connect(self, role):
+        sock = self._socket_module().create_connection(self.address)
+        sock.sendall(role + b'\n')
+        return sock
+
+    def _publish(self, data):
+        line = json.dumps({'channel': self.channel, 'data': data}).encode() + b'\n'
+        with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub is None:
+                        self._pub = self._connect(b'PUB')
+                    self._pub.sendall(line)
+                    return
+                except OSError as e:
+                    self._pub = None
+                    if attempt:
+                        self._get_logger().error(f'Cannot publish to socket broker: {e}')
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(b'SUB')
+                reader = sock.makefile('rb')
+                for line in reader:
+                    message = json.loads(line)
+                    if message.get('channel') == self.channel:
+                        yield message['data']
+            except OSError as e:
+                self._get_logger().error(f'Socket broker connection lost, retrying: {e}')
+            self.server.sleep(1)
+
+
+# --- PRESENCE ---
+# Who is connected right now, shared across workers through the socket_connections table.
+# A user's first connection and last disconnection are pushed to the presence_{id} room.
+class Presence:
+
+    def __init__(self, app=None, socketio=None):
+        self.app = None
+        self.node = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._heartbeat_started = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio=None):
+        self.app = app
+        self.socketio = socketio
+        self.heartbeat = app.config.get('PRESENCE_HEARTBEAT', 30)
+        # Miss a few heartbeats and you're considered gone
+        self.ttl = timedelta(seconds=self.heartbeat * 3)
+
+    def _cutoff(self):
+        return datetime.utcnow() - self.ttl
+
+    def _live_count(self, user_id):
+        return db.session.execute(select(func.count()).select_from(SocketConnection).where(
+            SocketConnection.user_id == user_id,
+            SocketConnection.last_seen >= self._cutoff())).scalar()
+
+    def connected(self, user_id, sid):
+        now = datetime.utcnow()
+        db.session.execute(insert(SocketConnection).values(
+            sid=sid, user_id=user_id, node=self.node, connected_at=now, last_seen=now))
+        db.session.commit()
+        self._ensure_heartbeat()
+        if self._live_count(user_id) == 1:
+            self._announce(user_id, True)
+
+    def disconnected(self, sid):
+        user_id = db.session.execute(select(SocketConnection.user_id)
+                                     .where(SocketConnection.sid == sid)).scalar()
+        if user_id is None:
+            return
+        db.session.execute(delete(SocketConnection).where(SocketConnection.sid == sid))
+        db.session.commit()
+        if self._live_count(user_id) == 0:
+            self._announce(user_id, False)
+
+    def connection_count(self, user_id):
+        return self._live_count(user_id)
+
+    def is_online(self, user_id):
+        return self._live_count(user_id) > 0
+
+    def online_ids(self, user_ids):
+        """Which of these users are connected anywhere? One query for the whole list."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        return set(db.session.execute(select(SocketConnection.user_id).distinct().where(
+            SocketConnection.user_id.in_(user_ids),
+            SocketConnection.last_seen >= self._cutoff())).scalars())
+
+    def _announce(self, user_id, online):
+        if self.socketio is not None:
+            self.socketio.emit('presence', {'user_id': user_id, 'online': online},
+                               room=f"presence_{user_id}")
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat_started:
+                return
+            self._heartbeat_started = True
+        if self.socketio is not None:
+            self.socketio.start_background_task(self._run)
+        else:
+            threading.Thread(target=self._run, daemon=True, name='presence-heartbeat').start()
+
+    def beat(self):
+        with self.app.app_context():
+            try:
+                db.session.execute(update(SocketConnection)
+                                   .where(SocketConnection.node == self.node)
+                                   .values(last_seen=datetime.utcnow()))
+                # Rows from nodes that died without saying goodbye
+                db.session.execute(delete(SocketConnection)
+                                   .where(SocketConnection.last_seen < self._cutoff()))
+                db.session.commit()
+            except Exception as e:
+                print(f"Presence heartbeat failed: {e}")
+                db.session.rollback()
+
+    def _run(self):
+        sleep = self.socketio.sleep if self.socketio is not None else time.sleep
+        while True:
+            sleep(self.heartbeat)
+            self.beat()
@@ -0,0 +1,344 @@
+import math
+import zlib
+import numpy as np
+from sqlalchemy import delete, insert, select, update, bindparam
+from sqlalchemy.orm import joinedload
+import caching
+from models import db, Photo, PhotoFeatures, RelatedPhoto, RelatedCell
+from tags import parse_tags
+
+# --- RELATED PHOTOS ---
+# "More like this" under every photo. Scoring a photo against every other row on each
+# page view is hopeless at our size, so:
+#   1. every photo gets a small feature vector: hashed tags, category, photographer and
+#      a 4x4x4 colour histogram from the image worker. Each block is unit length and
+#      scaled by sqrt(weight), so a dot product is the weighted sum of the block cosines
+#   2. rebuild() clusters all vectors (spherical k-means, ~sqrt(N) cells) and compares
+#      each cell's photos with the photos of its nearest RELATED_PROBES cells in one
+#      matrix product, keeping the top RELATED_PER_PHOTO per photo in related_photos
+#   3. add() files a new upload under its nearest cells, scores it against the photos
+#      there and slips it into their lists where it beats the current last entry
+#   4. the photo page reads its list with one range scan on (photo_id, score)
+# Approximate on purpose: a neighbour filed under a cell that isn't probed is missed
+# (bench/related_bench.py reports the recall). Run `flask rebuild-related` nightly, the
+# cells drift as uploads are added to them.
+
+features = PhotoFeatures.__table__
+related = RelatedPhoto.__table__
+cells = RelatedCell.__table__
+
+TAG_DIMS = 64
+CATEGORY_DIMS = 16
+PHOTOGRAPHER_DIMS = 32
+COLOR_DIMS = 64            # imaging.color_histogram with 4 bins per channel
+# (name, width, weight), weights add up to 1
+BLOCKS = (('tags', TAG_DIMS, 0.45), ('category', CATEGORY_DIMS, 0.2),
+          ('photographer', PHOTOGRAPHER_DIMS, 0.15), ('color', COLOR_DIMS, 0.2))
+DIMS = sum(width for _, width, _ in BLOCKS)
+OFFSETS = dict(zip([name for name, _, _ in BLOCKS],
+                   np.cumsum([0] + [width for _, width, _ in BLOCKS[:-1]]).tolist()))
+
+# Scores per matrix product, keeps a (queries x candidates) block around 64 MB
+SCORE_BLOCK = 16 * 1024 * 1024
+ASSIGN_CHUNK = 65536
+
+
+# --- VECTORS ---
+
+def _bucket(kind, value, width):
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(f'{kind}:{value}'.encode()) % width
+
+
+def vectorize(rows):
+    """
+    float32 (len(rows), DIMS) from (tags, category, user_id, histogram bytes or None) rows.
+    Python only collects coordinates, the normalising is done on whole columns.
+    """
+    rows = list(rows)
+    matrix = np.zeros((len(rows), DIMS), dtype=np.float32)
+    tag_rows, tag_cols, one_rows, one_cols, color_rows, colors = [], [], [], [], [], []
+    for i, (tags, category, user_id, histogram) in enumerate(rows):
+        for tag in parse_tags(tags):
+            tag_rows.append(i)
+            tag_cols.append(OFFSETS['tags'] + _bucket('tag', tag, TAG_DIMS))
+        if category:
+            one_rows.append(i)
+            one_cols.append(OFFSETS['category'] + _bucket('category', category.strip().lower(), CATEGORY_DIMS))
+        one_rows.append(i)
+        one_cols.append(OFFSETS['photographer'] + _bucket('user', user_id, PHOTOGRAPHER_DIMS))
+        if histogram and len(histogram) == COLOR_DIMS:
+            color_rows.append(i)
+            colors.append(histogram)
+
+    # Two tags landing in the same bucket add up
+    np.add.at(matrix, (np.array(tag_rows, dtype=np.intp), np.array(tag_cols, dtype=np.intp)), 1)
+    matrix[one_rows, one_cols] = 1
+    if colors:
+        start = OFFSETS['color']
+        matrix[color_rows, start:start + COLOR_DIMS] = \
+            np.frombuffer(b''.join(colors), dtype=np.uint8).reshape(-1, COLOR_DIMS)
+
+    for name, width, weight in BLOCKS:
+        block = matrix[:, OFFSETS[name]:OFFSETS[name] + width]
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        np.divide(block, norms, out=block, where=norms > 0)
+        block *= math.sqrt(weight)
+    return matrix
+
+
+def _unpack(blobs, dtype=np.float16):
+    return np.frombuffer(b''.join(blobs), dtype=dtype).reshape(-1, DIMS).astype(np.float32)
+
+
+def _top(scores, k):
+    """Column indexes of the k best scores in each row, best first."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1)
+
+
+# --- CLUSTERING ---
+
+def nearest_cells(matrix, centroids, probes=1):
+    """(N, probes) indexes of the most similar centroids per row, done in chunks."""
+    out = np.empty((len(matrix), probes), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_CHUNK):
+        scores = matrix[start:start + ASSIGN_CHUNK].astype(np.float32) @ centroids.T
+        out[start:start + ASSIGN_CHUNK] = _top(scores, probes) if probes > 1 else scores.argmax(axis=1)[:, None]
+    return out
+
+
+def train_cells(matrix, count, iterations=4, sample_size=None, seed=0):
+    """Spherical k-means on a sample: count unit-length centroids, float32."""
+    rng = np.random.default_rng(seed)
+    count = max(1, min(count, len(matrix)))
+    sample_size = min(len(matrix), sample_size or count * 64)
+    sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))].astype(np.float32)
+    centroids = sample[rng.choice(len(sample), count, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = nearest_cells(sample, centroids)[:, 0]
+        # Sum each cell's members in one pass: sort by cell, then reduceat at the boundaries
+        order = np.argsort(assigned, kind='stable')
+        ordered = assigned[order]
+        starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        used = norms[:, 0] > 0
+        # Cells nobody picked keep their old centre
+        centroids[ordered[starts][used]] = sums[used] / norms[used]
+    return centroids
+
+
+def neighbours(matrix, per_photo, centroids, probes, assigned=None):
+    """
+    Top per_photo neighbours of every row, comparing each cell only with its `probes`
+    nearest cells. Yields (rows, neighbour_rows, scores) per block of rows, where
+    neighbour_rows/scores are (len(rows), <= per_photo) and -1 / 0 pad short lists.
+    """
+    if assigned is None:
+        assigned = nearest_cells(matrix, centroids)[:, 0]
+    order = np.argsort(assigned, kind='stable')
+    bounds = np.searchsorted(assigned[order], np.arange(len(centroids) + 1))
+    members = [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+    probes = max(1, min(probes, len(centroids)))
+    # A cell's own members always come first among its candidates
+    similar = centroids @ centroids.T
+    np.fill_diagonal(similar, np.inf)
+    probe_cells = _top(similar, probes)
+
+    for cell, rows in enumerate(members):
+        if not len(rows):
+            continue
+        candidates = np.concatenate([members[c] for c in probe_cells[cell]])
+        candidate_vectors = matrix[candidates].astype(np.float32)
+        k = min(per_photo, len(candidates) - 1)
+        step = max(1, SCORE_BLOCK // len(candidates))
+        for start in range(0, len(rows), step):
+            block = rows[start:start + step]
+            scores = matrix[block].astype(np.float32) @ candidate_vectors.T
+            # The photo itself sits at the same offset in its own cell's candidates
+            scores[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf
+            if k <= 0:
+                yield block, np.full((len(block), 0), -1), np.zeros((len(block), 0), dtype=np.float32)
+                continue
+            top = _top(scores, k)
+            best = np.take_along_axis(scores, top, axis=1)
+            found = np.where(best > 0, candidates[top], -1)
+            yield block, found, np.where(best > 0, best, 0)
+
+
+class RelatedPhotos:
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.per_photo = app.config.get('RELATED_PER_PHOTO', 12)
+        self.shown = app.config.get('RELATED_SHOWN', 6)
+        self.probes = app.config.get('RELATED_PROBES', 8)
+        self.max_candidates = app.config.get('RELATED_MAX_CANDIDATES', 50000)
+
+    # --- READS ---
+
+    def for_photo(self, photo_id, limit=None):
+        """Ready related photos with their photographers, best first. One indexed query."""
+        return (Photo.query
+                .join(RelatedPhoto, RelatedPhoto.related_id == Photo.id)
+                .filter(RelatedPhoto.photo_id == photo_id, Photo.status == 'ready')
+                .options(joinedload(Photo.photographer))
+                .order_by(RelatedPhoto.score.desc(), RelatedPhoto.related_id)
+                .limit(limit or self.shown)
+                .all())
+
+    # --- WRITES ---
+
+    def add(self, photo, histogram=None):
+        """
+        File a freshly processed photo: its own top-K, plus a place in the lists of its
+        neighbours where it scores better than their current last entry. Runs inside
+        the caller's transaction.
+        """
+        vector = vectorize([(photo.tags, photo.category, photo.user_id, histogram)])[0]
+        stored = db.session.execute(select(cells.c.cell, cells.c.centroid).order_by(cells.c.cell)).all()
+        if stored:
+            # Centroids are float32, photo vectors float16
+            ranked = _top((_unpack([row.centroid for row in stored], np.float32) @ vector)[None, :],
+                          min(self.probes, len(stored)))[0]
+            probe = [stored[i].cell for i in ranked]
+        else:
+            # No batch build yet, everything lives in cell 0
+            probe = [0]
+
+        rows = db.session.execute(
+            select(features.c.photo_id, features.c.vector)
+            .where(features.c.cell.in_(probe), features.c.vector.isnot(None), features.c.photo_id != photo.id)
+            .order_by(features.c.photo_id.desc()).limit(self.max_candidates)).all()
+
+        db.session.execute(delete(related).where(related.c.photo_id == photo.id))
+        db.session.execute(delete(features).where(features.c.photo_id == photo.id))
+        db.session.execute(insert(features).values(
+            photo_id=photo.id, histogram=histogram, cell=probe[0],
+            vector=vector.astype(np.float16).tobytes()))
+        if not rows:
+            return []
+
+        ids = np.array([row.photo_id for row in rows])
+        scores = _unpack([row.vector for row in rows]) @ vector
+        top = _top(scores[None, :], min(self.per_photo, len(ids)))[0]
+        found = [(int(ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+        if found:
+            db.session.execute(insert(related), [
+                {'photo_id': photo.id, 'related_id': other, 'score': score} for other, score in found])
+        self._offer(photo.id, found)
+        return found
+
+    def _offer(self, photo_id, found):
+        # Similarity is symmetric, so the new photo may belong in its neighbours' lists too
+        if not found:
+            return
+        lists = {}
+        for row in db.session.execute(
+                select(related.c.photo_id, related.c.related_id, related.c.score)
+                .where(related.c.photo_id.in_([other for other, _ in found]))):
+            lists.setdefault(row.photo_id, []).append((row.score, row.related_id))
+
+        changed, added, dropped = [], [], []
+        for other, score in found:
+            current = lists.get(other, [])
+            if len(current) >= self.per_photo:
+                worst = min(current)
+                if score <= worst[0]:
+                    continue
+                dropped.append({'b_photo_id': other, 'b_related_id': worst[1]})
+            added.append({'photo_id': other, 'related_id': photo_id, 'score': score})
+            changed.append(other)
+        if dropped:
+            db.session.execute(
+                delete(related).where(related.c.photo_id == bindparam('b_photo_id'),
+                                      related.c.related_id == bindparam('b_related_id')), dropped)
+        if added:
+            db.session.execute(insert(related), added)
+            caching.touch(*[f'photo:{other}' for other in changed])
+
+    def remove_photo(self, photo):
+        db.session.execute(delete(related).where(
+            (related.c.photo_id == photo.id) | (related.c.related_id == photo.id)))
+        db.session.execute(delete(features).where(features.c.photo_id == photo.id))
+
+    # --- BATCH BUILD ---
+
+    def rebuild(self, batch_size=10000, cell_count=None, seed=0):
+        """
+        Recluster every ready photo and recompute all related lists. Vectors are built
+        from photos + photo_features in keyset batches and held as float16 (~350 MB at
+        1M photos). Returns (photos, related rows stored).
+        """
+        db.session.execute(insert(features).from_select(
+            ['photo_id'],
+            select(Photo.id).where(Photo.status == 'ready',
+                                   ~select(features.c.photo_id).where(features.c.photo_id == Photo.id).exists())))
+        db.session.commit()
+
+        ids, parts, last_id = [], [], 0
+        while True:
+            batch = db.session.execute(
+                select(Photo.id, Photo.tags, Photo.category, Photo.user_id, features.c.histogram)
+                .join(features, features.c.photo_id == Photo.id)
+                .where(Photo.id > last_id, Photo.status == 'ready')
+                .order_by(Photo.id).limit(batch_size)).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            ids.extend(row.id for row in batch)
+            parts.append(vectorize((row.tags, row.category, row.user_id, row.histogram)
+                                   for row in batch).astype(np.float16))
+        if not ids:
+            return 0, 0
+        ids = np.array(ids)
+        matrix = np.concatenate(parts)
+        del parts
+
+        centroids = train_cells(matrix, cell_count or round(math.sqrt(len(ids))), seed=seed)
+        db.session.execute(delete(cells))
+        db.session.execute(insert(cells), [{'cell': i, 'centroid': centroid.tobytes()}
+                                           for i, centroid in enumerate(centroids)])
+        db.session.commit()
+
+        home = nearest_cells(matrix, centroids)[:, 0]
+        stored, pending = 0, []
+        for rows, found, scores in neighbours(matrix, self.per_photo, centroids, self.probes, home):
+            pending.append((rows, found, scores))
+            if sum(len(part[0]) for part in pending) >= batch_size:
+                stored += self._write(ids, matrix, home, pending)
+                pending = []
+        if pending:
+            stored += self._write(ids, matrix, home, pending)
+        caching.touch_all()
+        db.session.commit()
+        return len(ids), stored
+
+    def _write(self, ids, matrix, home, parts):
+        # One transaction per batch of photos: their old lists out, new lists and cells in
+        photo_ids, rows, updates = [], [], []
+        for block, found, scores in parts:
+            for row, others, row_scores in zip(block, found, scores):
+                photo_id = int(ids[row])
+                photo_ids.append(photo_id)
+                updates.append({'b_photo_id': photo_id, 'b_cell': int(home[row]),
+                                'b_vector': matrix[row].tobytes()})
+                rows.extend({'photo_id': photo_id, 'related_id': int(ids[other]), 'score': float(score)}
+                            for other, score in zip(others, row_scores) if other >= 0)
+        for start in range(0, len(photo_ids), 500):
+            db.session.execute(delete(related).where(related.c.photo_id.in_(photo_ids[start:start + 500])))
+        if rows:
+            db.session.execute(insert(related), rows)
+        db.session.execute(
+            update(features).where(features.c.photo_id == bindparam('b_photo_id'))
+            .values(cell=bindparam('b_cell'), vector=bindparam('b_vector')), updates)
+        db.session.commit()
+        return len(rows)
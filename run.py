@@ -1,36 +1,87 @@
 import os
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort
 import json
+import click
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from models import db, User, Photo, Comment, Message
+from models import db, User, Photo, PhotoExif, Comment, Message, saved_photos as saved_photos_table
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from sqlalchemy.orm import joinedload, undefer
+from pagination import keyset_page
+from tags import tag_photo, untag_photo, trending_tags, filter_by_tag, rebuild_tag_index
+import feed as timelines
 from werkzeug.utils import secure_filename
-from PIL import Image
-import pillow_heif
-
-# Register HEIF opener to handle HEIC files disguised as JPEG from iPhones
-# Apple wale hamesha alag hi chalte hain yaar... (Apple always has to be different...)
-pillow_heif.register_heif_opener()
+from datetime import datetime
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from imaging import ImagePipeline, PipelineFull, backfill_renditions, rendition_files
+from counters import CounterBuffer
+import interactions
+import messaging
+from unread import UnreadCounter
+import realtime
+from realtime import Presence, LocalBroker
+from messaging import Outbox
+from search import Search, photo_counts
+import stats as user_stats
+from stats import ChartCache
+import analytics
+from analytics import EventBuffer
+from config import load_config, configure_engine
+from instrumentation import Instrumentation
+import migrations
+import caching
+from caching import HttpCache
+from pagination import decode_cursor
+import uploads
+from uploads import UploadRequest, InvalidImage
+import graph
+from graph import SocialGraph
+import exif
+from storage import Storage
+from related import RelatedPhotos
 
 # Application Configuration
+# All settings live in config.py, pick a profile with LENS_ENV
 app = Flask(__name__)
-# Bro please don't leak this key... phat jayegi
-app.config['SECRET_KEY'] = 'your_super_secret_key_here' # Change this in production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///lens_portfolio.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+load_config(app)
+# Multipart files stream straight into INCOMING_FOLDER (see uploads.py)
+app.request_class = UploadRequest
 
-# File Upload Configuration
-UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'heic'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Initialize Plugins
 db.init_app(app)
+# WAL, busy timeout etc. on every SQLite connection
+configure_engine(app, db)
+# Query counts, template/Pillow timings, /metrics and the slow request log
+instrumentation = Instrumentation(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*",
+                    **realtime.queue_options(app.config['SOCKETIO_MESSAGE_QUEUE']))
+pipeline = ImagePipeline(app, socketio)
+counters = CounterBuffer(app, socketio)
+unread = UnreadCounter(app, socketio)
+presence = Presence(app, socketio)
+outbox = Outbox(app, socketio)
+search_index = Search(app)
+chart_cache = ChartCache(app)
+view_events = EventBuffer(app, socketio)
+# Followed/follower id sets, cached per worker (see graph.py)
+social_graph = SocialGraph(app)
+# "More like this" lists, built in batch and topped up on upload (see related.py)
+related_photos = RelatedPhotos(app)
+
+def cache_viewer():
+    # Per-viewer bits of every page besides their own content version: the unread badge
+    return (unread.get(current_user.id),)
+
+# ETags / 304s for public pages, fragment cache, immutable upload headers
+http_cache = HttpCache(app, viewer=cache_viewer)
+# Content-addressed upload storage and the /media/<key> route (see storage.py)
+media = Storage(app)
 
 # --- SOCKET.IO EVENTS ---
 # Yeh Socket magic hai for instant DMs!
@@ -40,11 +91,133 @@ def on_join(data):
         # Creating a VIP room just for this user
         room = f"user_{current_user.id}"
         join_room(room)
+        # Hand the badge its number straight away
+        emit('unread_count', {'count': unread.get(current_user.id)})
+
+@socketio.on('connect')
+def on_connect():
+    if current_user.is_authenticated:
+        presence.connected(current_user.id, request.sid)
+
+@socketio.on('disconnect')
+def on_disconnect(*args):
+    presence.disconnected(request.sid)
+
+@socketio.on('watch_presence')
+def on_watch_presence(data):
+    # Chat page wants to know when the other person comes and goes
+    try:
+        user_id = int(data.get('user_id'))
+    except (TypeError, ValueError, AttributeError):
+        return
+    join_room(f"presence_{user_id}")
+    emit('presence', {'user_id': user_id, 'online': presence.is_online(user_id)})
+
+def deliver_message(message):
+    # Zoom! Message gaya. (Zoom! Message sent.)
+    unread.adjust(message['recipient_id'], +1)
+    socketio.emit('receive_message', message, room=f"user_{message['recipient_id']}")
+
+def send_receipt(reader_id, sender_id, status, up_to_id=None):
+    # Tells the sender their messages were 'delivered' / 'read' (all of them when up_to_id is None)
+    socketio.emit('receipt', {'user_id': reader_id, 'status': status, 'up_to_id': up_to_id},
+                  room=f"user_{sender_id}")
+
+@socketio.on('send_message')
+def on_send_message(data):
+    """
+    Full-duplex DM send. The return value is the ack the client gets back.
+    `client_id` is generated by the browser, resending with the same one never duplicates.
+    """
+    if not current_user.is_authenticated:
+        return {'status': 'error', 'message': 'Please log in again.'}
+    data = data if isinstance(data, dict) else {}
+    content = str(data.get('content') or '').strip()
+    client_id = data.get('client_id')
+    try:
+        recipient_id = int(data.get('recipient_id'))
+    except (TypeError, ValueError):
+        return {'status': 'error', 'message': 'Unknown recipient.'}
+
+    if not content:
+        return {'status': 'error', 'message': 'Message is empty.'}
+    if client_id is not None and (not isinstance(client_id, str) or len(client_id) > 64):
+        return {'status': 'error', 'message': 'Invalid client id.'}
+    if recipient_id == current_user.id or db.session.get(User, recipient_id) is None:
+        return {'status': 'error', 'message': 'Unknown recipient.'}
+
+    try:
+        message, created = outbox.send(current_user.id, recipient_id, content, client_id)
+    except Exception:
+        return {'status': 'error', 'message': 'Could not send, try again.'}
+    if created:
+        deliver_message(message)
+    return {'status': 'success', 'message': message, 'duplicate': not created}
+
+@socketio.on('delivered')
+def on_delivered(data):
+    if not current_user.is_authenticated:
+        return
+    try:
+        sender_id, up_to_id = int(data['sender_id']), int(data['up_to_id'])
+    except (TypeError, ValueError, KeyError):
+        return
+    if messaging.mark_delivered(current_user.id, sender_id, up_to_id):
+        db.session.commit()
+        send_receipt(current_user.id, sender_id, 'delivered', up_to_id)
+
+@socketio.on('mark_read')
+def on_mark_read(data):
+    if not current_user.is_authenticated:
+        return
+    try:
+        sender_id, up_to_id = int(data['user_id']), int(data['up_to_id'])
+    except (TypeError, ValueError, KeyError):
+        return
+    flipped = messaging.mark_read(current_user.id, sender_id, up_to_id)
+    if flipped:
+        db.session.commit()
+        unread.adjust(current_user.id, -flipped)
+        send_receipt(current_user.id, sender_id, 'read', up_to_id)
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# --- TEMPLATE HELPERS ---
+SOURCE_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+@app.template_global()
+def media_url(filename):
+    return media.url(filename)
+
+@app.template_global()
+def photo_srcset(photo, fmt='jpeg'):
+    # "a_320.webp 320w, a_640.webp 640w, ..." for <img srcset> / <source srcset>
+    sizes = (photo.renditions or {}).get(fmt) or {}
+    return ', '.join(f"{media_url(name)} {width}w"
+                     for width, name in sorted(sizes.items(), key=lambda item: int(item[0])))
+
+@app.template_global()
+def photo_sources(photo):
+    # Modern formats first, the browser takes the first <source> it understands
+    return [(SOURCE_TYPES[fmt], photo_srcset(photo, fmt))
+            for fmt in ('avif', 'webp') if (photo.renditions or {}).get(fmt)]
+
+@app.template_global()
+def live_count(photo, field):
+    # DB value plus whatever is still sitting in the counter buffer
+    return counters.live(photo, field)
+
+@app.template_global()
+def exif_summary(photo):
+    return exif.summary(photo.exif)
+
+@app.template_global()
+def follows(user):
+    # Connect/Connected buttons, answered from the cached followed set
+    return current_user.is_authenticated and social_graph.follows(current_user.id, user.id)
+
 # --- ROUTES ---
 
 @app.route('/')
@@ -110,47 +283,118 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Pass the current user's stats to the template
-    user_photos = Photo.query.filter_by(user_id=current_user.id).order_by(Photo.upload_date.desc()).all()
-    total_views = sum(photo.views for photo in user_photos)
-    total_likes = sum(photo.likes for photo in user_photos)
-    
-    # Get user's saved photos
-    saved_photos = current_user.saved
-    
-    # Get Top 10 Photos for Chart.js
-    top_photos = Photo.query.filter_by(user_id=current_user.id).order_by(Photo.views.desc()).limit(10).all()
+    # Totals come from user_stats, the grid is one page of photos at a time
+    stats = user_stats.get(current_user.id)
+    try:
+        page = keyset_page(Photo.query.filter_by(user_id=current_user.id), Photo.upload_date, Photo.id,
+                           cursor=request.args.get('cursor'), limit=app.config['DASHBOARD_PAGE_SIZE'])
+    except ValueError:
+        return redirect(url_for('dashboard'))
     
-    # Safely convert to JSON strings for embedding in script tag
-    labels = json.dumps([p.title for p in top_photos])
-    views_data = json.dumps([p.views for p in top_photos])
-    likes_data = json.dumps([p.likes for p in top_photos])
+    # Latest few saved photos, not the whole collection
+    saved_photos = (Photo.query.join(saved_photos_table, saved_photos_table.c.photo_id == Photo.id)
+                    .filter(saved_photos_table.c.user_id == current_user.id, Photo.status == 'ready')
+                    .options(joinedload(Photo.photographer))
+                    .order_by(Photo.upload_date.desc(), Photo.id.desc())
+                    .limit(app.config['DASHBOARD_SAVED_LIMIT']).all())
     
+    # The chart fetches its numbers from /api/dashboard/chart
     return render_template('dashboard.html', 
-                           photos=user_photos, 
-                           views=total_views, 
-                           likes=total_likes,
-                           saved_photos=saved_photos,
-                           top_photos_labels=labels,
-                           top_photos_views=views_data,
-                           top_photos_likes=likes_data)
+                           photos=page.items, 
+                           next_cursor=page.next_cursor,
+                           stats=stats,
+                           saved_photos=saved_photos)
+
+@app.route('/api/dashboard/chart')
+@login_required
+def api_dashboard_chart():
+    """Top 10 photos by views for the dashboard chart, cached per user."""
+    response = jsonify(chart_cache.get(current_user.id))
+    response.headers['Cache-Control'] = f"private, max-age={app.config['DASHBOARD_CHART_TTL']}"
+    return response
+@app.route('/api/analytics')
+@login_required
+def api_analytics():
+    """
+    Views/likes over time for the current user, or one of their photos:
+    /api/analytics?granularity=day|hour&start=2024-05-01&end=2024-06-01&photo_id=7
+    Defaults to the last 30 days (day) or 48 hours (hour). Read from the rollups only.
+    """
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in analytics.GRANULARITIES:
+        return jsonify({'error': 'granularity must be day or hour'}), 400
+    step = analytics.GRANULARITIES[granularity]
+    try:
+        end = (analytics.parse_time(request.args['end']) if request.args.get('end')
+               else analytics.floor_bucket(datetime.utcnow(), granularity) + step)
+        start = (analytics.parse_time(request.args['start']) if request.args.get('start')
+                 else end - step * (30 if granularity == 'day' else 48))
+    except ValueError:
+        return jsonify({'error': 'start/end must be ISO dates'}), 400
+    if not start < end:
+        return jsonify({'error': 'start must be before end'}), 400
+    if (end - start) / step > analytics.MAX_BUCKETS[granularity]:
+        return jsonify({'error': f"At most {analytics.MAX_BUCKETS[granularity]} {granularity}s per request"}), 400
+
+    photo_id = request.args.get('photo_id', type=int)
+    if photo_id is not None:
+        photo = db.session.get(Photo, photo_id)
+        if photo is None or photo.user_id != current_user.id:
+            return jsonify({'error': 'Not your photo'}), 403
+        points = analytics.series('photo', photo_id, start, end, granularity)
+    else:
+        points = analytics.series('user', current_user.id, start, end, granularity)
+
+    payload = {
+        'granularity': granularity,
+        'labels': [bucket.isoformat() for bucket, _, _ in points],
+        'views': [views for _, views, _ in points],
+        'likes': [likes for _, _, likes in points],
+    }
+    payload['totals'] = {'views': sum(payload['views']), 'likes': sum(payload['likes'])}
+    # Referrers are only tracked per photographer
+    if photo_id is None:
+        payload['referrers'] = [{'referrer': row.referrer, 'views': row.views}
+                                for row in analytics.top_referrers(current_user.id, start, end)]
+    response = jsonify(payload)
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
 # Dashboard data bhejne ka kaam khatam! (Dashboard data sending is done!)
 
-# --- SEARCH USERS ROUTE ---
+# --- SEARCH ROUTE ---
 @app.route('/search')
 @login_required
 def search():
     # Grab the search query from the URL (e.g., /search?q=Parth)
-    query = request.args.get('q', '')
+    query = request.args.get('q', '').strip()
+    per_page = app.config['SEARCH_PAGE_SIZE']
     
-    if query:
-        # ilike() makes the search case-insensitive (finds "parth", "Parth", "PARTH")
-        # The % symbols mean the query can be anywhere in the name
-        found_users = User.query.filter(User.full_name.ilike(f'%{query}%')).all()
-    else:
-        found_users = []
+    # Ranked full-text matches over names/bios and photo titles/descriptions/locations/tags,
+    # each list paged on its own (?users_page=2, ?photos_page=3)
+    users = search_index.users(query, request.args.get('users_page', 1, type=int), per_page)
+    photos = search_index.photos(query, request.args.get('photos_page', 1, type=int), per_page)
+    counts = photo_counts(user.id for user in users.items)
         
-    return render_template('search.html', users=found_users, query=query)
+    return render_template('search.html', users=users.items, users_page=users,
+                           photos=photos.items, photos_page=photos,
+                           photo_counts=counts, query=query)
+
+@app.route('/api/search/suggest')
+@login_required
+def api_search_suggest():
+    """Typeahead: a few people and photos whose words start with what's typed so far."""
+    query = request.args.get('q', '').strip()
+    if len(query) < 2:
+        # One letter matches half the index and isn't prefix-indexed, not worth it
+        return jsonify({'users': [], 'photos': []})
+    users = search_index.users(query, per_page=5, ranked=False).items
+    photos = search_index.photos(query, per_page=5, ranked=False).items
+    return jsonify({
+        'users': [{'id': user.id, 'full_name': user.full_name, 'avatar_url': avatar_url(user),
+                   'url': url_for('portfolio', user_id=user.id)} for user in users],
+        'photos': [{'id': photo.id, 'title': photo.title, 'image_url': media_url(photo.filename),
+                    'url': url_for('view_photo', photo_id=photo.id)} for photo in photos]
+    })
 
 # --- SETTINGS ROUTE ---
 @app.route('/settings', methods=['GET', 'POST'])
@@ -168,16 +412,23 @@ def settings():
             # If the user actually selected a file
             if file and file.filename != '':
                 if allowed_file(file.filename):
-                    # Secure the name and add a UUID to prevent overwriting
-                    original_filename = secure_filename(file.filename)
-                    unique_filename = f"avatar_{uuid.uuid4().hex}_{original_filename}"
+                    try:
+                        uploads.probe(file, app.config['MAX_IMAGE_PIXELS'])
+                    except InvalidImage as e:
+                        flash(str(e), 'error')
+                        return redirect(url_for('settings'))
                     
-                    # Save it to the static/uploads folder
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(file_path)
-                    
-                    # Update the database record with the new filename
-                    current_user.profile_image = unique_filename
+                    # Same workers as photos: square 64/128/256px renditions, swapped in when done
+                    ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+                    token = uuid.uuid4().hex
+                    raw_path = uploads.claim(file, os.path.join(app.config['INCOMING_FOLDER'], f"avatar-{token}{ext}"))
+                    try:
+                        pipeline.submit_avatar(current_user.id, raw_path,
+                                               os.path.join(app.config['INCOMING_FOLDER'], f"avatar_{token}.jpeg"))
+                    except PipelineFull:
+                        os.remove(raw_path)
+                        flash('We are processing a lot of uploads right now, please try the picture again in a minute.', 'error')
+                        return redirect(url_for('settings'))
                 else:
                     flash('Invalid image format for avatar. Allowed types are: png, jpg, jpeg, gif, webp, heic', 'error')
                     return redirect(url_for('settings'))
@@ -186,23 +437,59 @@ def settings():
         current_user.full_name = new_name
         current_user.bio = new_bio
         
+        profile_changed(current_user)
         db.session.commit()
         return redirect(url_for('settings'))
         
     # If it's a GET request, just render the page
     return render_template('settings.html')
 
+def profile_changed(user):
+    # Name and avatar show up on explore tiles, their own photo pages (user:<id>)
+    # and next to their comments on other people's photos
+    commented = [photo_id for (photo_id,) in
+                 db.session.query(Comment.photo_id).filter_by(user_id=user.id).distinct()]
+    caching.touch(caching.PHOTOS, f'user:{user.id}', *[f'photo:{photo_id}' for photo_id in commented])
+
+@pipeline.avatar_completed
+def avatar_processed(user, result, error):
+    if error is not None:
+        print(f"Avatar conversion failed: {error}")
+        return
+    old_files = {user.profile_image} if user.profile_image != 'default_profile.jpg' else set()
+    for sizes in (user.avatar_renditions or {}).values():
+        old_files.update(sizes.values())
+    
+    renditions = media.store_renditions(result['renditions'], result['folder'])
+    user.avatar_renditions = renditions
+    user.profile_image = renditions['jpeg'][max(renditions['jpeg'], key=int)]
+    profile_changed(user)
+    
+    # Uploads are cached as immutable, nothing will ask for the old ones again
+    media.release(old_files)
+
 @app.route('/portfolio/<int:user_id>')
 def portfolio(user_id):
     # Public masonry grid page
     user = User.query.get_or_404(user_id)
-    photos = Photo.query.filter_by(user_id=user.id).order_by(Photo.upload_date.desc()).all()
+    cursor = request.args.get('cursor')
+    try:
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError:
+        return redirect(url_for('portfolio', user_id=user_id))
+    not_modified = http_cache.validate(f'user:{user.id}')
+    if not_modified:
+        return not_modified
     
-    # Calculate total views and likes for the user
-    total_views = sum(photo.views for photo in photos)
-    total_likes = sum(photo.likes for photo in photos)
+    def load_page():
+        # Only runs when the grid isn't in the fragment cache
+        return keyset_page(Photo.query.filter_by(user_id=user.id, status='ready'), Photo.upload_date, Photo.id,
+                           cursor=cursor, limit=app.config['PORTFOLIO_PAGE_SIZE'])
     
-    return render_template('portfolio.html', user=user, photos=photos, views=total_views, likes=total_likes)
+    # Totals are kept up to date by the write paths (stats.py), no summing here
+    return render_template('portfolio.html', user=user, load_page=load_page, cursor=cursor,
+                           stats=user_stats.get(user.id))
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -221,50 +508,18 @@ def upload():
             return redirect(request.url)
             
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            from datetime import datetime
-            base, ext = os.path.splitext(filename)
-            unique_filename = f"{base}_{int(datetime.now().timestamp())}{ext}"
-            
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
-            
-            # --- REALISTIC UPGRADE: Image Compression & Resize ---
+            # Header only: real format, pixel count and EXIF, nothing decoded yet
             try:
-                img = Image.open(file_path)
-                
-                # Convert HEIC or non-RGB (like transparent PNG) to RGB
-                if img.format == 'HEIF' or img.mode != 'RGB':
-                    img = img.convert('RGB')
-                    
-                # Resize if the image is massive (e.g., limit width to 1920px for HD viewing)
-                max_width = 1920
-                if img.width > max_width:
-                    ratio = max_width / img.width
-                    new_height = int(img.height * ratio)
-                    img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                
-                # If it was an HEIC, change the extension to jpeg
-                if unique_filename.lower().endswith('.heic'):
-                    base = os.path.splitext(unique_filename)[0]
-                    new_filename = f"{base}.jpeg"
-                    new_file_path = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
-                    # Save with optimized compression
-                    img.save(new_file_path, optimize=True, quality=85)
-                    os.remove(file_path)
-                    unique_filename = new_filename
-                else:
-                    # Save with optimized compression over the original file
-                    img.save(file_path, "JPEG", optimize=True, quality=85)
-                    
-            except Exception as e:
-                print(f"Image conversion failed: {e}")
-                # Clean up the broken file
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                flash('The uploaded file appears to be corrupted or invalid.', 'error')
+                _, _, _, exif_data = uploads.probe(file, app.config['MAX_IMAGE_PIXELS'])
+            except InvalidImage as e:
+                flash(str(e), 'error')
                 return redirect(request.url)
             
+            ext = os.path.splitext(secure_filename(file.filename))[1]
+            # Everything comes out of the pipeline as JPEG (HEIC included). This is only
+            # the workers' output name, photo_processed swaps in the storage key
+            unique_filename = f"{uuid.uuid4().hex}.jpeg"
+            
             new_photo = Photo(
                 title=request.form.get('title'),
                 category=request.form.get('category'),
@@ -272,41 +527,148 @@ def upload():
                 location=request.form.get('location'),
                 tags=request.form.get('tags'),
                 filename=unique_filename,
+                status='processing',
                 user_id=current_user.id
             )
+            # Filters only see it once it's ready (photo_processed sets upload_date)
+            new_photo.exif = PhotoExif(**exif_data)
             db.session.add(new_photo)
             db.session.commit()
             
-            flash('Photo uploaded successfully!', 'success')
+            # Park the raw file and let the image workers do the heavy lifting
+            # (already on disk, this is a rename)
+            raw_path = uploads.claim(file, os.path.join(app.config['INCOMING_FOLDER'], f"{new_photo.id}{ext.lower()}"))
+            
+            try:
+                pipeline.submit(new_photo.id, raw_path,
+                                os.path.join(app.config['INCOMING_FOLDER'], unique_filename))
+            except PipelineFull:
+                # Bhai server pe bahut load hai (Server is swamped right now)
+                os.remove(raw_path)
+                db.session.delete(new_photo)
+                db.session.commit()
+                flash('We are processing a lot of uploads right now, please try again in a minute.', 'error')
+                return redirect(request.url)
+            
+            flash('Photo uploaded! It will show up as soon as processing finishes.', 'success')
             return redirect(url_for('dashboard'))
         else:
             flash('Allowed file types are png, jpg, jpeg, gif, webp', 'error')
             
     return render_template('upload.html')
 
+@pipeline.completed
+def photo_processed(photo, result, error):
+    if error is not None:
+        print(f"Image conversion failed: {error}")
+        photo.status = 'failed'
+    else:
+        instrumentation.record_image(result['seconds'])
+        photo.status = 'ready'
+        # Outputs move from incoming/ into storage, identical files are kept once
+        photo.renditions = media.store_renditions(result['renditions'], result['folder'])
+        photo.filename = photo.renditions['jpeg'][max(photo.renditions['jpeg'], key=int)]
+        user_stats.bump(photo.user_id, photo_count=1)
+        # Only now does the photo go public: tags, trending and followers' feeds
+        tag_photo(photo)
+        if photo.exif is not None:
+            photo.exif.upload_date = photo.upload_date
+        # Its own related list, and a spot in its neighbours' lists where it scores higher
+        related_photos.add(photo, result.get('histogram'))
+        db.session.flush()
+        timelines.fan_out_photo(photo)
+        caching.touch_photo(photo)
+    
+    # No request here to build URLs with, the client asks the status endpoint for those
+    socketio.emit('photo_status', {'photo_id': photo.id, 'status': photo.status},
+                  room=f"user_{photo.user_id}")
+
+@app.route('/api/photos/<int:photo_id>/status')
+@login_required
+def photo_status(photo_id):
+    photo = Photo.query.get_or_404(photo_id)
+    if photo.user_id != current_user.id:
+        return jsonify({'error': 'Not your photo'}), 403
+        
+    payload = {'photo_id': photo.id, 'status': photo.status}
+    if photo.status == 'ready':
+        payload['image_url'] = media_url(photo.filename)
+    return jsonify(payload)
+
 @app.route('/photo/<int:photo_id>')
 def view_photo(photo_id):
-    photo = Photo.query.get_or_404(photo_id)
-    # Increment view count
-    photo.views += 1
-    db.session.commit()
+    # Photographer, EXIF and the comment count come with the photo row, one SELECT
+    photo = (Photo.query
+             .options(joinedload(Photo.photographer), joinedload(Photo.exif), undefer(Photo.comment_count))
+             .filter(Photo.id == photo_id)
+             .first_or_404())
+    # Still cooking in the image workers, only the owner gets to peek
+    if photo.status != 'ready' and not (current_user.is_authenticated and photo.user_id == current_user.id):
+        abort(404)
+    # Increment view count (buffered, flushed as views = views + n)
+    counters.incr(photo.id, 'views')
+    # ...and as an event for the per-day analytics, with where the viewer came from
+    view_events.record('view', photo.id, photo.user_id,
+                       analytics.referrer_label(request.referrer, request.host))
+    # A revalidation still counts as a view, only the rendering is skipped
+    not_modified = http_cache.validate(f'photo:{photo.id}', f'user:{photo.user_id}')
+    if not_modified:
+        return not_modified
     
-    # Check if current user saved this photo
-    is_saved = False
-    if current_user.is_authenticated:
-        is_saved = photo in current_user.saved
+    # Has the current user liked/saved this photo (one query for both)
+    liked, saved = interactions.viewer_state(current_user, [photo.id])
+    # Precomputed by related.py, one range scan with the photographers joined
+    related = related_photos.for_photo(photo.id)
+    # Newest comments with their authors, older ones come from api_photo_comments
+    comments = interactions.comments_page(photo.id, limit=app.config['COMMENTS_PAGE_SIZE'])
         
-    return render_template('photo.html', photo=photo, is_saved=is_saved)
+    return render_template('photo.html', photo=photo, is_saved=photo.id in saved, is_liked=photo.id in liked,
+                           related=related, comments=comments.items, comments_cursor=comments.next_cursor)
+
+@app.route('/api/photos/<int:photo_id>/comments')
+def api_photo_comments(photo_id):
+    """
+    Older comments for the photo page, newest first.
+    Pass the `next_cursor` from the previous response (or the page) as `cursor`.
+    """
+    photo = Photo.query.get_or_404(photo_id)
+    if photo.status != 'ready' and not (current_user.is_authenticated and photo.user_id == current_user.id):
+        abort(404)
+    try:
+        page = interactions.comments_page(photo.id, request.args.get('cursor'),
+                                          limit=app.config['COMMENTS_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+        
+    return jsonify({
+        'comments': [serialize_comment(comment) for comment in page.items],
+        'next_cursor': page.next_cursor
+    })
 
 from flask import jsonify
 
 @app.route('/like/<int:photo_id>', methods=['POST'])
 @login_required
 def like_photo(photo_id):
+    # Toggle: like once, click again to unlike. One row per user per photo
     photo = Photo.query.get_or_404(photo_id)
-    photo.likes += 1
-    db.session.commit()
-    return jsonify({'status': 'success', 'new_likes': photo.likes})
+    liked, likes = interactions.toggle_like(current_user.id, photo.id)
+    view_events.record('like' if liked else 'unlike', photo.id, photo.user_id)
+    return jsonify({'status': 'success', 'liked': liked, 'new_likes': likes})
+
+@app.route('/api/photos/state')
+@login_required
+def api_photo_state():
+    """
+    Batched liked/saved lookup for grids: /api/photos/state?ids=1,2,3
+    """
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'ids must be comma-separated integers'}), 400
+        
+    liked, saved = interactions.viewer_state(current_user, ids)
+    return jsonify({'liked': sorted(liked), 'saved': sorted(saved)})
 
 # --- COMMENT ROUTE ---
 # Comments daalne ke liye function (Function to drop some comments)
@@ -314,16 +676,24 @@ def like_photo(photo_id):
 @login_required
 def comment_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    content = request.form.get('content')
+    wants_json = request.headers.get('Accept') == 'application/json' or request.is_json
+    content = (request.get_json(silent=True) or {}).get('content') if request.is_json else request.form.get('content')
     
     if content and content.strip():
         # Acha comment haina?
-        new_comment = Comment(content=content, user_id=current_user.id, photo_id=photo.id)
-        db.session.add(new_comment)
-        db.session.commit()
+        new_comment = interactions.add_comment(current_user.id, photo.id, content)
+        if wants_json:
+            # The page prepends it, no redirect and re-render of the whole photo page
+            return jsonify({
+                'status': 'success',
+                'comment': serialize_comment(new_comment),
+                'comment_count': interactions.comment_count(photo.id)
+            })
         flash('Comment added successfully!', 'success')
     else:
         # Khali comment nahi chalega re baba
+        if wants_json:
+            return jsonify({'status': 'error', 'message': 'Comment cannot be empty.'}), 400
         flash('Comment cannot be empty.', 'error')
         
     return redirect(url_for('view_photo', photo_id=photo.id))
@@ -334,15 +704,9 @@ def comment_photo(photo_id):
 def save_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     
-    if photo in current_user.saved:
-        current_user.saved.remove(photo)
-        status = 'unsaved'
-    else:
-        current_user.saved.append(photo)
-        status = 'saved'
-        
-    db.session.commit()
-    return jsonify({'status': 'success', 'action': status})
+    # Straight to the association table, no loading the whole saved list
+    saved = interactions.toggle_save(current_user.id, photo.id)
+    return jsonify({'status': 'success', 'action': 'saved' if saved else 'unsaved'})
 
 # --- CONNECT ROUTE ---
 @app.route('/connect/<int:user_id>')
@@ -353,8 +717,12 @@ def connect_user(user_id):
     if user_to_connect == current_user:
         return redirect(url_for('portfolio', user_id=user_id))
         
-    current_user.connect(user_to_connect)
-    db.session.commit()
+    # Unique edge, a second click (or a racing request) changes nothing
+    if social_graph.follow(current_user.id, user_to_connect.id):
+        timelines.on_follow(current_user, user_to_connect)
+        user_stats.followed(current_user.id, user_to_connect.id)
+        caching.touch(f'user:{current_user.id}', f'user:{user_to_connect.id}')
+        db.session.commit()
     
     return redirect(url_for('portfolio', user_id=user_id))
 
@@ -364,8 +732,11 @@ def connect_user(user_id):
 def disconnect_user(user_id):
     user_to_disconnect = User.query.get_or_404(user_id)
     
-    current_user.disconnect(user_to_disconnect)
-    db.session.commit()
+    if social_graph.unfollow(current_user.id, user_to_disconnect.id):
+        timelines.on_unfollow(current_user, user_to_disconnect)
+        user_stats.followed(current_user.id, user_to_disconnect.id, -1)
+        caching.touch(f'user:{current_user.id}', f'user:{user_to_disconnect.id}')
+        db.session.commit()
     
     return redirect(url_for('portfolio', user_id=user_id))
 
@@ -381,12 +752,17 @@ def delete_photo(photo_id):
         return "You do not have permission to delete this photo.", 403
         
     try:
-        # Delete file from filesystem
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], photo.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # One reference less to the file and its renditions, `flask gc-storage` removes
+        # whatever no other photo or avatar shares
+        media.release(rendition_files(photo))
             
-        # Delete from database
+        # Delete from database (tag scores first, they need the upload date)
+        untag_photo(photo)
+        timelines.remove_photo(photo)
+        interactions.remove_photo(photo)
+        related_photos.remove_photo(photo)
+        user_stats.photo_removed(photo)
+        caching.touch_photo(photo)
         db.session.delete(photo)
         db.session.commit()
         flash('Photo deleted successfully.', 'success')
@@ -402,6 +778,11 @@ def delete_photo(photo_id):
 def page_not_found(e):
     return render_template('404.html'), 404
 
+@app.errorhandler(413)
+def request_too_large(e):
+    flash(f"That file is too big, uploads are limited to {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'error')
+    return redirect(request.url)
+
 @app.errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
@@ -410,71 +791,142 @@ def internal_server_error(e):
 @app.route('/feed')
 @login_required
 def feed():
-    # 1. Get a list of IDs for everyone the current user follows
-    followed_ids = [u.id for u in current_user.followed]
-    
-    # 2. Add the current user's own ID so their photos show up in their feed too
-    followed_ids.append(current_user.id)
-    
-    # 3. Query the Photo table for any photo belonging to these IDs, newest first
-    feed_photos = Photo.query.filter(Photo.user_id.in_(followed_ids)).order_by(Photo.upload_date.desc()).all()
+    # Timeline rows are written at upload/follow time (see feed.py),
+    # so this is one query for the page and one for the followed set
+    try:
+        page = timelines.feed_page(current_user, request.args.get('cursor'),
+                                   limit=app.config['FEED_PAGE_SIZE'])
+    except ValueError:
+        return redirect(url_for('feed'))
     
-    return render_template('feed.html', photos=feed_photos)
+    liked_ids, _ = interactions.viewer_state(current_user, [photo.id for photo in page.items])
+    followed_ids = social_graph.follows_many(current_user.id, {photo.user_id for photo in page.items})
+    # Precomputed by `flask rebuild-suggestions`, only the first page shows them
+    suggestions = []
+    if not request.args.get('cursor'):
+        suggestions = graph.suggested_for(current_user.id, exclude=social_graph.followed(current_user.id),
+                                          limit=app.config['SUGGESTIONS_SHOWN'])
+    follower_counts = social_graph.counts([s.suggested_id for s in suggestions])
+    return render_template('feed.html', photos=page.items, next_cursor=page.next_cursor,
+                           followed_ids=followed_ids, liked_ids=liked_ids,
+                           suggestions=suggestions, follower_counts=follower_counts)
 
 # --- EXPLORE ROUTE ---
+def explore_page(cursor=None, tag=None, filters=None):
+    # One SELECT per page: photographer joined in, comment count as a subquery
+    query = (Photo.query.filter(Photo.status == 'ready')
+             .options(joinedload(Photo.photographer), undefer(Photo.comment_count)))
+    if tag:
+        query = filter_by_tag(query, tag)
+    if filters:
+        # EXIF filters page on photo_exif's own (facet, upload_date, photo_id) indexes
+        return keyset_page(exif.filter_photos(query, filters), PhotoExif.upload_date, PhotoExif.photo_id,
+                           cursor=cursor, limit=app.config['EXPLORE_PAGE_SIZE'],
+                           key=lambda photo: (photo.upload_date, photo.id))
+    return keyset_page(query, Photo.upload_date, Photo.id,
+                       cursor=cursor, limit=app.config['EXPLORE_PAGE_SIZE'])
+
+@app.template_global()
+def avatar_url(user, size=None):
+    if user.profile_image == 'default_profile.jpg':
+        return 'https://images.unsplash.com/photo-1500648767791-00dcc994a43e?q=80&w=150&auto=format&fit=crop'
+    # Smallest square rendition that still covers `size` px (avatars from before renditions have none)
+    sizes = (user.avatar_renditions or {}).get('jpeg') or {}
+    if size and sizes:
+        fits = [int(width) for width in sizes if int(width) >= size]
+        return media_url(sizes[str(min(fits) if fits else max(map(int, sizes)))])
+    return media_url(user.profile_image)
+
+def serialize_photo(photo):
+    # JSON shape used by the infinite-scroll grids
+    return {
+        'id': photo.id,
+        'title': photo.title,
+        'url': url_for('view_photo', photo_id=photo.id),
+        'image_url': media_url(photo.filename),
+        'srcset': photo_srcset(photo),
+        'sources': [{'type': mime, 'srcset': srcset} for mime, srcset in photo_sources(photo)],
+        'likes': photo.likes,
+        'comment_count': photo.comment_count,
+        'photographer': {
+            'id': photo.photographer.id,
+            'full_name': photo.photographer.full_name,
+            'url': url_for('portfolio', user_id=photo.photographer.id),
+            'avatar_url': avatar_url(photo.photographer, 64)
+        }
+    }
+
+def serialize_comment(comment):
+    # JSON shape for comments posted or paged in by the photo page
+    return {
+        'id': comment.id,
+        'content': comment.content,
+        'timestamp': comment.timestamp.strftime('%b %d, %H:%M'),
+        'user': {
+            'id': comment.user.id,
+            'full_name': comment.user.full_name,
+            'url': url_for('portfolio', user_id=comment.user.id),
+            'avatar_url': avatar_url(comment.user, 64)
+        }
+    }
+
 @app.route('/explore')
 def explore():
-    # Get all photos globally
-    photos = Photo.query.order_by(Photo.upload_date.desc()).all()
-    
-    # Extract unique tags across all photos to generate trending tags
-    all_tags = set()
-    for photo in photos:
-        if photo.tags:
-            # Assuming tags are comma-separated strings
-            tags_list = [t.strip().lower() for t in photo.tags.split(',') if t.strip()]
-            all_tags.update(tags_list)
-            
-    # Convert set back to sorted list for the template
-    trending_tags = sorted(list(all_tags))
+    active_tag = request.args.get('tag', '').strip().lower() or None
+    filters = exif.parse_filters(request.args)
+    cursor = request.args.get('cursor')
+    try:
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError:
+        return redirect(url_for('explore', tag=active_tag, **filters))
+    not_modified = http_cache.validate(caching.PHOTOS)
+    if not_modified:
+        return not_modified
     
     # Basic categories we want to always show
     categories = ['Landscape', 'Portrait', 'Architecture', 'Nature', 'Street', 'Abstract']
     
-    return render_template('explore.html', photos=photos, trending_tags=trending_tags, categories=categories)
+    # The grid, the trending tags and the EXIF facets are fragment cached, these only run on a miss
+    return render_template('explore.html', load_page=lambda: explore_page(cursor, tag=active_tag, filters=filters),
+                           load_trending=lambda: trending_tags(10),
+                           load_facets=lambda: exif.facets(filters, tag=active_tag), cursor=cursor,
+                           active_tag=active_tag, filters=filters, categories=categories)
 # Explore logic done. Ab photo dhundho mst! (Explore logic done. Now browse awesome photos!)
 
+@app.route('/api/explore')
+def api_explore():
+    """
+    Infinite scroll endpoint for the Explore grid.
+    Pass the `next_cursor` from the previous response as `cursor`.
+    """
+    try:
+        page = explore_page(request.args.get('cursor'), tag=request.args.get('tag') or None,
+                            filters=exif.parse_filters(request.args))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+        
+    return jsonify({
+        'photos': [serialize_photo(photo) for photo in page.items],
+        'next_cursor': page.next_cursor
+    })
+
 # --- MESSAGES ROUTES ---
 
 @app.route('/messages')
 @login_required
 def messages_inbox():
-    # Get a list of all users the current user has sent or received messages from
-    # Complex query to find distinct users... or we can do it in Python for simplicity
-    
-    # Let's get all messages involving the current user
-    all_msgs = Message.query.filter(
-        (Message.sender_id == current_user.id) | (Message.recipient_id == current_user.id)
-    ).order_by(Message.timestamp.desc()).all()
-    
-    # Group them by the *other* user to find recent conversations
-    conversations = {}
-    for msg in all_msgs:
-        other_user = msg.recipient if msg.sender_id == current_user.id else msg.sender
-        if other_user.id not in conversations:
-            conversations[other_user.id] = {
-                'user': other_user,
-                'last_message': msg,
-                'unread_count': 0
-            }
-        # Count unread messages sent TO the current user
-        if msg.recipient_id == current_user.id and not msg.read:
-            conversations[other_user.id]['unread_count'] += 1
-            
-    # Sort conversations by last message timestamp (already mostly sorted, but good to be certain)
-    sorted_convos = sorted(conversations.values(), key=lambda x: x['last_message'].timestamp, reverse=True)
+    # Conversation rows are kept current by chat(), so this is one indexed query
+    # with the other user and the last message joined in
+    try:
+        page = messaging.inbox_page(current_user, request.args.get('cursor'),
+                                    limit=app.config['INBOX_PAGE_SIZE'])
+    except ValueError:
+        return redirect(url_for('messages_inbox'))
             
-    return render_template('messages_inbox.html', conversations=sorted_convos)
+    online_ids = presence.online_ids(convo.other_user_id for convo in page.items)
+    return render_template('messages_inbox.html', conversations=page.items, next_cursor=page.next_cursor,
+                           online_ids=online_ids)
 
 
 @app.route('/messages/<int:user_id>', methods=['GET', 'POST'])
@@ -498,89 +950,266 @@ def chat(user_id):
             content = request.form.get('content')
             
         if content and content.strip():
-            new_msg = Message(sender_id=current_user.id, recipient_id=other_user.id, content=content.strip())
-            db.session.add(new_msg)
-            db.session.commit()
-            
-            
-            msg_data = {
-                'content': new_msg.content,
-                'timestamp': new_msg.timestamp.strftime('%I:%M %p'),
-                'sender_id': current_user.id
-            }
-            
-            # Emit back to recipient via web socket instantly
-            # Zoom! Message gaya. (Zoom! Message sent.)
-            socketio.emit('receive_message', msg_data, room=f"user_{other_user.id}")
+            # Same group-committed path the socket send uses
+            try:
+                message, created = outbox.send(current_user.id, other_user.id, content.strip(),
+                                               data.get('client_id') if request.is_json else None)
+            except Exception as e:
+                # Timed out waiting for the group commit, or the commit itself failed
+                print(f"Error sending message: {e}")
+                if request.headers.get('Accept') == 'application/json' or request.is_json:
+                    return jsonify({'status': 'error', 'message': 'Could not send, try again.'}), 503
+                flash("Could not send your message, please try again.", "error")
+                return redirect(url_for('chat', user_id=other_user.id))
+            if created:
+                deliver_message(message)
             
             # If the request expects JSON, return the new message data
             if request.headers.get('Accept') == 'application/json' or request.is_json:
                 return jsonify({
                     'status': 'success',
-                    'message': msg_data
+                    'message': message
                 })
             
     # Mark messages from other_user to current_user as read
-    Message.query.filter_by(sender_id=other_user.id, recipient_id=current_user.id, read=False).update({'read': True})
-    db.session.commit()
+    flipped = messaging.mark_read(current_user.id, other_user.id)
+    if flipped:
+        db.session.commit()
+        unread.adjust(current_user.id, -flipped)
+        send_receipt(current_user.id, other_user.id, 'read')
     
-    # Fetch message history
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.recipient_id == other_user.id)) |
-        ((Message.sender_id == other_user.id) & (Message.recipient_id == current_user.id))
-    ).order_by(Message.timestamp.asc()).all()
+    # Only the latest page, older ones come from the history API as you scroll up
+    page = messaging.history_page(current_user.id, other_user.id, limit=app.config['CHAT_PAGE_SIZE'])
+    messages = list(reversed(page.items))
     
-    return render_template('chat.html', other_user=other_user, messages=messages)
+    return render_template('chat.html', other_user=other_user, messages=messages, older_cursor=page.next_cursor,
+                           other_online=presence.is_online(other_user.id))
+
+@app.route('/api/messages/<int:user_id>/history')
+@login_required
+def api_message_history(user_id):
+    """
+    Older messages for the chat view, oldest first within the page.
+    Pass the `next_cursor` from the previous response (or the page) as `cursor`.
+    """
+    try:
+        page = messaging.history_page(current_user.id, user_id, request.args.get('cursor'),
+                                      limit=app.config['CHAT_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+        
+    return jsonify({
+        'messages': [messaging.message_to_dict(msg) for msg in reversed(page.items)],
+        'next_cursor': page.next_cursor
+    })
 
 @app.route('/api/messages/<int:user_id>/recent')
 @login_required
 def api_recent_messages(user_id):
     """
-    API endpoint for polling new messages.
-    Expects a timestamp parameter `since` (Unix timestamp).
+    Delta sync for the chat view: every message of the chat with an id above `after_id`,
+    oldest first. Keep calling with the returned `last_id` while `has_more` is true.
+    Used to catch up after a socket reconnect, or as a polling fallback.
     """
-    since_timestamp_str = request.args.get('since', 0)
     try:
-        since_timestamp = float(since_timestamp_str)
-        since_date = datetime.fromtimestamp(since_timestamp)
+        after_id = int(request.args.get('after_id', 0))
     except ValueError:
-        return jsonify({'error': 'Invalid timestamp'}), 400
+        return jsonify({'error': 'Invalid after_id'}), 400
         
-    # Find new messages FROM the other user TO the current user that were sent AFTER the timestamp
-    new_messages = Message.query.filter(
-        Message.sender_id == user_id,
-        Message.recipient_id == current_user.id,
-        Message.timestamp > since_date
-    ).order_by(Message.timestamp.asc()).all()
+    limit = app.config['CHAT_PAGE_SIZE']
+    new_messages = messaging.messages_after(current_user.id, user_id, after_id, limit=limit + 1)
+    has_more = len(new_messages) > limit
+    new_messages = new_messages[:limit]
     
-    # Mark them as read immediately since they are being delivered
-    if new_messages:
-        for msg in new_messages:
-            msg.read = True
+    # Mark what we're handing over as read, since it's being delivered right now
+    incoming = [msg.id for msg in new_messages if msg.sender_id == user_id]
+    flipped = messaging.mark_read(current_user.id, user_id, max(incoming)) if incoming else 0
+    messages_data = [messaging.message_to_dict(msg) for msg in new_messages]
+    # mark_read() is a bulk UPDATE, the loaded rows still say what they said before it
+    for data in messages_data:
+        if data['sender_id'] == user_id:
+            data['status'] = 'read'
+    last_id = new_messages[-1].id if new_messages else after_id
+    if flipped:
         db.session.commit()
-        
-    messages_data = [{
-        'id': msg.id,
-        'content': msg.content,
-        'timestamp': msg.timestamp.strftime('%I:%M %p'),
-        'sender_id': msg.sender_id
-    } for msg in new_messages]
+        unread.adjust(current_user.id, -flipped)
+        send_receipt(current_user.id, user_id, 'read', max(incoming))
     
-    return jsonify({'messages': messages_data})
+    return jsonify({
+        'messages': messages_data,
+        'last_id': last_id,
+        'has_more': has_more
+    })
 
 @app.context_processor
 def inject_unread_count():
     if current_user.is_authenticated:
-        count = Message.query.filter_by(recipient_id=current_user.id, read=False).count()
-        return dict(unread_messages_count=count)
+        # Cached per user (see unread.py), only hits the DB to reconcile
+        return dict(unread_messages_count=unread.get(current_user.id))
     return dict(unread_messages_count=0)
 
 
-# Create tables before first request
+# --- CLI COMMANDS ---
+# flask --app run <command>
+@app.cli.command('rebuild-tags')
+def rebuild_tags_command():
+    """Backfill photo_tags and recompute trending scores."""
+    rebuild_tag_index()
+    print('Tag index rebuilt.')
+
+@app.cli.command('process-pending')
+def process_pending_command():
+    """Finish photos stuck in 'processing' (e.g. the server died mid-upload)."""
+    pipeline.mode = 'inline'
+    for photo in Photo.query.filter_by(status='processing').all():
+        raw_files = glob.glob(os.path.join(app.config['INCOMING_FOLDER'], f"{photo.id}.*"))
+        if raw_files:
+            pipeline.submit(photo.id, raw_files[0],
+                            os.path.join(app.config['INCOMING_FOLDER'], photo.filename))
+        else:
+            photo.status = 'failed'
+            db.session.commit()
+        db.session.refresh(photo)
+        print(f"Photo {photo.id}: {photo.status}")
+
+@app.cli.command('backfill-renditions')
+def backfill_renditions_command():
+    """Generate srcset renditions for photos uploaded before they existed."""
+    done, last_id = 0, 0
+    with ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS']) as executor:
+        while True:
+            photos = (Photo.query.filter(Photo.id > last_id, Photo.status == 'ready', Photo.renditions.is_(None))
+                      .order_by(Photo.id).limit(200).all())
+            if not photos:
+                break
+            last_id = photos[-1].id
+            
+            # Workers get a local copy of the main file, the new sizes go into storage
+            copies, futures = [], []
+            for photo in photos:
+                copy = os.path.join(app.config['INCOMING_FOLDER'],
+                                    f"backfill-{uuid.uuid4().hex}{os.path.splitext(photo.filename)[1]}")
+                try:
+                    media.fetch(photo.filename, copy)
+                except OSError as e:
+                    print(f"Photo {photo.id} skipped: {e}")
+                    continue
+                copies.append((photo, copy))
+                futures.append(executor.submit(backfill_renditions, copy, app.config['RENDITION_FORMATS']))
+            for (photo, copy), future in zip(copies, futures):
+                try:
+                    renditions = future.result()
+                    main = os.path.basename(copy)
+                    os.remove(copy)
+                    new = media.store_renditions(
+                        {fmt: {width: name for width, name in sizes.items() if name != main}
+                         for fmt, sizes in renditions.items()}, app.config['INCOMING_FOLDER'])
+                    for fmt, sizes in renditions.items():
+                        for width, name in sizes.items():
+                            if name == main:
+                                new[fmt][width] = photo.filename
+                    photo.renditions = new
+                    done += 1
+                except Exception as e:
+                    print(f"Photo {photo.id} skipped: {e}")
+                    if os.path.exists(copy):
+                        os.remove(copy)
+            db.session.commit()
+    print(f"Backfilled {done} photos.")
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations_command():
+    """Rebuild the inbox summary table from the full message history."""
+    messaging.rebuild_conversations()
+    print('Conversations rebuilt.')
+
+@app.cli.command('rebuild-feeds')
+def rebuild_feeds_command():
+    """Rebuild every user's home feed timeline from the follow graph."""
+    timelines.rebuild_all_feeds()
+    print('Feed timelines rebuilt.')
+
+@app.cli.command('backfill-exif')
+def backfill_exif_command():
+    """Read camera metadata from the headers of uploads that don't have it yet."""
+    checked, found = exif.backfill(media.open)
+    print(f'Checked {checked} photos, {found} had EXIF.')
+
+@app.cli.command('gc-storage')
+@click.option('--grace', default=None, type=int, help='Seconds a file must have been unreferenced (default STORAGE_GC_GRACE).')
+def gc_storage_command(grace):
+    """Delete stored files no photo or avatar refers to anymore."""
+    removed = media.gc(grace)
+    print(f'Removed {removed} files.')
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Move old style uploads (static/uploads/<name>) into content-addressed storage."""
+    moved = media.adopt_legacy()
+    if moved:
+        # Every page with an image on it now has different URLs
+        caching.touch_all()
+        db.session.commit()
+    print(f'Moved {moved} files.')
+
+@app.cli.command('rebuild-suggestions')
+@click.option('--per-user', default=10, show_default=True, help='Suggestions stored per user.')
+def rebuild_suggestions_command(per_user):
+    """Recompute everyone's suggested photographers (friends of friends). Run it nightly."""
+    stored = graph.rebuild_suggestions(per_user=per_user)
+    print(f'Stored {stored} suggestions.')
+
+@app.cli.command('rebuild-related')
+@click.option('--cells', type=int, default=None, help='Clusters to build (default: square root of the photo count).')
+def rebuild_related_command(cells):
+    """Recompute every photo's related photos in one batch. Run it nightly."""
+    photos, stored = related_photos.rebuild(cell_count=cells)
+    print(f'Stored {stored} related photos for {photos} photos.')
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute every user's dashboard/portfolio totals from the source tables."""
+    user_stats.rebuild_all()
+    print('User stats rebuilt.')
+
+@app.cli.command('rollup-analytics')
+def rollup_analytics_command():
+    """Fold new view/like events into the analytics rollups and prune old raw events."""
+    view_events.flush()
+    rolled = analytics.rollup(settle=app.config['ANALYTICS_ROLLUP_SETTLE'])
+    pruned = analytics.prune(app.config['ANALYTICS_RAW_RETENTION_DAYS'])
+    print(f'Rolled up {rolled} events, pruned {pruned}.')
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Re-index every user and photo for full-text search."""
+    search_index.setup()
+    search_index.rebuild()
+    print('Search index rebuilt.')
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Add missing tables, columns and indexes to an existing database."""
+    ran = migrations.upgrade()
+    print(f"Applied: {', '.join(ran)}" if ran else 'Schema already up to date.')
+
+@app.cli.command('socket-broker')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=realtime.DEFAULT_BROKER_PORT, type=int)
+def socket_broker_command(host, port):
+    """Run the local Socket.IO message broker (for SOCKETIO_MESSAGE_QUEUE=local://...)."""
+    print(f'Socket broker listening on {host}:{port}')
+    LocalBroker(host, port).serve_forever()
+
+
+# Create tables (and upgrade older databases) before first request
 with app.app_context():
-    db.create_all()
-    # Ensure upload directory exists
+    migrations.upgrade()
+    # Full-text indexes + the triggers that keep them in sync
+    search_index.setup()
+    # Ensure upload directories exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['INCOMING_FOLDER'], exist_ok=True)
 
 if __name__ == '__main__':
     socketio.run(app, debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,210 @@
+import re
+from collections import namedtuple
+from sqlalchemy import func, or_, select, text
+from sqlalchemy.orm import joinedload, undefer
+from models import db, User, Photo
+
+# --- FULL-TEXT SEARCH ---
+# search() used to run full_name ILIKE '%q%' over every user with no limit, which can't
+# use an index and only ever matched names. Now users (name, bio) and photos (title,
+# description, location, tags) sit in full-text indexes, results are ranked and paged,
+# and the last word of the query matches as a prefix so typeahead works.
+#
+# Backends are pluggable through SEARCH_BACKEND:
+#   'fts5'  SQLite FTS5, synced by triggers on insert/update/delete (default on SQLite)
+#   'like'  plain LIKE scans, works on any database (the old behaviour, but paged)
+
+MAX_TERMS = 8
+MAX_PAGE = 50
+
+SearchPage = namedtuple('SearchPage', ['items', 'page', 'has_more'])
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(query):
+    return _WORD.findall(query or '')[:MAX_TERMS]
+
+
+def _in_order(model, ids, options=()):
+    # Load rows for ranked ids and put them back in rank order
+    if not ids:
+        return []
+    rows = {row.id: row for row in model.query.options(*options).filter(model.id.in_(ids))}
+    return [rows[id_] for id_ in ids if id_ in rows]
+
+
+class FTS5Backend:
+    name = 'fts5'
+
+    # External content tables: the text lives in users/photos, FTS only keeps the index
+    SCHEMA = [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+               full_name, bio, content='users', content_rowid='id',
+               tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS photos_fts USING fts5(
+               title, description, location, tags, content='photos', content_rowid='id',
+               tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+
+        """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+               INSERT INTO users_fts(rowid, full_name, bio) VALUES (new.id, new.full_name, new.bio);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+               INSERT INTO users_fts(users_fts, rowid, full_name, bio)
+               VALUES ('delete', old.id, old.full_name, old.bio);
+           END""",
+        # Only when the indexed text changes, not on every profile picture update
+        """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, bio ON users BEGIN
+               INSERT INTO users_fts(users_fts, rowid, full_name, bio)
+               VALUES ('delete', old.id, old.full_name, old.bio);
+               INSERT INTO users_fts(rowid, full_name, bio) VALUES (new.id, new.full_name, new.bio);
+           END""",
+
+        # Photos are only in the index while they're 'ready', so searches never need to
+        # join back to photos to hide uploads that are still processing
+        """CREATE TRIGGER IF NOT EXISTS photos_fts_insert AFTER INSERT ON photos
+               WHEN new.status = 'ready' BEGIN
+               INSERT INTO photos_fts(rowid, title, description, location, tags)
+               VALUES (new.id, new.title, new.description, new.location, new.tags);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS photos_fts_delete AFTER DELETE ON photos
+               WHEN old.status = 'ready' BEGIN
+               INSERT INTO photos_fts(photos_fts, rowid, title, description, location, tags)
+               VALUES ('delete', old.id, old.title, old.description, old.location, old.tags);
+           END""",
+        # Views and likes change all the time, those must not touch the index
+        """CREATE TRIGGER IF NOT EXISTS photos_fts_update
+               AFTER UPDATE OF title, description, location, tags, status ON photos BEGIN
+               INSERT INTO photos_fts(photos_fts, rowid, title, description, location, tags)
+               SELECT 'delete', old.id, old.title, old.description, old.location, old.tags
+               WHERE old.status = 'ready';
+               INSERT INTO photos_fts(rowid, title, description, location, tags)
+               SELECT new.id, new.title, new.description, new.location, new.tags
+               WHERE new.status = 'ready';
+           END""",
+    ]
+
+    # bm25 column weights, a hit in a name/title counts for more than one in a bio
+    USER_RANK = 'bm25(users_fts, 10.0, 1.0)'
+    PHOTO_RANK = 'bm25(photos_fts, 10.0, 2.0, 4.0, 6.0)'
+
+    def setup(self):
+        conn = db.session.connection()
+        existed = conn.execute(text(
+            "SELECT count(*) FROM sqlite_master WHERE name IN ('users_fts', 'photos_fts')")).scalar()
+        for statement in self.SCHEMA:
+            conn.execute(text(statement))
+        db.session.commit()
+        if existed < 2:
+            # First run on an existing database, index what's already there
+            self.rebuild()
+
+    def rebuild(self):
+        db.session.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+        # 'rebuild' would index every photo, we only want the ready ones
+        db.session.execute(text("INSERT INTO photos_fts(photos_fts) VALUES ('delete-all')"))
+        db.session.execute(text(
+            "INSERT INTO photos_fts(rowid, title, description, location, tags) "
+            "SELECT id, title, description, location, tags FROM photos WHERE status = 'ready'"))
+        db.session.commit()
+
+    @staticmethod
+    def match_expression(words):
+        # Every word must match, the last one as a prefix ("sun" finds "sunset").
+        # Words are quoted so nothing the user types is read as FTS syntax
+        quoted = ['"{}"'.format(word.replace('"', '')) for word in words]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def _ids(self, table, rank, words, limit, offset, ranked):
+        # bm25 has to score every match before it can sort. For typeahead that's too much on a
+        # short prefix, so unranked lookups take the newest matches, which FTS5 can stream in rowid order
+        order = rank if ranked else 'rowid DESC'
+        return list(db.session.execute(text(
+            f"SELECT rowid FROM {table} WHERE {table} MATCH :match "
+            f"ORDER BY {order} LIMIT :limit OFFSET :offset"), {
+                'match': self.match_expression(words), 'limit': limit, 'offset': offset}).scalars())
+
+    def user_ids(self, words, limit, offset, ranked=True):
+        return self._ids('users_fts', self.USER_RANK, words, limit, offset, ranked)
+
+    def photo_ids(self, words, limit, offset, ranked=True):
+        return self._ids('photos_fts', self.PHOTO_RANK, words, limit, offset, ranked)
+
+
+class LikeBackend:
+    name = 'like'
+
+    def setup(self):
+        pass
+
+    def rebuild(self):
+        pass
+
+    @staticmethod
+    def _all_words(columns, words):
+        # Each word has to appear in at least one of the columns
+        return [or_(*[column.ilike(f'%{word}%') for column in columns]) for word in words]
+
+    def user_ids(self, words, limit, offset, ranked=True):
+        return list(db.session.execute(
+            select(User.id).where(*self._all_words((User.full_name, User.bio), words))
+            .order_by(User.full_name, User.id).limit(limit).offset(offset)).scalars())
+
+    def photo_ids(self, words, limit, offset, ranked=True):
+        columns = (Photo.title, Photo.description, Photo.location, Photo.tags)
+        return list(db.session.execute(
+            select(Photo.id).where(Photo.status == 'ready', *self._all_words(columns, words))
+            .order_by(Photo.upload_date.desc(), Photo.id.desc()).limit(limit).offset(offset)).scalars())
+
+
+BACKENDS = {'fts5': FTS5Backend, 'like': LikeBackend}
+
+
+class Search:
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.get('SEARCH_BACKEND')
+        if not name:
+            # FTS5 ships with SQLite, anything else falls back to LIKE
+            name = 'fts5' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else 'like'
+        self.backend = BACKENDS[name]()
+
+    def setup(self):
+        """Create indexes/triggers if missing. Call inside an app context after create_all()."""
+        self.backend.setup()
+
+    def rebuild(self):
+        self.backend.rebuild()
+
+    def _page(self, fetch, model, query, page, per_page, ranked, options=()):
+        words = terms(query)
+        page = min(max(page, 1), MAX_PAGE)
+        if not words:
+            return SearchPage([], page, False)
+        # One extra id tells us whether there's a next page
+        ids = fetch(words, per_page + 1, (page - 1) * per_page, ranked)
+        return SearchPage(_in_order(model, ids[:per_page], options), page, len(ids) > per_page)
+
+    def users(self, query, page=1, per_page=20, ranked=True):
+        return self._page(self.backend.user_ids, User, query, page, per_page, ranked)
+
+    def photos(self, query, page=1, per_page=24, ranked=True):
+        return self._page(self.backend.photo_ids, Photo, query, page, per_page, ranked,
+                          (joinedload(Photo.photographer), undefer(Photo.comment_count)))
+
+
+def photo_counts(user_ids):
+    # Photo count per user for a result list, one GROUP BY instead of len(user.photos) each
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    return dict(db.session.execute(
+        select(Photo.user_id, func.count(Photo.id))
+        .where(Photo.user_id.in_(user_ids), Photo.status == 'ready')
+        .group_by(Photo.user_id)).all())
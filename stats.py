@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import bindparam, delete, func, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Photo, UserStats, connections
+
+# --- MATERIALIZED USER STATS ---
+# dashboard() and portfolio() used to load every photo a user owns just to sum views
+# and likes in Python. Those totals now live in user_stats and every write path nudges
+# them with col = col + n:
+#   photo ready / deleted      photo_count, total_views, total_likes
+#   like / unlike              total_likes      (interactions.toggle_like)
+#   buffered view flush        total_views      (counters.CounterBuffer.flush)
+#   follow / unfollow          follower_count, following_count
+# A missing row is never bumped, get() computes it from the source tables the first
+# time it's needed, so users from before this table existed just work.
+# `flask rebuild-stats` recomputes everyone if the numbers ever drift.
+
+user_stats = UserStats.__table__
+photos = Photo.__table__
+
+COLUMNS = ('photo_count', 'total_views', 'total_likes', 'follower_count', 'following_count')
+
+# Counter fields on photos -> their total on the owner's row
+PHOTO_TOTALS = {'views': 'total_views', 'likes': 'total_likes'}
+
+
+def bump(user_id, **deltas):
+    """Add deltas to a user's stats, e.g. bump(3, follower_count=1). No-op until the row exists."""
+    values = {column: user_stats.c[column] + delta for column, delta in deltas.items() if delta}
+    if values:
+        db.session.execute(update(user_stats).where(user_stats.c.user_id == user_id).values(values))
+
+
+def bump_photo_owners(field, deltas):
+    """
+    Add per-photo counter deltas to the owners' totals in one executemany.
+    `deltas` is [{'photo_id': .., 'delta': ..}], the same params CounterBuffer uses.
+    """
+    if not deltas:
+        return
+    column = PHOTO_TOTALS[field]
+    owner = select(photos.c.user_id).where(photos.c.id == bindparam('photo_id')).scalar_subquery()
+    db.session.execute(update(user_stats).where(user_stats.c.user_id == owner)
+                       .values({column: user_stats.c[column] + bindparam('delta')}), deltas)
+
+
+def photo_removed(photo):
+    # Call before deleting the row. Views still in the counter buffer land nowhere, fine
+    bump(photo.user_id, photo_count=-1 if photo.status == 'ready' else 0,
+         total_views=-(photo.views or 0), total_likes=-(photo.likes or 0))
+
+
+def followed(follower_id, followed_id, delta=1):
+    bump(follower_id, following_count=delta)
+    bump(followed_id, follower_count=delta)
+
+
+def _computed(user_id):
+    # The same numbers straight from the source tables, as one SELECT
+    mine = photos.c.user_id == user_id
+    return select(
+        literal(user_id).label('user_id'),
+        select(func.count()).where(mine, photos.c.status == 'ready').scalar_subquery(),
+        select(func.coalesce(func.sum(photos.c.views), 0)).where(mine).scalar_subquery(),
+        select(func.coalesce(func.sum(photos.c.likes), 0)).where(mine).scalar_subquery(),
+        select(func.count()).where(connections.c.followed_id == user_id).scalar_subquery(),
+        select(func.count()).where(connections.c.follower_id == user_id).scalar_subquery(),
+    )
+
+
+def refresh(user_id):
+    """Recompute one user's row from scratch. Commits."""
+    try:
+        with db.session.begin_nested():
+            db.session.execute(delete(user_stats).where(user_stats.c.user_id == user_id))
+            db.session.execute(insert(user_stats).from_select(('user_id',) + COLUMNS, _computed(user_id)))
+    except IntegrityError:
+        # Another request created it at the same moment, theirs is just as good
+        pass
+    db.session.commit()
+    return db.session.get(UserStats, user_id, populate_existing=True)
+
+
+def get(user_id):
+    return db.session.get(UserStats, user_id) or refresh(user_id)
+
+
+def rebuild_all(batch_size=1000):
+    last_id = 0
+    while True:
+        user_ids = [uid for (uid,) in db.session.query(User.id)
+                    .filter(User.id > last_id).order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            db.session.execute(delete(user_stats).where(user_stats.c.user_id == user_id))
+            db.session.execute(insert(user_stats).from_select(('user_id',) + COLUMNS, _computed(user_id)))
+        db.session.commit()
+        last_id = user_ids[-1]
+
+
+# --- DASHBOARD CHART ---
+# Top 10 photos by views for the Chart.js panel. Fetched by the page from a small JSON
+# endpoint and cached per user for a minute, views move constantly anyway.
+
+class ChartCache:
+
+    def __init__(self, app=None):
+        self._cache = OrderedDict()   # user_id -> (payload, loaded_at)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('DASHBOARD_CHART_TTL', 60)
+        self.max_users = app.config.get('DASHBOARD_CHART_CACHE_SIZE', 1000)
+
+    @staticmethod
+    def _load(user_id, limit=10):
+        rows = db.session.execute(
+            select(photos.c.title, photos.c.views, photos.c.likes)
+            .where(photos.c.user_id == user_id, photos.c.status == 'ready')
+            .order_by(photos.c.views.desc(), photos.c.id.desc()).limit(limit)).all()
+        return {'labels': [row.title for row in rows],
+                'views': [row.views or 0 for row in rows],
+                'likes': [row.likes or 0 for row in rows]}
+
+    def get(self, user_id):
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and time.monotonic() - cached[1] < self.ttl:
+                self._cache.move_to_end(user_id)
+                return cached[0]
+
+        payload = self._load(user_id)
+        with self._lock:
+            self._cache[user_id] = (payload, time.monotonic())
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_users:
+                self._cache.popitem(last=False)
+        return payload
+
+    def forget(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
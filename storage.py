@@ -0,0 +1,359 @@
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from flask import abort, make_response, redirect, request, send_file, url_for
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, Photo, User, StoredFile
+
+# --- UPLOAD STORAGE ---
+# Uploads used to land in static/uploads/ under names made from the original filename
+# and a timestamp (two uploads in the same second could overwrite each other), the same
+# bytes were stored once per upload, deletes unlinked files directly and every image
+# byte went through a Python worker. Now:
+#   1. every stored file is named by its content: ab/cd/<sha256>.<ext>. Same bytes,
+#      same key, stored once. Directories are sharded two levels deep (65k buckets)
+#   2. stored_files counts the references (photo renditions, avatars) to each key.
+#      release() only decrements, gc() deletes what has been unreferenced for
+#      STORAGE_GC_GRACE seconds, so the same bytes uploaded again soon after a delete
+#      just bring the key back
+#   3. the bytes live in a backend: 'local' (a directory) or 'bucket' (a local stand-in
+#      for object storage: put/get/delete only, no renames, no paths to hand out)
+#   4. /media/<key> is served by the front server when STORAGE_OFFLOAD is set
+#      (X-Accel-Redirect for nginx, X-Sendfile for Apache/lighttpd), by a redirect when
+#      the bucket has a STORAGE_PUBLIC_URL, else with sendfile + Range by Werkzeug
+# store() puts the bytes before the caller commits. If that transaction rolls back instead,
+# the keys it put get a refcount 0 row of their own, so gc() still finds those files.
+# Keys never change content, so they're cached as immutable. Names from before this
+# (no '/') are still served from static/uploads and deleted directly.
+
+stored_files = StoredFile.__table__
+
+# session.info entry: keys store() put in the session's current transaction
+PUT_KEYS = 'storage_put_keys'
+KEY_PATTERN = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]{2,5}$')
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_key(name):
+    return bool(name) and KEY_PATTERN.match(name) is not None
+
+
+def file_key(path):
+    """ab/cd/<sha256>.<ext> for a file on disk, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+    ext = os.path.splitext(path)[1].lstrip('.').lower() or 'bin'
+    return f"{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}.{ext}"
+
+
+# --- BACKENDS ---
+
+class LocalBackend:
+    """Keys are files under root, handed to sendfile / the front server as paths."""
+
+    def __init__(self, root, public_url=None):
+        self.root = root
+        self.public_url = public_url
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, src_path):
+        """Move src_path in as key. Returns False (and drops src_path) if it's already there."""
+        dest = self.path(key)
+        if os.path.exists(dest):
+            os.remove(src_path)
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.replace(src_path, dest)
+        except OSError:
+            # Different filesystem, copy next to the target then rename so readers never see half a file
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(dest), delete=False) as tmp:
+                with open(src_path, 'rb') as src:
+                    shutil.copyfileobj(src, tmp, CHUNK_SIZE)
+            os.replace(tmp.name, dest)
+            os.remove(src_path)
+        return True
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def local_path(self, key):
+        return self.path(key)
+
+    def url(self, key):
+        return None
+
+
+class BucketBackend(LocalBackend):
+    """
+    Stand-in for S3/GCS style object storage, kept on local disk: objects are uploaded
+    as a copy and read back as a stream, nothing gets a filesystem path. A real bucket
+    only needs put/open/size/delete/exists. With STORAGE_PUBLIC_URL browsers are
+    redirected to the bucket (or the CDN in front of it) and never touch the app.
+    """
+
+    def put(self, key, src_path):
+        if self.exists(key):
+            os.remove(src_path)
+            return False
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(dest), delete=False) as tmp:
+            with open(src_path, 'rb') as src:
+                shutil.copyfileobj(src, tmp, CHUNK_SIZE)
+        os.replace(tmp.name, dest)
+        os.remove(src_path)
+        return True
+
+    def local_path(self, key):
+        return None
+
+    def url(self, key):
+        return f"{self.public_url.rstrip('/')}/{key}" if self.public_url else None
+
+
+BACKENDS = {'local': LocalBackend, 'bucket': BucketBackend}
+
+
+class Storage:
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.config)
+        app.add_url_rule('/media/<path:key>', 'media', self.serve)
+        event.listen(db.session, 'after_commit', self._forget_puts)
+        event.listen(db.session, 'after_transaction_end', self._claim_puts)
+
+    def configure(self, config):
+        # Separate from init_app so scripts can point an imported app somewhere else
+        self.legacy_folder = config['UPLOAD_FOLDER']
+        root = config.get('STORAGE_ROOT') or self.legacy_folder
+        kind = config.get('STORAGE_BACKEND', 'local')
+        if kind not in BACKENDS:
+            raise RuntimeError(f"Unknown STORAGE_BACKEND '{kind}', use one of: {', '.join(BACKENDS)}")
+        self.backend = BACKENDS[kind](root, config.get('STORAGE_PUBLIC_URL'))
+        self.offload = config.get('STORAGE_OFFLOAD')
+        self.accel_prefix = config.get('STORAGE_ACCEL_PREFIX', '/_media/')
+        self.max_age = config.get('UPLOAD_CACHE_MAX_AGE', 365 * 24 * 3600)
+        self.gc_grace = config.get('STORAGE_GC_GRACE', 3600)
+
+    # --- REFERENCES ---
+
+    def store(self, path):
+        """
+        Take over a file (it's moved or deleted) and return its key, one more reference
+        to it. Call inside the transaction that saves the key.
+        """
+        key = file_key(path)
+        size = os.path.getsize(path)
+        now = datetime.utcnow()
+        # Reference first, bytes second: the row lock (or the new row) keeps gc() away from
+        # the key until we commit, and if gc() got there first it has already unlinked the
+        # file, so put() writes it again instead of trusting a copy that's about to go
+        found = db.session.execute(
+            update(stored_files).where(stored_files.c.key == key)
+            .values(refcount=stored_files.c.refcount + 1, updated_at=now)).rowcount
+        if not found:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(stored_files).values(key=key, refcount=1, size=size, updated_at=now))
+            except IntegrityError:
+                # Same bytes stored by another request a moment ago
+                db.session.execute(
+                    update(stored_files).where(stored_files.c.key == key)
+                    .values(refcount=stored_files.c.refcount + 1, updated_at=now))
+        self.backend.put(key, path)
+        db.session.info.setdefault(PUT_KEYS, set()).add(key)
+        return key
+
+    def _forget_puts(self, session):
+        # Committed, the rows store() wrote track the files now (a savepoint isn't the end)
+        if not session.in_nested_transaction():
+            session.info.pop(PUT_KEYS, None)
+
+    def _claim_puts(self, session, transaction):
+        """Rolled back (or closed) after store() put files: give them a row gc() can find."""
+        if transaction.parent is not None or not session.info.get(PUT_KEYS):
+            return
+        keys = session.info.pop(PUT_KEYS)
+        now = datetime.utcnow()
+        for key in keys:
+            try:
+                if not self.backend.exists(key):
+                    continue
+                with db.engine.begin() as conn:
+                    conn.execute(insert(stored_files).values(
+                        key=key, refcount=0, size=self.backend.size(key), updated_at=now))
+            except IntegrityError:
+                pass    # the row survived (or someone stored the same bytes since), it's tracked
+            except Exception as e:
+                print(f"Could not hand {key} over to gc: {e}")
+
+    def store_renditions(self, renditions, folder):
+        """{format: {width: name in folder}} -> the same with keys, every file stored once."""
+        keys = {name: self.store(os.path.join(folder, name))
+                for name in {name for sizes in renditions.values() for name in sizes.values()}}
+        return {fmt: {width: keys[name] for width, name in sizes.items()} for fmt, sizes in renditions.items()}
+
+    def release(self, names):
+        """Drop one reference to each name. Old style names are deleted straight away."""
+        now = datetime.utcnow()
+        for name in set(names):
+            if is_key(name):
+                db.session.execute(
+                    update(stored_files).where(stored_files.c.key == name)
+                    .values(refcount=stored_files.c.refcount - 1, updated_at=now))
+            elif name and name != 'default_profile.jpg' and os.path.basename(name) == name:
+                path = os.path.join(self.legacy_folder, name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def gc(self, grace=None, batch_size=500):
+        """Delete files nobody has referenced for `grace` seconds. Returns how many went."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.gc_grace if grace is None else grace)
+        removed = 0
+        while True:
+            keys = db.session.execute(
+                select(stored_files.c.key)
+                .where(stored_files.c.refcount <= 0, stored_files.c.updated_at < cutoff)
+                .limit(batch_size)).scalars().all()
+            if not keys:
+                return removed
+            for key in keys:
+                # Re-checked in the DELETE, a store() since the SELECT keeps the file.
+                # The file goes before the commit, while the row is still locked: a store()
+                # waiting on it then finds no row and no file, and writes both again
+                gone = db.session.execute(
+                    delete(stored_files).where(stored_files.c.key == key, stored_files.c.refcount <= 0)).rowcount
+                if gone:
+                    try:
+                        self.backend.delete(key)
+                    except OSError:
+                        db.session.rollback()
+                        raise
+                    removed += 1
+                db.session.commit()
+
+    def adopt_legacy(self, batch_size=200):
+        """Move old style uploads into storage and point photos/avatars at the keys."""
+        moved = 0
+        jobs = ((Photo, 'filename', 'renditions'), (User, 'profile_image', 'avatar_renditions'))
+        for model, main_column, renditions_column in jobs:
+            last_id = 0
+            while True:
+                rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                old_paths = []
+                for row in rows:
+                    main, renditions = getattr(row, main_column), getattr(row, renditions_column) or {}
+                    names = {main} | {name for sizes in renditions.values() for name in sizes.values()}
+                    keys = {}
+                    for name in names:
+                        path = os.path.join(self.legacy_folder, name or '')
+                        if is_key(name) or not name or name == 'default_profile.jpg' or not os.path.isfile(path):
+                            keys[name] = name
+                            continue
+                        # store() takes the file over, give it a copy until the commit went through
+                        fd, copy = tempfile.mkstemp(suffix=os.path.splitext(name)[1].lower(), dir=self.legacy_folder)
+                        os.close(fd)
+                        shutil.copyfile(path, copy)
+                        keys[name] = self.store(copy)
+                        old_paths.append(path)
+                    setattr(row, main_column, keys[main])
+                    if renditions:
+                        setattr(row, renditions_column, {fmt: {width: keys[name] for width, name in sizes.items()}
+                                                         for fmt, sizes in renditions.items()})
+                db.session.commit()
+                for path in old_paths:
+                    os.remove(path)
+                moved += len(old_paths)
+        return moved
+
+    # --- READING ---
+
+    def open(self, name):
+        if is_key(name):
+            return self.backend.open(name)
+        return open(os.path.join(self.legacy_folder, os.path.basename(name)), 'rb')
+
+    def fetch(self, name, dest_path):
+        """Copy a stored file to a local path (for jobs that need a real file)."""
+        with self.open(name) as src, open(dest_path, 'wb') as dest:
+            shutil.copyfileobj(src, dest, CHUNK_SIZE)
+        return dest_path
+
+    def url(self, name):
+        if not is_key(name):
+            return url_for('static', filename='uploads/' + name)
+        return self.backend.url(name) or url_for('media', key=name)
+
+    # --- SERVING ---
+
+    def serve(self, key):
+        if not is_key(key):
+            abort(404)
+        etag = os.path.basename(key).split('.')[0]
+        public_url = self.backend.url(key)
+        if public_url:
+            return redirect(public_url, 301)
+
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        elif self.offload in ('x-accel', 'x-sendfile'):
+            path = self.backend.local_path(key)
+            if path is None or not os.path.exists(path):
+                abort(404)
+            # Headers only, the front server streams the file (and answers Range itself)
+            response = make_response('')
+            response.mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+            if self.offload == 'x-accel':
+                response.headers['X-Accel-Redirect'] = self.accel_prefix + key
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+        else:
+            path = self.backend.local_path(key)
+            if path is not None:
+                if not os.path.exists(path):
+                    abort(404)
+                # A path lets the WSGI server use sendfile(), Range is answered from the stat
+                response = send_file(os.path.abspath(path), conditional=True, etag=etag)
+            else:
+                if not self.backend.exists(key):
+                    abort(404)
+                response = send_file(self.backend.open(key), conditional=False, etag=False,
+                                     mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream')
+                response.set_etag(etag)
+                response.make_conditional(request.environ, accept_ranges=True,
+                                          complete_length=self.backend.size(key))
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.cache_control.immutable = True
+        return response
@@ -0,0 +1,108 @@
+import math
+from datetime import datetime
+from models import db, Photo, Tag, photo_tags
+
+# --- TRENDING TAGS ---
+# Each photo adds 2^(-age / half_life) to the score of every tag it carries.
+# Decaying every score on every request would mean touching every row, so instead we
+# store log2(sum(2^((t - EPOCH) / half_life))) which ranks tags exactly the same way
+# and never needs rewriting as time passes. Adding or removing a photo is then a
+# single read-modify-write on the tag row, and ORDER BY trend_score hits an index.
+
+TREND_EPOCH = datetime(2024, 1, 1)
+TREND_HALF_LIFE_HOURS = 48.0
+MAX_TAG_LENGTH = 50
+
+
+def parse_tags(raw):
+    # "Sunset, sea ,SUNSET" -> ['sunset', 'sea']
+    if not raw:
+        return []
+    seen = []
+    for tag in raw.split(','):
+        tag = tag.strip().lower().lstrip('#')[:MAX_TAG_LENGTH]
+        if tag and tag not in seen:
+            seen.append(tag)
+    return seen
+
+
+def _weight(when):
+    # Position of a photo on the log2 score axis
+    return (when - TREND_EPOCH).total_seconds() / 3600.0 / TREND_HALF_LIFE_HOURS
+
+
+def _log2_add(a, b):
+    if a is None:
+        return b
+    hi, lo = max(a, b), min(a, b)
+    return hi + math.log2(1 + 2 ** (lo - hi))
+
+
+def _log2_sub(a, b):
+    # Only ever called with b <= a since b is one of the terms summed into a
+    if a is None or b >= a:
+        return None
+    return a + math.log2(1 - 2 ** (b - a))
+
+
+def tag_photo(photo):
+    """Index the tags of a new photo. Caller commits."""
+    names = parse_tags(photo.tags)
+    if not names:
+        return
+
+    existing = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+    weight = _weight(photo.upload_date or datetime.utcnow())
+
+    for name in names:
+        tag = existing.get(name)
+        if tag is None:
+            tag = Tag(name=name, photo_count=0)
+            db.session.add(tag)
+        tag.photo_count += 1
+        tag.trend_score = _log2_add(tag.trend_score, weight)
+        photo.tag_index.append(tag)
+
+
+def untag_photo(photo):
+    """Remove a photo's contribution before it gets deleted. Caller commits."""
+    weight = _weight(photo.upload_date or datetime.utcnow())
+
+    for tag in list(photo.tag_index):
+        tag.photo_count = max(tag.photo_count - 1, 0)
+        tag.trend_score = _log2_sub(tag.trend_score, weight) if tag.photo_count else None
+        photo.tag_index.remove(tag)
+
+
+def trending_tags(limit=10):
+    # Single indexed query, no matter how many photos exist
+    return [name for (name,) in db.session.query(Tag.name)
+            .filter(Tag.trend_score.isnot(None))
+            .order_by(Tag.trend_score.desc())
+            .limit(limit)]
+
+
+def filter_by_tag(query, name):
+    # Join through photo_tags instead of scanning Photo.tags with LIKE
+    tag_id = db.session.query(Tag.id).filter_by(name=name.strip().lower()).scalar_subquery()
+    return query.join(photo_tags, photo_tags.c.photo_id == Photo.id).filter(photo_tags.c.tag_id == tag_id)
+
+
+def rebuild_tag_index(batch_size=1000):
+    # Recomputes photo_tags and every score from scratch.
+    # Run it to backfill old photos or to wash out float drift in the scores.
+    # Only ready photos, processing ones get tagged when they finish, failed ones never show.
+    db.session.execute(photo_tags.delete())
+    Tag.query.delete()
+    db.session.commit()
+
+    last_id = 0
+    while True:
+        photos = (Photo.query.filter(Photo.id > last_id, Photo.status == 'ready')
+                  .order_by(Photo.id).limit(batch_size).all())
+        if not photos:
+            break
+        for photo in photos:
+            tag_photo(photo)
+        db.session.commit()
+        last_id = photos[-1].id
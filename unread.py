@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import func, select
+from models import db, Message
+
+# --- UNREAD MESSAGE BADGE ---
+# The navbar badge used to be a COUNT(*) on every single template render.
+# Now each user's count lives in a small in-memory LRU. The message paths nudge it
+# up/down as they go (and push the new value over the socket), and every
+# `reconcile_after` seconds we re-read the real number from the DB in case
+# another worker process changed it behind our back.
+
+messages = Message.__table__
+
+
+class UnreadCounter:
+
+    def __init__(self, app=None, socketio=None):
+        self._cache = OrderedDict()   # user_id -> (count, loaded_at)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, socketio)
+
+    def init_app(self, app, socketio=None):
+        self.socketio = socketio
+        self.reconcile_after = app.config.get('UNREAD_RECONCILE_SECONDS', 60)
+        self.max_users = app.config.get('UNREAD_CACHE_SIZE', 10000)
+
+    def _load(self, user_id):
+        # Served by the partial unread index on messages
+        return db.session.execute(select(func.count()).select_from(messages).where(
+            messages.c.recipient_id == user_id, ~messages.c.read)).scalar()
+
+    def _store(self, user_id, count, loaded_at):
+        with self._lock:
+            self._cache[user_id] = (count, loaded_at)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_users:
+                self._cache.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                self._cache.move_to_end(user_id)
+
+        if cached is not None and time.monotonic() - cached[1] < self.reconcile_after:
+            return cached[0]
+
+        count = self._load(user_id)
+        self._store(user_id, count, time.monotonic())
+        return count
+
+    def adjust(self, user_id, delta, push=True):
+        # Only touch users we already have, the rest get loaded fresh when needed
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                self._cache[user_id] = (max(cached[0] + delta, 0), cached[1])
+        if push:
+            self.push(user_id)
+
+    def push(self, user_id):
+        if self.socketio is not None:
+            self.socketio.emit('unread_count', {'count': self.get(user_id)}, room=f"user_{user_id}")
+
+    def forget(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
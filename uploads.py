@@ -0,0 +1,82 @@
+import os
+import tempfile
+from flask import Request, current_app, request
+from PIL import Image, UnidentifiedImageError
+import imaging  # registers the HEIF opener
+from exif import read_exif
+
+# --- STREAMING UPLOADS ---
+# Werkzeug keeps small uploads in memory and spools big ones to a temp file, then
+# file.save() copied that into incoming/ - two full writes, and the temp file lived
+# in /tmp (often RAM backed). Here multipart file parts are streamed straight into a
+# temp file inside INCOMING_FOLDER while the body is read, and claim() just renames it.
+# MAX_CONTENT_LENGTH (config.py) caps the body before any of it is stored, Werkzeug
+# answers 413 as soon as it's exceeded.
+#
+# Before anything gets decoded probe() reads only the image header: real format
+# (not the file extension) and pixel count, so a 1 KB PNG claiming 100000 x 100000
+# pixels (decompression bomb) never reaches Pillow's decoder. The EXIF block is in
+# that header too, so it's read right there (see exif.py).
+
+ACCEPTED_FORMATS = {'JPEG', 'MPO', 'PNG', 'GIF', 'WEBP', 'HEIF'}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class UploadRequest(Request):
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile(dir=current_app.config['INCOMING_FOLDER'],
+                                             prefix='upload-', suffix='.part', delete=False)
+        if not hasattr(self, '_spooled'):
+            self._spooled = []
+        self._spooled.append(stream.name)
+        return stream
+
+    def close(self):
+        super().close()
+        # Whatever the view didn't claim() goes away with the request
+        for path in getattr(self, '_spooled', ()):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def claim(file, dest_path):
+    """Move an uploaded file to dest_path, a rename when it was streamed to disk."""
+    path = getattr(file.stream, 'name', None)
+    spooled = getattr(request, '_spooled', [])
+    if path not in spooled:
+        file.save(dest_path)
+        return dest_path
+    file.stream.close()
+    os.replace(path, dest_path)
+    spooled.remove(path)
+    return dest_path
+
+
+def probe(file, max_pixels):
+    """Check an upload from its header alone. Returns (format, width, height, exif) or raises InvalidImage."""
+    stream = file.stream
+    try:
+        stream.seek(0)
+        # Image.open only parses the header, pixel data is read on first access
+        with Image.open(stream) as img:
+            fmt, (width, height) = img.format, img.size
+            exif = read_exif(img)
+    except Image.DecompressionBombError:
+        raise InvalidImage('That image has far too many pixels.')
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise InvalidImage('That file is not an image we can read.')
+    finally:
+        stream.seek(0)
+
+    if fmt not in ACCEPTED_FORMATS:
+        raise InvalidImage(f'{fmt} images are not supported.')
+    if width < 1 or height < 1:
+        raise InvalidImage('That image is empty.')
+    if width * height > max_pixels:
+        raise InvalidImage(f'That image is {width} x {height}, '
+                           f'the limit is {max_pixels // 1_000_000} megapixels.')
+    return fmt, width, height, exif